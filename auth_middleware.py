@@ -1,13 +1,25 @@
 from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from datetime import datetime, timedelta
-from starlette.responses import StreamingResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
+import asyncio
+import httpx
+import json
 import jwt
+import numpy as np
 import requests
 import os
 import logging
 import subprocess
 
+from compression import CompressionMiddleware
+from embed_batcher import EmbedBatcher
+from embedding_format import MEDIA_TYPES, encode_embeddings, negotiate
+from embedding_store import EmbeddingStore
+from http_cache import entity_tag, etag_matches
+from single_flight import Flight, SingleFlight, request_key
+from vector_index import VectorStore, normalize, top_k
+
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 
@@ -27,9 +39,65 @@ TOKEN_PASSWORD = os.getenv("TOKEN_PASSWORD", "default_token_password")
 # Ollama API URL
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://127.0.0.1:11434/")
 
+# Directory for the persistent embedding store (empty string disables it)
+EMBED_STORE_DIR = os.getenv("EMBED_STORE_DIR", "embed_store")
+
+# Share one upstream call between identical in-flight requests
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+
+# Only idempotent, deterministic endpoints are coalesced: chat and generate
+# sample a fresh answer per call, and pull/create/delete have side effects
+COALESCE_PATHS = {"api/embed", "api/show", "api/tags", "api/ps"}
+
+# Micro-batching of concurrent embed requests (a max window of 0 disables it)
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "64"))
+EMBED_BATCH_MIN_WINDOW_MS = float(os.getenv("EMBED_BATCH_MIN_WINDOW_MS", "2"))
+EMBED_BATCH_MAX_WINDOW_MS = float(os.getenv("EMBED_BATCH_MAX_WINDOW_MS", "10"))
+EMBED_BATCH_MAX_INFLIGHT = int(os.getenv("EMBED_BATCH_MAX_INFLIGHT", "2"))
+
+# Responses smaller than this are never compressed
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+
+# Compression level (gzip 1-9, brotli up to 11, zstd up to 22; capped per encoding)
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+# Upper bound on a decompressed request body
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(64 * 1024 * 1024)))
+
+# Directory for /protected/vectors collections (empty keeps them in memory)
+VECTOR_STORE_DIR = os.getenv("VECTOR_STORE_DIR", "vector_store")
+
+# Collections this large are searched through an IVF index instead of exactly
+VECTOR_IVF_MIN_ROWS = int(os.getenv("VECTOR_IVF_MIN_ROWS", "20000"))
+VECTOR_IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "8"))
+
+# Optional per-hit fields a vector query can return
+QUERY_INCLUDE_FIELDS = {"metadata", "documents"}
+
+# Metadata endpoints answered with an ETag and revalidated with If-None-Match
+ETAG_PATHS = {"api/tags", "api/show", "api/ps"}
+
 # In-memory token store
 tokens = {}
 
+# Shared embedding store, visible to every worker through the same directory
+embedding_store = EmbeddingStore(EMBED_STORE_DIR) if EMBED_STORE_DIR else None
+
+# /api/embed is answered here only when that adds something: the store, micro-batching
+# or packed float output. Otherwise it passes through with Ollama's timing fields intact.
+EMBED_INTERCEPT = embedding_store is not None or EMBED_BATCH_MAX_WINDOW_MS > 0
+
+# Named embedding collections served by /protected/vectors
+vector_store = VectorStore(
+    VECTOR_STORE_DIR or None, ivf_min_rows=VECTOR_IVF_MIN_ROWS, nprobe=VECTOR_IVF_NPROBE
+)
+
+# Pooled client for upstream Ollama calls
+upstream_client = httpx.AsyncClient(timeout=httpx.Timeout(600.0, connect=10.0))
+
+# In-flight request registry for coalescing identical requests
+single_flight = SingleFlight()
+
 # Security schema
 security = HTTPBearer()
 
@@ -85,10 +153,16 @@ async def auth_middleware(request: Request, call_next):
     if request.url.path not in unauthenticated_routes:
         auth_header = request.headers.get("Authorization")
         if not auth_header or not auth_header.startswith("Bearer "):
-            raise HTTPException(status_code=401, detail="Missing or invalid token")
+            return JSONResponse(
+                status_code=401, content={"detail": "Missing or invalid token"}
+            )
 
         token = auth_header.split(" ")[1]
-        verify_token(token)  # Validate the token
+        try:
+            verify_token(token)  # Validate the token
+        except HTTPException as e:
+            # Exceptions raised here bypass FastAPI's handlers and would become a 500
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
 
     return await call_next(request)  # Proceed to the next middleware or endpoint
 
@@ -96,6 +170,14 @@ async def auth_middleware(request: Request, call_next):
 # Add the middleware to the app
 app.middleware("http")(auth_middleware)
 
+# Negotiate gzip/zstd/brotli for responses and accept compressed request bodies
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESS_MIN_BYTES,
+    level=COMPRESS_LEVEL,
+    max_request_size=MAX_REQUEST_BYTES,
+)
+
 
 # Endpoint to generate a token (password-protected)
 @app.post("/generate-token")
@@ -111,6 +193,360 @@ async def create_token(request: Request):
     return {"token": token}
 
 
+@app.on_event("shutdown")
+async def close_upstream():
+    await upstream_client.aclose()
+    if embedding_store is not None:
+        embedding_store.close()
+
+
+async def json_body(request: Request) -> dict:
+    """The request body as a JSON object, or a 400."""
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be valid JSON")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    return payload
+
+
+# Request fields that do not change the vectors Ollama returns
+EMBED_KEY_IGNORED_FIELDS = {"model", "input", "keep_alive"}
+
+
+def embed_namespace(payload: dict) -> str:
+    """Store namespace for an embed request: the model plus any output-affecting options."""
+    options = {
+        k: v for k, v in payload.items() if k not in EMBED_KEY_IGNORED_FIELDS
+    }
+    if not options:
+        return payload["model"]
+    return f"{payload['model']}|{json.dumps(options, sort_keys=True)}"
+
+
+async def post_upstream_json(path: str, payload: dict) -> dict:
+    """POST a JSON payload to Ollama and return the decoded response."""
+    try:
+        response = await upstream_client.post(
+            f"{OLLAMA_API_URL.rstrip('/')}/{path}", json=payload
+        )
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to query Ollama: {str(e)}")
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Ollama API Error: {response.text}",
+        )
+    return response.json()
+
+
+async def send_embed_batch(payload: dict, texts: list) -> list:
+    """Forward one micro-batch of inputs as a single multi-input /api/embed call."""
+    result = await post_upstream_json("api/embed", {**payload, "input": texts})
+    return result["embeddings"]
+
+
+# Gathers concurrent embed misses into shared upstream calls
+embed_batcher = EmbedBatcher(
+    send_embed_batch,
+    max_batch=EMBED_BATCH_MAX,
+    min_window=EMBED_BATCH_MIN_WINDOW_MS / 1000,
+    max_window=EMBED_BATCH_MAX_WINDOW_MS / 1000,
+    max_inflight=EMBED_BATCH_MAX_INFLIGHT,
+)
+
+
+# Serve /api/embed from the embedding store, micro-batching only the misses upstream
+async def cached_embed(payload: dict) -> list:
+    if not payload.get("model"):
+        raise HTTPException(status_code=400, detail="Model is required")
+    inputs = payload.get("input")
+    texts = [inputs] if isinstance(inputs, str) else inputs or []
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        raise HTTPException(
+            status_code=400, detail="Input must be a string or a list of strings"
+        )
+    namespace = embed_namespace(payload)
+
+    vectors = [None] * len(texts)
+    if embedding_store is not None:
+        try:
+            # Store reads and appends take file locks: keep them off the event loop
+            vectors = await asyncio.to_thread(embedding_store.get_many, namespace, texts)
+        except (OSError, ValueError) as e:
+            logging.error(f"Embedding store read failed: {str(e)}")
+
+    missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+    if missing:
+        key = None
+        if COALESCE_REQUESTS:
+            upstream_payload = {**payload, "input": missing}
+            key = request_key("POST", "api/embed", "", json.dumps(upstream_payload).encode())
+        fetched = dict(
+            zip(
+                missing,
+                await single_flight.do(
+                    key, lambda: embed_batcher.embed(namespace, payload, missing)
+                ),
+            )
+        )
+        if embedding_store is not None:
+            try:
+                await asyncio.to_thread(
+                    embedding_store.put_many, namespace, missing, [fetched[t] for t in missing]
+                )
+            except (OSError, ValueError) as e:
+                logging.error(f"Embedding store write failed: {str(e)}")
+        vectors = [fetched[t] if v is None else v for t, v in zip(texts, vectors)]
+
+    return vectors
+
+
+class FlightResponse(StreamingResponse):
+    """Streams a shared flight to one client.
+
+    The subscription is closed however the response ends, including when the
+    client disconnects before the body starts and iteration never begins.
+    """
+
+    def __init__(self, flight: Flight):
+        self.subscription = flight.subscribe()
+        super().__init__(self.subscription, media_type=flight.media_type)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.subscription.close()
+
+
+# Render embeddings as packed floats when the client asked for them, else as JSON
+def embed_response(model: str, vectors: list, accept: str) -> Response:
+    dtype = negotiate(accept)
+    if dtype is not None:
+        return Response(
+            content=encode_embeddings(vectors, dtype), media_type=MEDIA_TYPES[dtype]
+        )
+    return JSONResponse(
+        {
+            "model": model,
+            "embeddings": [
+                v.tolist() if isinstance(v, memoryview) else v for v in vectors
+            ],
+        }
+    )
+
+
+def vector_collection(name: str, create: bool = False):
+    try:
+        collection = vector_store.collection(name, create=create)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if collection is None:
+        raise HTTPException(status_code=404, detail=f"Collection {name} not found")
+    return collection
+
+
+def int_field(payload: dict, name: str, default: int) -> int:
+    """A positive integer request field (default when absent or null), or a 400."""
+    value = payload.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"{name} must be an integer")
+    if value < 1:
+        raise HTTPException(status_code=400, detail=f"{name} must be at least 1")
+    return value
+
+
+# Embed texts through the cached embed path, as a float32 matrix
+async def embed_matrix(model: str, texts: list) -> np.ndarray:
+    if not model:
+        raise HTTPException(status_code=400, detail="Model is required to embed text")
+    vectors = await cached_embed({"model": model, "input": texts})
+    return np.vstack([np.asarray(v, dtype=np.float32) for v in vectors])
+
+
+# List vector collections
+@app.get("/protected/vectors")
+def list_vector_collections(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_token(credentials.credentials)
+    return {"collections": vector_store.names()}
+
+
+# Describe a vector collection
+@app.get("/protected/vectors/{name}")
+def describe_vector_collection(
+    name: str, credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    verify_token(credentials.credentials)
+    return vector_collection(name).describe()
+
+
+# Drop a vector collection
+@app.delete("/protected/vectors/{name}")
+def drop_vector_collection(
+    name: str, credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    verify_token(credentials.credentials)
+    vector_collection(name)
+    vector_store.drop(name)
+    return {"message": f"Collection {name} dropped"}
+
+
+# Insert or replace items: {"model", "items": [{"id", "text" or "vector", "metadata"}]}
+@app.post("/protected/vectors/{name}/upsert")
+async def upsert_vectors(
+    name: str,
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+):
+    verify_token(credentials.credentials)
+    payload = await json_body(request)
+    items = payload.get("items")
+    if (
+        not isinstance(items, list)
+        or not items
+        or any(not isinstance(item, dict) or "id" not in item for item in items)
+    ):
+        raise HTTPException(
+            status_code=400, detail="Items must be a list of objects with an id"
+        )
+    # Loading a collection takes its file lock and replays the journal: keep it off the loop
+    collection = await asyncio.to_thread(vector_collection, name, True)
+    model = payload.get("model") or collection.model
+
+    # Items without a vector are embedded in one batched call
+    to_embed = [i for i, item in enumerate(items) if item.get("vector") is None]
+    if any(not items[i].get("text") for i in to_embed):
+        raise HTTPException(status_code=400, detail="Each item needs a text or a vector")
+    embedded = {}
+    if to_embed:
+        matrix = await embed_matrix(model, [items[i]["text"] for i in to_embed])
+        embedded = dict(zip(to_embed, matrix))
+    try:
+        vectors = np.vstack(
+            [
+                embedded[i] if i in embedded else np.asarray(item["vector"], dtype=np.float32)
+                for i, item in enumerate(items)
+            ]
+        )
+        count = await asyncio.to_thread(
+            collection.upsert,
+            [str(item["id"]) for item in items],
+            vectors,
+            model if to_embed else payload.get("model"),
+            [item.get("metadata") for item in items],
+            [item.get("text") for item in items],
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"upserted": len(items), "count": count}
+
+
+# Top-k cosine search: {"query": text or [texts]} or {"vectors": [[...]]}, "k"
+@app.post("/protected/vectors/{name}/query")
+async def query_vectors(
+    name: str,
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+):
+    verify_token(credentials.credentials)
+    payload = await json_body(request)
+    include = payload.get("include", ["metadata"])
+    if not isinstance(include, list) or not all(
+        isinstance(field, str) and field in QUERY_INCLUDE_FIELDS for field in include
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"include must be a list of {', '.join(sorted(QUERY_INCLUDE_FIELDS))}",
+        )
+    collection = await asyncio.to_thread(vector_collection, name)
+    k = int_field(payload, "k", 10)
+    nprobe = int_field(payload, "nprobe", vector_store.nprobe)
+
+    if payload.get("vectors") is not None:
+        try:
+            queries = np.asarray(payload["vectors"], dtype=np.float32)
+        except (TypeError, ValueError):
+            # Ragged rows or non-numbers
+            queries = np.zeros(0, dtype=np.float32)
+    elif payload.get("query"):
+        texts = payload["query"]
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        queries = await embed_matrix(payload.get("model") or collection.model, texts)
+    else:
+        raise HTTPException(status_code=400, detail="A query or vectors are required")
+    if queries.ndim != 2:
+        raise HTTPException(
+            status_code=400, detail="vectors must be a list of equal-length number lists"
+        )
+
+    try:
+        results = await asyncio.to_thread(collection.search, queries, k, nprobe)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # One list per query, in the shape Chroma's query() returns
+    response = {
+        "ids": [[hit["id"] for hit in hits] for hits in results],
+        "scores": [[hit["score"] for hit in hits] for hits in results],
+    }
+    if "metadata" in include:
+        response["metadata"] = [[hit["metadata"] for hit in hits] for hits in results]
+    if "documents" in include:
+        response["documents"] = [[hit["document"] for hit in hits] for hits in results]
+    return response
+
+
+# Remove items by id: {"ids": [...]}
+@app.post("/protected/vectors/{name}/delete")
+async def delete_vectors(
+    name: str,
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+):
+    verify_token(credentials.credentials)
+    payload = await json_body(request)
+    collection = await asyncio.to_thread(vector_collection, name)
+    ids = [str(id_) for id_ in payload.get("ids") or []]
+    removed = await asyncio.to_thread(collection.delete, ids)
+    return {"deleted": removed, "count": collection.count}
+
+
+# Score candidates against a query: {"model", "query", "documents": [...], "top_n"}
+@app.post("/protected/rerank")
+async def rerank(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+):
+    verify_token(credentials.credentials)
+    payload = await json_body(request)
+    query = payload.get("query")
+    documents = payload.get("documents") or []
+    if not isinstance(query, str) or not query:
+        raise HTTPException(status_code=400, detail="A query string is required")
+    if not isinstance(documents, list) or not all(isinstance(d, str) for d in documents):
+        raise HTTPException(status_code=400, detail="Documents must be strings")
+    if not documents:
+        return {"model": payload.get("model"), "results": []}
+    top_n = int_field(payload, "top_n", len(documents))
+
+    # Query and candidates share one cached, micro-batched embed call
+    matrix = normalize(await embed_matrix(payload.get("model"), [query, *documents]))
+    scores = matrix[1:] @ matrix[0]
+    results = []
+    for index in top_k(scores, top_n):
+        result = {"index": int(index), "score": float(scores[index])}
+        if payload.get("return_documents"):
+            result["document"] = documents[index]
+        results.append(result)
+    return {"model": payload["model"], "results": results}
+
+
 # Protected route for pass-through with streaming
 @app.api_route("/protected/{path:path}", methods=["GET", "POST"])
 async def protected_route(
@@ -121,43 +557,75 @@ async def protected_route(
     # Token verification
     verify_token(credentials.credentials)
 
-    try:
-        # Construct the full Ollama URL including any subpath
-        ollama_url = f"{OLLAMA_API_URL.rstrip('/')}/{path}"
+    accept = request.headers.get("Accept")
+    if (
+        path == "api/embed"
+        and request.method == "POST"
+        and (EMBED_INTERCEPT or negotiate(accept) is not None)
+    ):
+        payload = await json_body(request)
+        vectors = await cached_embed(payload)
+        return embed_response(payload["model"], vectors, accept)
+
+    # Construct the full Ollama URL including any subpath
+    ollama_url = f"{OLLAMA_API_URL.rstrip('/')}/{path}"
+
+    # Get the request method
+    method = request.method
+    body = await request.body() if method == "POST" else b""
+
+    # Common headers
+    headers = {
+        "Content-Type": request.headers.get("Content-Type", "application/json")
+    }
 
-        # Get the request method
-        method = request.method
+    async def open_upstream():
+        upstream_request = upstream_client.build_request(
+            method, ollama_url, headers=headers, params=request.query_params, content=body
+        )
+        response = await upstream_client.send(upstream_request, stream=True)
 
-        # Common headers
-        headers = {
-            "Content-Type": request.headers.get("Content-Type", "application/json")
-        }
+        async def chunks():
+            try:
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+            finally:
+                await response.aclose()
 
-        if method == "GET":
-            response = requests.get(
-                ollama_url, headers=headers, params=request.query_params, stream=True
-            )
-        else:  # POST
-            body = await request.body()
-            response = requests.post(
-                ollama_url, data=body, headers=headers, stream=True
-            )
+        media_type = response.headers.get("Content-Type", "application/json")
+        return response.status_code, media_type, chunks()
 
-        # Check for errors
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Ollama API Error: {response.text}",
-            )
+    key = None
+    if COALESCE_REQUESTS and path in COALESCE_PATHS:
+        key = request_key(method, path, str(request.query_params), body)
 
-        # Stream the response back
-        return StreamingResponse(
-            response.iter_content(chunk_size=1024),
-            media_type=response.headers.get("Content-Type", "application/json"),
+    try:
+        flight = await single_flight.stream(key, open_upstream)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to query Ollama: {str(e)}")
+
+    # Check for errors
+    if flight.status_code != 200:
+        error_body = b"".join([frame async for frame in flight.subscribe()])
+        raise HTTPException(
+            status_code=flight.status_code,
+            detail=f"Ollama API Error: {error_body.decode('utf-8', 'replace')}",
         )
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to query Ollama: {str(e)}")
+    # Small metadata responses are buffered and tagged so clients can revalidate
+    if path in ETAG_PATHS:
+        content = b"".join([frame async for frame in flight.subscribe()])
+        etag = entity_tag(content)
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(
+            content=content,
+            media_type=flight.media_type,
+            headers={"ETag": etag, "Cache-Control": "no-cache"},
+        )
+
+    # Stream the response back, shared with any identical in-flight requests
+    return FlightResponse(flight)
 
 
 # Endpoint to revoke a token
@@ -187,6 +655,18 @@ def status(credentials: HTTPAuthorizationCredentials = Depends(security)):
     return {"middleware_status": middleware_status, "ollama_status": ollama_status}
 
 
+# Counters for the middleware's caching subsystems
+@app.get("/stats")
+def stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_token(credentials.credentials)  # Verify token for /stats
+    return {
+        "embedding_store": embedding_store.stats() if embedding_store else None,
+        "single_flight": single_flight.stats(),
+        "embed_batcher": embed_batcher.stats(),
+        "vector_collections": len(vector_store.names()),
+    }
+
+
 # Endpoint to kill and restart Ollama service
 @app.post("/restart-ollama")
 async def restart_ollama(credentials: HTTPAuthorizationCredentials = Depends(security)):
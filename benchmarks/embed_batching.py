@@ -0,0 +1,84 @@
+"""
+Throughput versus added latency of EmbedBatcher against a simulated Ollama.
+
+The simulated backend serves one call at a time and charges a fixed per-call
+overhead plus a per-input cost, which is roughly how Ollama's embed runner
+behaves. Each run drives closed-loop clients that send single-input requests
+and compares batching off (max window 0) with the adaptive window.
+
+    python -m benchmarks.embed_batching --concurrency 1 8 32 --seconds 3
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from embed_batcher import EmbedBatcher
+
+
+def make_backend(call_overhead: float, per_item: float):
+    lock = asyncio.Lock()
+
+    async def send(payload, texts):
+        async with lock:
+            await asyncio.sleep(call_overhead + per_item * len(texts))
+        return [[float(len(t))] for t in texts]
+
+    return send
+
+
+async def run(concurrency: int, seconds: float, max_window: float, args) -> dict:
+    batcher = EmbedBatcher(
+        make_backend(args.call_overhead_ms / 1000, args.per_item_ms / 1000),
+        max_batch=args.max_batch,
+        max_window=max_window,
+    )
+    latencies = []
+    deadline = time.monotonic() + seconds
+
+    async def client(worker: int):
+        n = 0
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            await batcher.embed("bench", {"model": "bench"}, [f"{worker}-{n}"])
+            latencies.append(time.monotonic() - started)
+            n += 1
+
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    latencies.sort()
+    stats = batcher.stats()
+    return {
+        "throughput": len(latencies) / seconds,
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p99_ms": 1000 * latencies[int(0.99 * (len(latencies) - 1))],
+        "mean_batch": stats["mean_batch_size"],
+        "added_wait_ms": stats["mean_added_wait_ms"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-window-ms", type=float, default=10.0)
+    parser.add_argument("--call-overhead-ms", type=float, default=15.0)
+    parser.add_argument("--per-item-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print(
+        f"{'clients':>7} {'mode':>8} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'batch':>6} {'wait ms':>8}"
+    )
+    for concurrency in args.concurrency:
+        for mode, window in (("off", 0.0), ("adaptive", args.max_window_ms / 1000)):
+            r = asyncio.run(run(concurrency, args.seconds, window, args))
+            print(
+                f"{concurrency:>7} {mode:>8} {r['throughput']:>9.1f} {r['p50_ms']:>8.1f}"
+                f" {r['p99_ms']:>8.1f} {r['mean_batch']:>6.1f} {r['added_wait_ms']:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
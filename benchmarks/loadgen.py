@@ -0,0 +1,497 @@
+"""
+End-to-end load generator and benchmark suite for the proxy chain.
+
+    client -> ollama_proxy_client (edge) -> nginx -> auth_middleware -> Ollama
+
+``run`` drives a mix of chat, generate and embed traffic either with a fixed
+number of closed-loop workers (``--concurrency``) or with open-loop Poisson
+arrivals (``--rate``), and reports latency percentiles, TTFT, inter-token
+latency, throughput and errors per operation.
+
+By default it starts the stack locally on free ports, each layer in its own
+uvicorn process, and runs the same workload against every layer:
+
+- ``stub``: the stub Ollama server on its own
+- ``middleware``: auth_middleware in front of the stub
+- ``edge``: ollama_proxy_client in front of the middleware
+
+The difference between consecutive layers is that hop's overhead. Pass
+``--url`` to benchmark an already running target instead (for example nginx
+in front of the middleware).
+
+``compare`` diffs two result files and exits non-zero on regressions.
+
+    python -m benchmarks.loadgen run --concurrency 8 --duration 20 -o new.json
+    python -m benchmarks.loadgen run --rate 5 --mix chat=1 --stream
+    python -m benchmarks.loadgen compare base.json new.json --threshold 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import httpx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYERS = ["stub", "middleware", "edge"]
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(values: List[float]) -> dict:
+    """p50/p95/p99 and mean in milliseconds."""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": 1000 * sum(values) / len(values),
+        "p50_ms": 1000 * percentile(values, 0.50),
+        "p95_ms": 1000 * percentile(values, 0.95),
+        "p99_ms": 1000 * percentile(values, 0.99),
+    }
+
+
+class Recorder:
+    """Raw samples for one operation."""
+
+    def __init__(self):
+        self.latency: List[float] = []
+        self.ttft: List[float] = []
+        self.itl: List[float] = []
+        self.tokens = 0
+        self.errors = 0
+        self.error_samples: List[str] = []
+
+    def error(self, message: str):
+        self.errors += 1
+        if len(self.error_samples) < 5:
+            self.error_samples.append(message[:200])
+
+    def report(self, elapsed: float) -> dict:
+        completed = len(self.latency)
+        total = completed + self.errors
+        return {
+            "requests": total,
+            "errors": self.errors,
+            "error_rate": self.errors / total if total else 0.0,
+            "throughput_rps": completed / elapsed if elapsed else 0.0,
+            "tokens_per_second": self.tokens / elapsed if elapsed else 0.0,
+            "latency": summarize(self.latency),
+            "ttft": summarize(self.ttft),
+            "inter_token": summarize(self.itl),
+            "error_samples": self.error_samples,
+        }
+
+
+def _frame_tokens(line: str) -> Optional[str]:
+    """Content carried by one NDJSON or SSE line, or None for framing/empty lines."""
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith("data:"):
+        line = line[5:].strip()
+        if line == "[DONE]":
+            return None
+    try:
+        frame = json.loads(line)
+    except ValueError:
+        return None
+    if "response" in frame:
+        return frame["response"] or None
+    if "message" in frame:
+        return frame["message"].get("content") or None
+    for choice in frame.get("choices", []):
+        content = (choice.get("delta") or {}).get("content")
+        if content:
+            return content
+    return None
+
+
+class Workload:
+    def __init__(self, args):
+        self.args = args
+        self.mix = []
+        for part in args.mix.split(","):
+            name, _, weight = part.partition("=")
+            self.mix.append((name.strip(), float(weight or 1)))
+        self.random = random.Random(args.seed)
+
+    def pick(self) -> str:
+        names, weights = zip(*self.mix)
+        return self.random.choices(names, weights)[0]
+
+    def text(self) -> str:
+        base = "Summarise the role of a reverse proxy in front of a model server. "
+        words = base * max(1, self.args.prompt_chars // len(base))
+        if self.random.random() < self.args.repeat_ratio:
+            return words
+        return f"{words} [{uuid.uuid4().hex}]"
+
+    def request(self, op: str) -> tuple:
+        """(path, json body, streaming) for one operation."""
+        args = self.args
+        if op == "embed":
+            inputs = [self.text() for _ in range(args.embed_batch)]
+            return "/api/embed", {"model": args.embed_model, "input": inputs}, False
+        options = {"num_predict": args.max_tokens}
+        if op == "chat":
+            body = {
+                "model": args.model,
+                "messages": [{"role": "user", "content": self.text()}],
+                "stream": args.stream,
+                "options": options,
+            }
+            return "/api/chat", body, args.stream
+        if op == "generate":
+            body = {
+                "model": args.model,
+                "prompt": self.text(),
+                "stream": args.stream,
+                "options": options,
+            }
+            return "/api/generate", body, args.stream
+        if op == "openai":
+            body = {
+                "model": args.model,
+                "messages": [{"role": "user", "content": self.text()}],
+                "stream": args.stream,
+                "max_tokens": args.max_tokens,
+            }
+            return "/v1/chat/completions", body, args.stream
+        raise ValueError(f"Unknown operation in --mix: {op}")
+
+
+async def one_request(client, target: dict, workload: Workload, recorders: dict):
+    op = workload.pick()
+    recorder = recorders.setdefault(op, Recorder())
+    path, body, streaming = workload.request(op)
+    url = f"{target['url']}{target['prefix']}{path}"
+    started = time.perf_counter()
+    try:
+        if not streaming:
+            response = await client.post(url, json=body, headers=target["headers"])
+            if response.status_code != 200:
+                recorder.error(f"{response.status_code}: {response.text}")
+                return
+            recorder.latency.append(time.perf_counter() - started)
+            if op != "embed":
+                recorder.tokens += body.get("options", {}).get("num_predict", 0)
+            return
+
+        last = None
+        async with client.stream("POST", url, json=body, headers=target["headers"]) as response:
+            if response.status_code != 200:
+                recorder.error(f"{response.status_code}: {(await response.aread()).decode()}")
+                return
+            async for line in response.aiter_lines():
+                if _frame_tokens(line) is None:
+                    continue
+                now = time.perf_counter()
+                if last is None:
+                    recorder.ttft.append(now - started)
+                else:
+                    recorder.itl.append(now - last)
+                last = now
+                recorder.tokens += 1
+        recorder.latency.append(time.perf_counter() - started)
+    except (httpx.HTTPError, ValueError) as e:
+        recorder.error(f"{type(e).__name__}: {e}")
+
+
+async def drive(target: dict, args) -> dict:
+    workload = Workload(args)
+    recorders: Dict[str, Recorder] = {}
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for _ in range(args.warmup):
+            await one_request(client, target, workload, {})
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+        if args.rate:
+            # Open loop: Poisson arrivals regardless of how fast responses come back
+            pending = set()
+            next_arrival = started
+            while next_arrival < deadline:
+                await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+                task = asyncio.ensure_future(
+                    one_request(client, target, workload, recorders)
+                )
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                next_arrival += workload.random.expovariate(args.rate)
+            if pending:
+                await asyncio.wait(pending)
+        else:
+
+            async def worker():
+                while time.perf_counter() < deadline:
+                    await one_request(client, target, workload, recorders)
+
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {op: recorder.report(elapsed) for op, recorder in sorted(recorders.items())}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, headers: dict, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, headers=headers, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+class LocalStack:
+    """Stub, middleware and edge proxy as local uvicorn processes."""
+
+    def __init__(self, args):
+        self.args = args
+        self.processes: List[subprocess.Popen] = []
+        self.targets: Dict[str, dict] = {}
+
+    def _spawn(self, command: List[str], env: dict) -> subprocess.Popen:
+        process = subprocess.Popen(
+            command, cwd=REPO_ROOT, env={**os.environ, **env}, stdout=subprocess.DEVNULL
+        )
+        self.processes.append(process)
+        return process
+
+    def _uvicorn(self, module: str, port: int, env: dict) -> subprocess.Popen:
+        return self._spawn(
+            [sys.executable, "-m", "uvicorn", module, "--port", str(port),
+             "--log-level", "warning", "--no-access-log"],
+            env,
+        )
+
+    def __enter__(self):
+        args = self.args
+        password = "loadgen-password"
+        stub_port, mw_port, edge_port = free_port(), free_port(), free_port()
+        stub_url = f"http://127.0.0.1:{stub_port}"
+        mw_url = f"http://127.0.0.1:{mw_port}"
+        edge_url = f"http://127.0.0.1:{edge_port}"
+
+        stub = self._spawn(
+            [sys.executable, "-m", "benchmarks.stub_ollama", "--port", str(stub_port)]
+            + shlex.split(args.stub_args),
+            {},
+        )
+        wait_ready(f"{stub_url}/", {}, stub)
+        self.targets["stub"] = {"url": stub_url, "prefix": "", "headers": {}}
+
+        mw_env = {
+            "OLLAMA_API_URL": f"{stub_url}/",
+            "TOKEN_PASSWORD": password,
+            "EMBED_STORE_DIR": os.path.join(args.work_dir, f"embed_store_{mw_port}"),
+        }
+        middleware = self._uvicorn("auth_middleware:app", mw_port, mw_env)
+        wait_ready(f"{mw_url}/", {}, middleware)
+        token = httpx.post(
+            f"{mw_url}/generate-token", json={"password": password}
+        ).json()["token"]
+        self.targets["middleware"] = {
+            "url": mw_url,
+            "prefix": "/protected",
+            "headers": {"Authorization": f"Bearer {token}"},
+        }
+
+        edge_headers = {"x-api-key": "ollama"}
+        edge_env = {"BASE_URL": mw_url, "TOKEN_PASSWORD": password, "API_KEY": "ollama"}
+        edge = self._uvicorn("ollama_proxy_client:app", edge_port, edge_env)
+        wait_ready(f"{edge_url}/mw/", edge_headers, edge)
+        self.targets["edge"] = {"url": edge_url, "prefix": "/pxy", "headers": edge_headers}
+        return self
+
+    def __exit__(self, *exc):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def hop_overhead(layers: dict) -> dict:
+    """Added p50/p95 latency and TTFT of each layer over the one below it."""
+    overhead = {}
+    ordered = [name for name in LAYERS if name in layers]
+    for lower, upper in zip(ordered, ordered[1:]):
+        hop = {}
+        for op, upper_report in layers[upper].items():
+            lower_report = layers[lower].get(op)
+            if not lower_report:
+                continue
+            hop[op] = {}
+            for metric in ("latency", "ttft"):
+                for stat in ("p50_ms", "p95_ms"):
+                    a = lower_report[metric].get(stat)
+                    b = upper_report[metric].get(stat)
+                    if a is not None and b is not None:
+                        hop[op][f"{metric}_{stat}"] = b - a
+        overhead[f"{lower}->{upper}"] = hop
+    return overhead
+
+
+def print_report(layers: dict):
+    print(
+        f"{'layer':<11} {'op':<9} {'req/s':>8} {'err%':>6} {'p50':>8} {'p95':>8}"
+        f" {'p99':>8} {'ttft50':>8} {'itl50':>7}"
+    )
+    for layer, ops in layers.items():
+        for op, r in ops.items():
+            lat, ttft, itl = r["latency"], r["ttft"], r["inter_token"]
+            print(
+                f"{layer:<11} {op:<9} {r['throughput_rps']:>8.1f} {100 * r['error_rate']:>6.1f}"
+                f" {lat.get('p50_ms', 0):>8.1f} {lat.get('p95_ms', 0):>8.1f}"
+                f" {lat.get('p99_ms', 0):>8.1f} {ttft.get('p50_ms', 0):>8.1f}"
+                f" {itl.get('p50_ms', 0):>7.1f}"
+            )
+            for sample in r["error_samples"][:1]:
+                print(f"{'':<21} first error: {sample}")
+
+
+def run(args) -> int:
+    settings = {
+        key: value for key, value in vars(args).items() if key not in ("func", "output")
+    }
+    layers = {}
+    if args.url:
+        headers = dict(h.split(":", 1) for h in args.header)
+        headers = {k.strip(): v.strip() for k, v in headers.items()}
+        target = {"url": args.url.rstrip("/"), "prefix": args.prefix, "headers": headers}
+        layers["target"] = asyncio.run(drive(target, args))
+    else:
+        with LocalStack(args) as stack:
+            for layer in args.layers:
+                layers[layer] = asyncio.run(drive(stack.targets[layer], args))
+
+    result = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": settings,
+        "layers": layers,
+        "hop_overhead": hop_overhead(layers),
+    }
+    print_report(layers)
+    for hop, ops in result["hop_overhead"].items():
+        for op, deltas in ops.items():
+            if not deltas:
+                continue
+            formatted = ", ".join(f"{k}={v:+.1f}ms" for k, v in deltas.items())
+            print(f"overhead {hop:<18} {op:<9} {formatted}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+def compare(args) -> int:
+    """Flag latency, TTFT, throughput and error-rate regressions beyond the threshold."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    regressions = []
+    for layer, ops in candidate["layers"].items():
+        for op, new in ops.items():
+            old = baseline["layers"].get(layer, {}).get(op)
+            if not old:
+                continue
+            checks = [
+                (f"{metric}.{stat}", old[metric].get(stat), new[metric].get(stat), True)
+                for metric in ("latency", "ttft", "inter_token")
+                for stat in ("p50_ms", "p95_ms", "p99_ms")
+            ]
+            checks.append(("throughput_rps", old["throughput_rps"], new["throughput_rps"], False))
+            for name, before, after, lower_is_better in checks:
+                if not before or after is None:
+                    continue
+                change = (after - before) / before
+                worse = change > args.threshold if lower_is_better else change < -args.threshold
+                marker = "REGRESSION" if worse else ""
+                print(f"{layer:<11} {op:<9} {name:<20} {before:>10.2f} -> {after:>10.2f} {change:>+7.1%} {marker}")
+                if worse:
+                    regressions.append((layer, op, name))
+            if new["error_rate"] > old["error_rate"] + args.error_threshold:
+                print(f"{layer:<11} {op:<9} error_rate {old['error_rate']:.2%} -> {new['error_rate']:.2%} REGRESSION")
+                regressions.append((layer, op, "error_rate"))
+
+    print(f"{len(regressions)} regression(s)")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Proxy chain load generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Drive load and record results")
+    run_parser.add_argument("--layers", nargs="+", choices=LAYERS, default=LAYERS)
+    run_parser.add_argument("--url", help="Benchmark a running target instead of a local stack")
+    run_parser.add_argument("--prefix", default="/protected", help="Route prefix for --url")
+    run_parser.add_argument("--header", action="append", default=[], help="'Name: value' for --url")
+    run_parser.add_argument("--mix", default="chat=0.5,generate=0.3,embed=0.2",
+                            help="Weighted operations: chat, generate, embed, openai")
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--rate", type=float, default=0.0,
+                            help="Open-loop arrivals per second (overrides --concurrency)")
+    run_parser.add_argument("--duration", type=float, default=10.0)
+    run_parser.add_argument("--warmup", type=int, default=2)
+    run_parser.add_argument("--stream", action="store_true")
+    run_parser.add_argument("--model", default="llama3.2:latest")
+    run_parser.add_argument("--embed-model", default="nomic-embed-text:latest")
+    run_parser.add_argument("--embed-batch", type=int, default=1)
+    run_parser.add_argument("--max-tokens", type=int, default=32)
+    run_parser.add_argument("--prompt-chars", type=int, default=400)
+    run_parser.add_argument("--repeat-ratio", type=float, default=0.0,
+                            help="Fraction of requests reusing an identical prompt")
+    run_parser.add_argument("--timeout", type=float, default=120.0)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--stub-args", default="--tokens-per-second 200",
+                            help="Extra arguments for benchmarks.stub_ollama")
+    run_parser.add_argument("--work-dir", default=os.path.join(REPO_ROOT, ".loadgen"))
+    run_parser.add_argument("-o", "--output", help="Write machine-readable results here")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="Relative change that counts as a regression")
+    compare_parser.add_argument("--error-threshold", type=float, default=0.01)
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""
+Stub Ollama server for offline load testing of the whole proxy chain.
+
+Implements the endpoints the middleware and clients use, with Ollama's
+response shapes and timing fields:
+
+- ``GET /api/tags``, ``GET /api/ps``, ``POST /api/show``
+- ``POST /api/generate`` and ``POST /api/chat`` (NDJSON streaming by default)
+- ``POST /api/embed`` (deterministic unit vectors derived from the text)
+- ``POST /v1/chat/completions`` (OpenAI JSON or SSE streaming)
+
+Timing is simulated from the configuration: a cold model pays ``load_time``,
+prompts are evaluated at ``prompt_eval_rate`` tokens/s, output is produced at
+``tokens_per_second``, and at most ``num_parallel`` requests run per model,
+like ``OLLAMA_NUM_PARALLEL``. ``failure_rate`` answers a request with a 500
+and ``stall_rate`` pauses a stream for ``stall_seconds`` mid-response.
+
+    python -m benchmarks.stub_ollama --port 11434 --tokens-per-second 40
+
+Use ``create_app(StubConfig(...))`` to run it in-process, e.g. behind
+``httpx.ASGITransport``.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+WORDS = (
+    "the of and to in is that for it as with was on be by this are or from at "
+    "an which but not have has had were all can if more when will would there "
+    "model token server proxy cache request stream latency batch vector"
+).split()
+
+
+@dataclass
+class StubConfig:
+    models: List[str] = field(
+        default_factory=lambda: ["llama3.2:latest", "nomic-embed-text:latest"]
+    )
+    load_time: float = 0.0  # Seconds to load a cold model
+    prompt_eval_rate: float = 2000.0  # Prompt tokens per second
+    tokens_per_second: float = 50.0  # Generated tokens per second
+    default_tokens: int = 64  # Output length when the request sets none
+    embedding_dim: int = 768
+    num_parallel: int = 4  # Concurrent requests per model
+    keep_alive: float = 300.0  # Seconds a model stays loaded after use
+    failure_rate: float = 0.0  # Fraction of requests answered with a 500
+    stall_rate: float = 0.0  # Fraction of streams that pause mid-response
+    stall_seconds: float = 5.0
+    seed: int = 0
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: about four characters per token."""
+    return max(1, len(text) // 4)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _ns(seconds: float) -> int:
+    return int(seconds * 1e9)
+
+
+class StubOllama:
+    """Simulated model runtime behind the stub endpoints."""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.loaded: Dict[str, float] = {}  # model -> expiry (monotonic)
+        self.slots: Dict[str, asyncio.Semaphore] = {}
+        self.requests = 0
+        self.started_at = _now()  # Reported as modified_at, so /api/tags stays stable
+
+    def known(self, model: str) -> bool:
+        return self.canonical(model) in self.config.models
+
+    @staticmethod
+    def canonical(model: str) -> str:
+        return model if ":" in model else f"{model}:latest"
+
+    def should_fail(self) -> bool:
+        return self.random.random() < self.config.failure_rate
+
+    async def load(self, model: str) -> float:
+        """Load a cold model, returning the time spent loading."""
+        model = self.canonical(model)
+        now = time.monotonic()
+        spent = 0.0
+        if self.loaded.get(model, 0.0) < now:
+            spent = self.config.load_time
+            await asyncio.sleep(spent)
+        self.loaded[model] = time.monotonic() + self.config.keep_alive
+        return spent
+
+    def slot(self, model: str) -> asyncio.Semaphore:
+        model = self.canonical(model)
+        if model not in self.slots:
+            self.slots[model] = asyncio.Semaphore(self.config.num_parallel)
+        return self.slots[model]
+
+    def words(self, prompt: str, count: int) -> List[str]:
+        rng = random.Random(f"{self.config.seed}:{prompt}")
+        return [
+            (" " if i else "") + rng.choice(WORDS) for i in range(count)
+        ]
+
+    def embedding(self, model: str, text: str) -> List[float]:
+        digest = hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+        rng = random.Random(digest)
+        vector = [rng.gauss(0.0, 1.0) for _ in range(self.config.embedding_dim)]
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    async def generate(self, model: str, prompt: str, max_tokens: int, stream: bool):
+        """Yield (token, stats) pairs; stats is None until the final step."""
+        started = time.monotonic()
+        async with self.slot(model):
+            load = await self.load(model)
+            prompt_tokens = estimate_tokens(prompt)
+            prompt_eval = prompt_tokens / self.config.prompt_eval_rate
+            await asyncio.sleep(prompt_eval)
+
+            stall_at = -1
+            if stream and self.random.random() < self.config.stall_rate:
+                stall_at = self.random.randrange(max(1, max_tokens))
+            eval_started = time.monotonic()
+            for i, token in enumerate(self.words(prompt, max_tokens)):
+                await asyncio.sleep(1 / self.config.tokens_per_second)
+                if i == stall_at:
+                    await asyncio.sleep(self.config.stall_seconds)
+                yield token, None
+            eval_duration = time.monotonic() - eval_started
+            self.loaded[self.canonical(model)] = time.monotonic() + self.config.keep_alive
+
+        yield "", {
+            "total_duration": _ns(time.monotonic() - started),
+            "load_duration": _ns(load),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": _ns(prompt_eval),
+            "eval_count": max_tokens,
+            "eval_duration": _ns(eval_duration),
+        }
+
+
+def _error(status: int, message: str) -> JSONResponse:
+    return JSONResponse({"error": message}, status_code=status)
+
+
+def _messages_prompt(messages: list) -> str:
+    return "\n".join(str(m.get("content", "")) for m in messages)
+
+
+def create_app(config: StubConfig = None) -> FastAPI:
+    stub = StubOllama(config or StubConfig())
+    app = FastAPI()
+    app.state.stub = stub
+
+    @app.middleware("http")
+    async def count_requests(request: Request, call_next):
+        stub.requests += 1
+        return await call_next(request)
+
+    @app.get("/")
+    async def root():
+        return PlainTextResponse("Ollama is running")
+
+    @app.get("/api/tags")
+    async def tags():
+        return {
+            "models": [
+                {
+                    "name": name,
+                    "model": name,
+                    "modified_at": stub.started_at,
+                    "size": 2_000_000_000,
+                    "digest": hashlib.sha256(name.encode()).hexdigest(),
+                    "details": {"format": "gguf", "family": name.split(":")[0]},
+                }
+                for name in stub.config.models
+            ]
+        }
+
+    @app.get("/api/ps")
+    async def ps():
+        now = time.monotonic()
+        return {
+            "models": [
+                {
+                    "name": name,
+                    "model": name,
+                    "size": 2_000_000_000,
+                    "size_vram": 0,
+                    "expires_at": (
+                        datetime.now(timezone.utc) + timedelta(seconds=expiry - now)
+                    ).isoformat(),
+                }
+                for name, expiry in stub.loaded.items()
+                if expiry > now
+            ]
+        }
+
+    @app.post("/api/show")
+    async def show(request: Request):
+        body = await request.json()
+        model = body.get("model") or body.get("name", "")
+        if not stub.known(model):
+            return _error(404, f"model '{model}' not found")
+        return {
+            "modelfile": f"FROM {model}",
+            "parameters": "stop <|eot_id|>",
+            "template": "{{ .Prompt }}",
+            "details": {"format": "gguf", "family": model.split(":")[0]},
+            "model_info": {"general.context_length": 131072},
+        }
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        model = body.get("model", "")
+        if not stub.known(model):
+            return _error(404, f"model '{model}' not found")
+        if stub.should_fail():
+            return _error(500, "injected failure")
+        inputs = body.get("input", [])
+        texts = [inputs] if isinstance(inputs, str) else list(inputs)
+        started = time.monotonic()
+        async with stub.slot(model):
+            load = await stub.load(model)
+            tokens = sum(estimate_tokens(t) for t in texts)
+            await asyncio.sleep(tokens / stub.config.prompt_eval_rate)
+        return {
+            "model": model,
+            "embeddings": [stub.embedding(model, t) for t in texts],
+            "total_duration": _ns(time.monotonic() - started),
+            "load_duration": _ns(load),
+            "prompt_eval_count": tokens,
+        }
+
+    async def native(request: Request, chat: bool):
+        body = await request.json()
+        model = body.get("model", "")
+        if not stub.known(model):
+            return _error(404, f"model '{model}' not found")
+        if stub.should_fail():
+            return _error(500, "injected failure")
+        prompt = _messages_prompt(body.get("messages", [])) if chat else body.get("prompt", "")
+        options = body.get("options") or {}
+        max_tokens = int(options.get("num_predict") or stub.config.default_tokens)
+        stream = body.get("stream", True)
+
+        def frame(token: str, stats: dict) -> dict:
+            out = {"model": model, "created_at": _now()}
+            if chat:
+                out["message"] = {"role": "assistant", "content": token}
+            else:
+                out["response"] = token
+            out["done"] = stats is not None
+            if stats is not None:
+                out.update({"done_reason": "stop", **stats})
+            return out
+
+        if not stream:
+            text = []
+            async for token, stats in stub.generate(model, prompt, max_tokens, False):
+                text.append(token)
+            return frame("".join(text), stats)
+
+        async def frames():
+            async for token, stats in stub.generate(model, prompt, max_tokens, True):
+                yield (json.dumps(frame(token, stats)) + "\n").encode("utf-8")
+
+        return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        return await native(request, chat=False)
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        return await native(request, chat=True)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "")
+        if not stub.known(model):
+            return _error(404, f"model '{model}' not found")
+        if stub.should_fail():
+            return _error(500, "injected failure")
+        prompt = _messages_prompt(body.get("messages", []))
+        max_tokens = int(body.get("max_tokens") or stub.config.default_tokens)
+        completion_id = f"chatcmpl-{stub.random.randrange(10**6)}"
+        created = int(time.time())
+
+        def usage(stats: dict) -> dict:
+            return {
+                "prompt_tokens": stats["prompt_eval_count"],
+                "completion_tokens": stats["eval_count"],
+                "total_tokens": stats["prompt_eval_count"] + stats["eval_count"],
+            }
+
+        if not body.get("stream"):
+            text = []
+            async for token, stats in stub.generate(model, prompt, max_tokens, False):
+                text.append(token)
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(text)},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage(stats),
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        def chunk(delta: dict, finish_reason=None, **extra) -> bytes:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+                **extra,
+            }
+            return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+        async def events():
+            async for token, stats in stub.generate(model, prompt, max_tokens, True):
+                if stats is None:
+                    yield chunk({"role": "assistant", "content": token})
+                else:
+                    yield chunk({}, "stop")
+                    if include_usage:
+                        data = {
+                            "id": completion_id,
+                            "object": "chat.completion.chunk",
+                            "created": created,
+                            "model": model,
+                            "choices": [],
+                            "usage": usage(stats),
+                        }
+                        yield f"data: {json.dumps(data)}\n\n".encode("utf-8")
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    defaults = StubConfig()
+    parser = argparse.ArgumentParser(description="Stub Ollama server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--models", nargs="+", default=defaults.models)
+    parser.add_argument("--load-time", type=float, default=defaults.load_time)
+    parser.add_argument("--prompt-eval-rate", type=float, default=defaults.prompt_eval_rate)
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--default-tokens", type=int, default=defaults.default_tokens)
+    parser.add_argument("--embedding-dim", type=int, default=defaults.embedding_dim)
+    parser.add_argument("--num-parallel", type=int, default=defaults.num_parallel)
+    parser.add_argument("--keep-alive", type=float, default=defaults.keep_alive)
+    parser.add_argument("--failure-rate", type=float, default=defaults.failure_rate)
+    parser.add_argument("--stall-rate", type=float, default=defaults.stall_rate)
+    parser.add_argument("--stall-seconds", type=float, default=defaults.stall_seconds)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = vars(parser.parse_args())
+    host, port = args.pop("host"), args.pop("port")
+
+    import uvicorn
+
+    uvicorn.run(create_app(StubConfig(**args)), host=host, port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Adaptive in-flight limit for bulk requests.
+
+Bulk jobs (embedding ingestion) should use whatever capacity the server has
+spare, and give it back as soon as interactive traffic needs it. Instead of a
+fixed parallelism, ``AdaptiveLimit`` moves the number of requests in flight
+using the signals the server gives:
+
+- additive increase: every completed request with the window full adds
+  ``1 / limit``, so the limit grows by about one per round trip
+- multiplicative decrease on overload: a 429, a 5xx, a timeout or a
+  connection failure halves the limit, at most once per round trip
+- latency back-off (as in TCP Vegas): when the smoothed latency per item
+  exceeds ``latency_tolerance`` times the best seen recently, requests are
+  queueing at the server, so the limit shrinks by 10%
+- ``Retry-After``: no new request starts before the time the server asked for
+
+Latencies are per item (e.g. per text embedded), so batches of different
+sizes are comparable. Sync threads and asyncio tasks can share one limit.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Deque, Optional, Tuple
+
+# Weight of each sample in the smoothed latency
+LATENCY_SMOOTHING = 0.2
+
+# How fast the baseline latency forgets an old minimum (per sample)
+BASELINE_DRIFT = 0.001
+
+# Multiplier applied when latency says the server is queueing
+LATENCY_BACKOFF = 0.9
+
+# Longest Retry-After that is honored, in seconds
+MAX_RETRY_AFTER = 120.0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+
+class AdaptiveLimit:
+    """AIMD limit on concurrent requests, with a latency back-off."""
+
+    def __init__(
+        self,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 16,
+        backoff_ratio: float = 0.5,
+        latency_tolerance: float = 2.0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max_limit, max(min_limit, initial)))
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+
+        self.inflight = 0
+        self.latency: Optional[float] = None
+        self.duration = 0.0
+        self.min_latency: Optional[float] = None
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.overloads = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._async_waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+    def _wait_time(self) -> Optional[float]:
+        """0 if a request may start now, else seconds to sleep (None: until a release)."""
+        blocked = self.blocked_until - time.monotonic()
+        if blocked > 0:
+            return blocked
+        if self.inflight < int(self.limit):
+            return 0.0
+        return None
+
+    def acquire(self):
+        with self._ready:
+            while True:
+                wait = self._wait_time()
+                if wait == 0:
+                    self.inflight += 1
+                    return
+                self._ready.wait(timeout=wait)
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                wait = self._wait_time()
+                if wait == 0:
+                    self.inflight += 1
+                    return
+                future = None
+                if wait is None:
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+            if future is None:
+                await asyncio.sleep(wait)
+            else:
+                await future
+
+    def release(
+        self,
+        duration: Optional[float],
+        items: int = 1,
+        overloaded: bool = False,
+        retry_after: Optional[float] = None,
+    ):
+        """Finish a request: how long it took for how many items, or that it was refused."""
+        now = time.monotonic()
+        with self._lock:
+            was_full = self.inflight >= int(self.limit)
+            self.inflight -= 1
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            if overloaded:
+                self.overloads += 1
+                self._decrease(now, self.backoff_ratio)
+            elif duration is not None:
+                self.duration = (
+                    duration
+                    if self.min_latency is None
+                    else self.duration + LATENCY_SMOOTHING * (duration - self.duration)
+                )
+                self._observe(duration / max(1, items), now, was_full)
+            self._wake()
+
+    def _observe(self, latency: float, now: float, was_full: bool):
+        if self.min_latency is None:
+            self.min_latency = self.latency = latency
+        else:
+            # Let the baseline rise slowly so a stale minimum cannot pin the limit down
+            self.min_latency = min(
+                latency, self.min_latency + BASELINE_DRIFT * (latency - self.min_latency)
+            )
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        if self.latency > self.min_latency * self.latency_tolerance:
+            self._decrease(now, LATENCY_BACKOFF)
+        elif was_full:
+            # Only probe for more while the current window is actually used
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _decrease(self, now: float, ratio: float):
+        # One decrease per round trip: the requests already in flight saw the same state
+        if now - self.last_decrease < self.duration:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * ratio)
+
+    def _wake(self):
+        self._ready.notify_all()
+        while self._async_waiters:
+            loop, future = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                pass  # The waiter's loop has closed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "inflight": self.inflight,
+                "latency_per_item_s": self.latency,
+                "min_latency_per_item_s": self.min_latency,
+                "overloads": self.overloads,
+                "blocked_for_s": max(0.0, self.blocked_until - time.monotonic()),
+            }
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
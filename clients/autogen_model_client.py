@@ -0,0 +1,231 @@
+"""
+autogen model client for Ollama's native /api/chat behind the middleware.
+
+``OllamaClient`` (wrapper_ollama_agents_convex.py) and ``OllamaLLMClient``
+(clients/client_models_autogen.py) are thin subclasses; autogen matches
+``model_client_cls`` by class name, so both names are kept.
+
+- ``create`` is what autogen calls. Agents replying from worker threads share
+  the transport's pooled sync client, so concurrent agents reuse connections.
+- ``acreate`` is the async equivalent over the pooled async client. autogen
+  never calls it (its async agents run ``create`` in a worker thread), so it
+  is for code that drives the client itself on an event loop::
+
+      client = OllamaModelClient(llm_config["config_list"][0])
+      response = await client.acreate({"messages": messages})
+      text = client.message_retrieval(response)[0]
+- With ``stream: True`` in the llm_config, the reply is streamed and printed
+  as it arrives (through autogen's IOStream when available), then returned
+  in the same shape as a non-streamed reply.
+- Every call's tokens, Ollama durations, wall-clock time and time to first
+  token are returned by ``get_usage`` and added to ``self.usage``; see
+  clients/usage.py for per-agent totals. ``cost`` uses the config's
+  ``price`` ([prompt, completion] per 1k tokens, default 0).
+- ``response_cache`` (a path, or True for the default) replays identical
+  requests from clients/response_cache.py, as a stream when one is asked for.
+"""
+
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+from clients.response_cache import cache_for, cache_key
+from clients.stream_decoder import StreamDecoder
+from clients.transport import transport_for
+from clients.usage import UsageTracker, call_record
+
+try:
+    from autogen.io.base import IOStream
+except ImportError:  # Older autogen without pluggable output
+    IOStream = None
+
+
+# Native chat endpoint: unlike /v1, it reports load and eval durations
+CHAT_PATH = "api/chat"
+
+
+def print_delta(delta: str):
+    if IOStream is not None:
+        IOStream.get_default().print(delta, end="", flush=True)
+    else:
+        print(delta, end="", flush=True)
+
+
+class OllamaModelClient:
+    def __init__(self, config, **kwargs):
+        self.base_url = config["base_url"]
+        self.transport = transport_for(config)
+        self.model_name = config["model"]
+        # [prompt, completion] price per 1k tokens, as in autogen's own config
+        self.price = config.get("price") or [0.0, 0.0]
+        self.usage = UsageTracker()
+        # Optional disk cache of replies ("response_cache": path or True)
+        self.cache = cache_for(
+            config.get("response_cache"),
+            config.get("response_cache_max_bytes", 512 * 1024 * 1024),
+        )
+        self.cache_seed = config.get("cache_seed")
+
+        self.authenticate()
+
+    def authenticate(self):
+        self.transport.authenticate()
+
+    def _payload(self, params) -> dict:
+        return {
+            "model": self.model_name,
+            "messages": params["messages"],
+            "stream": bool(params.get("stream")),
+            "options": {
+                "temperature": params.get("temperature", 0.7),
+                "num_predict": params.get("max_tokens", 256),
+                "top_p": params.get("top_p", 1.0),
+                "frequency_penalty": params.get("frequency_penalty", 0.0),
+                "presence_penalty": params.get("presence_penalty", 0.0),
+            },
+        }
+
+    def _response(self, content, finish_reason, usage, wall_s, ttft_s):
+        """Wrap a reply in a chat-completion shaped response and record its usage."""
+        # Create a custom response object with a cost attribute
+        response = SimpleNamespace()
+        response.data = {
+            "model": self.model_name,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": finish_reason,
+                }
+            ],
+            "usage": usage,
+        }
+        response.model = self.model_name
+        response.cost = self.cost(response)
+        record = call_record(usage, wall_s, ttft_s, response.cost)
+        response.usage = {**record, "model": self.model_name}
+        self.usage.record(record)
+        return response
+
+    @staticmethod
+    def _error(response):
+        return Exception(f"Error generating response: {response.text}")
+
+    def _cache_key(self, payload) -> Optional[str]:
+        if self.cache is None:
+            return None
+        params = {k: v for k, v in payload.items() if k not in ("model", "messages", "stream")}
+        return cache_key(self.model_name, payload["messages"], params, self.cache_seed)
+
+    def _replay(self, cached, stream, started):
+        """Answer from the response cache, streaming the stored chunks if asked to."""
+        ttft_s = None
+        if stream:
+            for chunk in cached["chunks"]:
+                if ttft_s is None:
+                    ttft_s = time.perf_counter() - started
+                print_delta(chunk)
+            print_delta("\n")
+        # Nothing was computed, so a hit records no tokens or server time
+        return self._response(
+            cached["content"],
+            cached["finish_reason"],
+            {},
+            time.perf_counter() - started,
+            ttft_s,
+        )
+
+    def _finish(self, key, decoder, started, ttft_s):
+        if key is not None:
+            self.cache.put(
+                key,
+                self.model_name,
+                decoder.text,
+                decoder.buffer.parts,
+                decoder.finish_reason,
+                decoder.usage,
+            )
+        return self._response(
+            decoder.text,
+            decoder.finish_reason,
+            decoder.usage or {},
+            time.perf_counter() - started,
+            ttft_s,
+        )
+
+    def create(self, params):
+        payload = self._payload(params)
+        started = time.perf_counter()
+        key = self._cache_key(payload)
+        cached = self.cache.get(key) if key is not None else None
+        if cached is not None:
+            return self._replay(cached, payload["stream"], started)
+
+        decoder = StreamDecoder()
+        ttft_s = None
+        if payload["stream"]:
+            with self.transport.stream("POST", CHAT_PATH, json=payload) as response_obj:
+                if response_obj.status_code != 200:
+                    response_obj.read()
+                    raise self._error(response_obj)
+                for delta in decoder.deltas(response_obj.iter_lines()):
+                    if ttft_s is None:
+                        ttft_s = time.perf_counter() - started
+                    print_delta(delta)
+            print_delta("\n")
+        else:
+            response_obj = self.transport.post(CHAT_PATH, json=payload)
+            if response_obj.status_code != 200:
+                raise self._error(response_obj)
+            decoder.feed(response_obj.text)
+        return self._finish(key, decoder, started, ttft_s)
+
+    async def acreate(self, params):
+        """Async create() over the transport's pooled async client.
+
+        Not called by autogen; await it directly (see the module docstring).
+        """
+        payload = self._payload(params)
+        started = time.perf_counter()
+        key = self._cache_key(payload)
+        cached = self.cache.get(key) if key is not None else None
+        if cached is not None:
+            return self._replay(cached, payload["stream"], started)
+
+        decoder = StreamDecoder()
+        ttft_s = None
+        if payload["stream"]:
+            async with self.transport.astream(
+                "POST", CHAT_PATH, json=payload
+            ) as response_obj:
+                if response_obj.status_code != 200:
+                    await response_obj.aread()
+                    raise self._error(response_obj)
+                async for delta in decoder.adeltas(response_obj.aiter_lines()):
+                    if ttft_s is None:
+                        ttft_s = time.perf_counter() - started
+                    print_delta(delta)
+            print_delta("\n")
+        else:
+            response_obj = await self.transport.apost(CHAT_PATH, json=payload)
+            if response_obj.status_code != 200:
+                raise self._error(response_obj)
+            decoder.feed(response_obj.text)
+        return self._finish(key, decoder, started, ttft_s)
+
+    def message_retrieval(self, response):
+        # Access the data attribute of the response
+        return [choice["message"]["content"] for choice in response.data["choices"]]
+
+    def cost(self, response) -> float:
+        usage = response.data["usage"]
+        prompt_price, completion_price = self.price
+        return (
+            usage.get("prompt_tokens", 0) * prompt_price
+            + usage.get("completion_tokens", 0) * completion_price
+        ) / 1000
+
+    @staticmethod
+    def get_usage(response):
+        # Token counts, cost and model for autogen's usage summary, plus timings
+        return response.usage
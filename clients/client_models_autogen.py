@@ -1,70 +1,20 @@
 import chromadb.utils.embedding_functions.ollama_embedding_function as ollama_embedding_function
-import requests
-from typing import Union, cast
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Union, cast
 from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
-import httpx
-from types import SimpleNamespace
-import requests
+import logging
+import time
 
+from clients.autogen_model_client import OllamaModelClient
+from clients.embedding_cache import EmbeddingCache, store_for
+from clients.transport import transport_for
+from embedding_format import accept_header, embeddings_from_response
 
-class OllamaLLMClient:
-    def __init__(self, config):
-        self.base_url = config["base_url"]
-        self.token = None
-        self.token_url = f"{self.base_url}/mw/generate-token"
-        self.token_password = config.get("token_password", "default_token_password")
-        self.headers = {"Content-Type": "application/json"}
-        self.model_name = config["model"]
+logger = logging.getLogger(__name__)
 
-        self.authenticate()
 
-    def authenticate(self):
-        payload = {"password": self.token_password}
-        response = requests.post(self.token_url, json=payload, headers=self.headers)
-        if response.status_code == 200:
-            self.token = response.json().get("token")
-            self.headers["Authorization"] = f"Bearer {self.token}"
-        else:
-            raise Exception(f"Authentication failed: {response.text}")
-
-    def create(self, params):
-        url = f"{self.base_url}/mw/protected/v1/chat/completions"
-        payload = {
-            "model": self.model_name,
-            "messages": params["messages"],
-            "temperature": params.get("temperature", 0.7),
-            "max_tokens": params.get("max_tokens", 256),
-            "top_p": params.get("top_p", 1.0),
-            "frequency_penalty": params.get("frequency_penalty", 0.0),
-            "presence_penalty": params.get("presence_penalty", 0.0),
-        }
-        response_obj = requests.post(url, json=payload, headers=self.headers)
-        if response_obj.status_code == 200:
-            response_data = response_obj.json()
-            # print("Got Content from Ollama:", response_data)
-
-            # Create a custom response object with a cost attribute
-            response = SimpleNamespace()
-            response.data = response_data
-            response.cost = self.cost(
-                response_data
-            )  # Calculate cost based on response data
-            return response
-        else:
-            raise Exception(f"Error generating response: {response_obj.text}")
-
-    def message_retrieval(self, response):
-        # Access the data attribute of the response
-        return [choice["message"]["content"] for choice in response.data["choices"]]
-
-    def cost(self, response) -> float:
-        # Calculate the cost based on the response
-        # Assuming you want to return a fixed cost for now
-        return 0  # Return the cost directly instead of trying to set it on the response
-
-    @staticmethod
-    def get_usage(content):
-        return {}
+class OllamaLLMClient(OllamaModelClient):
+    """autogen model client; see clients/autogen_model_client.py."""
 
 
 class OllamaEmbedClient(EmbeddingFunction):
@@ -75,53 +25,106 @@ class OllamaEmbedClient(EmbeddingFunction):
         Args:
             url (str): The URL of the Ollama Server.
             model_name (str): The name of the model to use for text embeddings. E.g. "nomic-embed-text" (see https://ollama.com/library for available models).
+
+        config["embedding_format"] selects the response encoding: "float32"
+        (default) or "float16" for packed vectors, or "json".
+
+        Documents are sent as multi-input requests of at most
+        config["embed_batch_size"] texts (default 64) and
+        config["embed_batch_chars"] characters (default 32768). How many
+        batches are in flight adapts to the server's latency and overload
+        responses (clients/adaptive_limit.py), up to config["max_inflight"]
+        (default 16); config["embed_concurrency"] caps it further.
+
+        Vectors are cached on disk (clients/embedding_cache.py), so only
+        texts not embedded before are sent. config["embedding_cache"] is the
+        cache directory, True for the default one, or False to disable it.
         """
         self._api_url = f"{url}"
         self._model_name = model_name
-        self._session = httpx.Client(timeout=100.0)
         self.base_url = config["base_url"]
-        self.token = None
-        self.token_url = f"{self.base_url}/mw/generate-token"
-        self.token_password = config.get("token_password", "default_token_password")
-        self.headers = {"Content-Type": "application/json"}
+        self.transport = transport_for(config)
         self.model_name = config["model"]
+        self.embedding_format = config.get("embedding_format", "float32")
+        self.batch_size = config.get("embed_batch_size", 64)
+        self.batch_chars = config.get("embed_batch_chars", 32768)
+        self.concurrency = config.get(
+            "embed_concurrency", self.transport.bulk_limit.max_limit
+        )
+        self.cache = EmbeddingCache(
+            store_for(config.get("embedding_cache", True)),
+            self.transport.url(self._api_url),
+            self._model_name,
+            self.embedding_format,
+        )
         self.authenticate()
 
     def authenticate(self):
-        payload = {"password": self.token_password}
-        response = requests.post(self.token_url, json=payload, headers=self.headers)
-        if response.status_code == 200:
-            self.token = response.json().get("token")
-            self.headers["Authorization"] = f"Bearer {self.token}"
-        else:
-            raise Exception(f"Authentication failed: {response.text}")
+        self.transport.authenticate()
 
     def __call__(self, input: Union[Documents, str]) -> Embeddings:
-
-        # Call Ollama Server API for each document
         texts = input if isinstance(input, list) else [input]
-        print(f"PRINTING TEMP FOR DEBUG {len(texts)}")
-        var = self._session.post(
+        found, missing = self.cache.lookup(texts)
+        batches = list(self._batches(missing))
+        fetched: dict = {}
+        started = time.perf_counter()
+
+        # The pooled sync client is thread-safe, so batches share its connections
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {
+                executor.submit(self._embed_batch, missing[start:end]): (start, end)
+                for start, end in batches
+            }
+            for future in as_completed(futures):
+                start, end = futures[future]
+                vectors = future.result()
+                self.cache.save(missing[start:end], vectors)
+                fetched.update(zip(missing[start:end], vectors))
+                elapsed = time.perf_counter() - started
+                logger.info(
+                    f"Embedded {len(fetched)}/{len(missing)} texts "
+                    f"({len(fetched) / elapsed if elapsed else 0:.1f} texts/s, "
+                    f"limit {self.transport.bulk_limit.limit:.1f})"
+                )
+
+        return cast(Embeddings, self.cache.fill(texts, found, fetched))
+
+    def _batches(self, texts: List[str]):
+        """(start, end) ranges bounded by batch_size texts and batch_chars characters."""
+        start = 0
+        chars = 0
+        for end, text in enumerate(texts):
+            if end > start and (
+                end - start >= self.batch_size or chars + len(text) > self.batch_chars
+            ):
+                yield start, end
+                start, chars = end, 0
+            chars += len(text)
+        if start < len(texts):
+            yield start, len(texts)
+
+    def _embed_batch(self, texts: List[str]) -> list:
+        response = self.transport.post(
             self._api_url,
-            json={"model": self._model_name, "input": texts[0]},
-            headers=self.headers,
+            json={"model": self._model_name, "input": texts},
+            headers=self._embed_headers(),
+            bulk=len(texts),
         )
+        if response.status_code != 200:
+            raise Exception(f"Error generating embeddings: {response.text}")
+        embeddings = self._parse_embeddings(response)
+        if len(embeddings) != len(texts):
+            raise Exception(
+                f"Expected {len(texts)} embeddings, got {len(embeddings)}"
+            )
+        return embeddings
+
+    def _embed_headers(self) -> dict:
+        return {"Accept": accept_header(self.embedding_format)}
 
-        var = var.json()["embeddings"]
-        print(f"SESSION RESPONSE {var[0]}")
-        embeddings = [
-            self._session.post(
-                self._api_url,
-                json={"model": self._model_name, "input": text},
-                headers=self.headers,
-            ).json()
-            for text in texts
-        ]
-        return cast(
-            Embeddings,
-            [
-                embedding["embeddings"][0]
-                for embedding in embeddings
-                if "embeddings" in embedding
-            ],
+    @staticmethod
+    def _parse_embeddings(response) -> list:
+        # Packed float32/float16 bodies when the server supports them, JSON otherwise
+        return embeddings_from_response(
+            response.headers.get("content-type"), response.content
         )
@@ -1,16 +1,31 @@
-from pydantic import Field, BaseModel, ConfigDict
+from pydantic import Field, BaseModel, ConfigDict, PrivateAttr
 from llama_index.core.llms import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
     CustomLLM,
     CompletionResponse,
+    CompletionResponseAsyncGen,
     CompletionResponseGen,
     LLMMetadata,
+    MessageRole,
 )
 from llama_index.core.embeddings import BaseEmbedding
-from llama_index.core.llms.callbacks import llm_completion_callback
-from typing import List, Any, Optional
-import requests
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Any, Optional, Sequence, Union
+import asyncio
 import logging
 
+from clients.embedding_cache import EmbeddingCache, store_for
+from clients.response_cache import ResponseCache, cache_for, cache_key
+from clients.prompt_budget import DEFAULT_CALIBRATION_PATH, PromptTrimmer, estimator_for
+from clients.stream_decoder import StreamDecoder
+from clients.transport import OllamaTransport, transport_for
+from embedding_format import accept_header, embeddings_from_response
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -22,36 +37,47 @@ class OurLLM(CustomLLM):
     base_url: str = Field(default=None)
     token_url: str = Field(default=None)
     token_password: str = Field(default="default_token_password")
-    headers: dict = Field(default_factory=lambda: {"Content-Type": "application/json"})
     llm_model_name: str = Field(default=None)
     context_window: int = Field(default=3900)
     num_output: int = Field(default=256)
-    token: Optional[str] = Field(default=None)
+    max_concurrency: int = Field(default=8)
+    trim_policy: Optional[str] = Field(default="drop_oldest")
 
     model_config = ConfigDict(protected_namespaces=())
 
+    _transport: OllamaTransport = PrivateAttr(default=None)
+    _last_usage: Optional[dict] = PrivateAttr(default=None)
+    _semaphore: Optional[asyncio.Semaphore] = PrivateAttr(default=None)
+    _semaphore_loop: Any = PrivateAttr(default=None)
+    _trimmer: Optional[PromptTrimmer] = PrivateAttr(default=None)
+    _cache: Optional[ResponseCache] = PrivateAttr(default=None)
+
     def __init__(self, config: dict):
         super().__init__()
         self.base_url = config["base_url"]
         self.token_url = f"{self.base_url}/mw/generate-token"
         self.token_password = config.get("token_password", "default_token_password")
-        self.headers = {"Content-Type": "application/json"}
         self.llm_model_name = config["model"]
         self.context_window = config.get("context_window", 3900)
         self.num_output = config.get("num_output", 256)
+        self.max_concurrency = config.get("max_concurrency", 8)
+        self.trim_policy = config.get("trim_policy", "drop_oldest")
+        if self.trim_policy:
+            estimator = estimator_for(
+                config.get("token_calibration_path", DEFAULT_CALIBRATION_PATH)
+            )
+            self._trimmer = PromptTrimmer(estimator, self.trim_policy)
+        # Optional disk cache of replies ("response_cache": path or True)
+        self._cache = cache_for(
+            config.get("response_cache"),
+            config.get("response_cache_max_bytes", 512 * 1024 * 1024),
+        )
+        self._transport = transport_for(config)
         self.authenticate()
 
     def authenticate(self):
         logger.info("Authenticating LLM...")
-        payload = {"password": self.token_password}
-        response = requests.post(self.token_url, json=payload, headers=self.headers)
-        if response.status_code == 200:
-            self.token = response.json().get("token")
-            self.headers["Authorization"] = f"Bearer {self.token}"
-            logger.info("Authentication successful.")
-        else:
-            logger.error(f"Authentication failed: {response.text}")
-            raise Exception(f"Authentication failed: {response.text}")
+        self._transport.authenticate()
 
     @property
     def metadata(self) -> LLMMetadata:
@@ -61,50 +87,251 @@ class OurLLM(CustomLLM):
             model_name=self.llm_model_name,
         )
 
-    @llm_completion_callback()
-    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
-        logger.info(f"Sending completion request for prompt: {prompt[:50]}...")
-        url = f"{self.base_url}/mw/protected/v1/chat/completions"
+    def _fit(self, messages: List[dict]) -> List[dict]:
+        """Trim messages to leave num_output tokens of the context window for the reply."""
+        if self._trimmer is None:
+            return messages
+        budget = self.context_window - self.num_output
+        return self._trimmer.fit(self.llm_model_name, messages, budget)
+
+    def _observe(self, payload: dict, usage: Optional[dict]):
+        """Calibrate the token estimator against the server's prompt token count."""
+        if self._trimmer is not None and usage and usage.get("prompt_tokens"):
+            self._trimmer.estimator.observe(
+                self.llm_model_name, payload["messages"], usage["prompt_tokens"]
+            )
+
+    @property
+    def trim_stats(self) -> Optional[dict]:
+        """Prompt trimming counters, including the tokens saved."""
+        return self._trimmer.stats() if self._trimmer is not None else None
+
+    def _payload(self, messages: List[dict], stream: bool) -> dict:
         payload = {
             "model": self.llm_model_name,
-            "messages": [{"role": "user", "content": prompt}],
+            "messages": self._fit(messages),
             "temperature": 0.7,
             "max_tokens": self.num_output,
-            "stream": False,
+            "stream": stream,
+        }
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    @staticmethod
+    def _prompt_messages(prompt: str) -> List[dict]:
+        return [{"role": "user", "content": prompt}]
+
+    @staticmethod
+    def _chat_messages(messages: Sequence[ChatMessage]) -> List[dict]:
+        return [
+            {"role": message.role.value, "content": message.content or ""}
+            for message in messages
+        ]
+
+    def _limiter(self) -> asyncio.Semaphore:
+        """Caps concurrent async requests from this LLM (one cap per event loop)."""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    def _lookup(self, payload: dict):
+        """(cache key, cached entry) for a payload; both None without a cache."""
+        if self._cache is None:
+            return None, None
+        params = {
+            k: v
+            for k, v in payload.items()
+            if k not in ("model", "messages", "stream", "stream_options")
         }
-        response = requests.post(url, json=payload, headers=self.headers)
+        key = cache_key(self.llm_model_name, payload["messages"], params)
+        return key, self._cache.get(key)
+
+    def _store(self, key: Optional[str], decoder: StreamDecoder):
+        if key is not None:
+            self._cache.put(
+                key,
+                self.llm_model_name,
+                decoder.text,
+                decoder.buffer.parts,
+                decoder.finish_reason,
+                decoder.usage,
+            )
+
+    def _completion(self, payload: dict, response, key: Optional[str] = None) -> dict:
+        """The decoded completion, parsed once, with its usage observed and cached."""
         if response.status_code == 200:
-            content = response.json()["choices"][0]["message"]["content"]
             logger.info("Completion request successful.")
-            return CompletionResponse(text=content)
-        else:
-            logger.error(f"Error generating response: {response.text}")
-            raise Exception(f"Error generating response: {response.text}")
+            data = response.json()
+            self._observe(payload, data.get("usage"))
+            if key is not None:
+                self._cache.put(
+                    key,
+                    self.llm_model_name,
+                    data["choices"][0]["message"]["content"],
+                    finish_reason=data["choices"][0].get("finish_reason"),
+                    usage=data.get("usage"),
+                )
+            return data
+        logger.error(f"Error generating response: {response.text}")
+        raise Exception(f"Error generating response: {response.text}")
+
+    def _message_content(self, payload: dict, response, key: Optional[str] = None) -> str:
+        return self._completion(payload, response, key)["choices"][0]["message"]["content"]
+
+    def _final_response(self, decoder: StreamDecoder) -> CompletionResponse:
+        # Usage arrives after the last token, so it gets a frame of its own
+        self._last_usage = decoder.usage
+        return CompletionResponse(
+            text=decoder.text,
+            delta="",
+            additional_kwargs={
+                "usage": decoder.usage,
+                "finish_reason": decoder.finish_reason,
+            },
+        )
+
+    @property
+    def last_usage(self) -> Optional[dict]:
+        """Token usage reported at the end of the most recent stream."""
+        return self._last_usage
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        logger.info(f"Sending completion request for prompt: {prompt[:50]}...")
+        payload = self._payload(self._prompt_messages(prompt), stream=False)
+        key, cached = self._lookup(payload)
+        if cached is not None:
+            return CompletionResponse(text=cached["content"])
+        response = self._transport.post("v1/chat/completions", json=payload)
+        return CompletionResponse(text=self._message_content(payload, response, key))
 
     @llm_completion_callback()
     def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
         logger.info(f"Streaming completion request for prompt: {prompt[:50]}...")
-        url = f"{self.base_url}/mw/protected/v1/chat/completions"
-        payload = {
-            "model": self.llm_model_name,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.7,
-            "max_tokens": self.num_output,
-            "stream": True,
-        }
-        with requests.post(
-            url, json=payload, headers=self.headers, stream=True
+        decoder = StreamDecoder()
+        payload = self._payload(self._prompt_messages(prompt), stream=True)
+        key, cached = self._lookup(payload)
+        if cached is not None:
+            for delta in decoder.replay(
+                cached["chunks"], cached["finish_reason"], cached["usage"]
+            ):
+                yield CompletionResponse(text=decoder.text, delta=delta)
+            yield self._final_response(decoder)
+            return
+        with self._transport.stream(
+            "POST", "v1/chat/completions", json=payload
         ) as response:
-            if response.status_code == 200:
-                response_text = ""
-                for line in response.iter_lines():
-                    if line:
-                        token = line.decode("utf-8")
-                        response_text += token
-                        yield CompletionResponse(text=response_text, delta=token)
-            else:
+            if response.status_code != 200:
+                response.read()
                 logger.error(f"Error streaming response: {response.text}")
                 raise Exception(f"Error streaming response: {response.text}")
+            for delta in decoder.deltas(response.iter_lines()):
+                yield CompletionResponse(text=decoder.text, delta=delta)
+        self._observe(payload, decoder.usage)
+        self._store(key, decoder)
+        yield self._final_response(decoder)
+
+    async def _astream(self, messages: List[dict]):
+        """(decoder, delta) pairs from a streamed chat completion, then (decoder, None)."""
+        decoder = StreamDecoder()
+        payload = self._payload(messages, stream=True)
+        key, cached = self._lookup(payload)
+        if cached is not None:
+            for delta in decoder.replay(
+                cached["chunks"], cached["finish_reason"], cached["usage"]
+            ):
+                yield decoder, delta
+            yield decoder, None
+            return
+        async with self._limiter():
+            async with self._transport.astream(
+                "POST", "v1/chat/completions", json=payload
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    logger.error(f"Error streaming response: {response.text}")
+                    raise Exception(f"Error streaming response: {response.text}")
+                async for delta in decoder.adeltas(response.aiter_lines()):
+                    yield decoder, delta
+        self._observe(payload, decoder.usage)
+        self._store(key, decoder)
+        yield decoder, None
+
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        logger.info(f"Sending completion request for prompt: {prompt[:50]}...")
+        payload = self._payload(self._prompt_messages(prompt), stream=False)
+        key, cached = self._lookup(payload)
+        if cached is not None:
+            return CompletionResponse(text=cached["content"])
+        async with self._limiter():
+            response = await self._transport.apost("v1/chat/completions", json=payload)
+        return CompletionResponse(text=self._message_content(payload, response, key))
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        logger.info(f"Streaming completion request for prompt: {prompt[:50]}...")
+
+        async def gen() -> CompletionResponseAsyncGen:
+            async for decoder, delta in self._astream(self._prompt_messages(prompt)):
+                if delta is None:
+                    yield self._final_response(decoder)
+                else:
+                    yield CompletionResponse(text=decoder.text, delta=delta)
+
+        return gen()
+
+    @llm_chat_callback()
+    async def achat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponse:
+        payload = self._payload(self._chat_messages(messages), stream=False)
+        key, cached = self._lookup(payload)
+        if cached is not None:
+            return ChatResponse(
+                message=ChatMessage(
+                    role=MessageRole.ASSISTANT, content=cached["content"]
+                )
+            )
+        async with self._limiter():
+            response = await self._transport.apost("v1/chat/completions", json=payload)
+        data = self._completion(payload, response, key)
+        return ChatResponse(
+            message=ChatMessage(
+                role=MessageRole.ASSISTANT,
+                content=data["choices"][0]["message"]["content"],
+            ),
+            raw=data,
+        )
+
+    @llm_chat_callback()
+    async def astream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseAsyncGen:
+        async def gen() -> ChatResponseAsyncGen:
+            async for decoder, delta in self._astream(self._chat_messages(messages)):
+                if delta is None:
+                    self._last_usage = decoder.usage
+                yield ChatResponse(
+                    message=ChatMessage(
+                        role=MessageRole.ASSISTANT, content=decoder.text
+                    ),
+                    delta=delta or "",
+                    additional_kwargs=(
+                        {"usage": decoder.usage, "finish_reason": decoder.finish_reason}
+                        if delta is None
+                        else {}
+                    ),
+                )
+
+        return gen()
 
 
 # Define Custom Embeddings
@@ -112,39 +339,77 @@ class OllamaEmbeddings(BaseEmbedding, BaseModel):
     base_url: str = Field(..., description="The base URL for the Ollama API")
     token_password: str = Field(..., description="Password to generate API token")
     embed_model: str = Field(..., description="Embedding model name")
-    token: str = Field(default=None, description="Generated API token")
+    embedding_format: str = Field(
+        default="float32",
+        description='Response encoding: "float32" or "float16" (packed) or "json"',
+    )
+    request_batch_size: int = Field(
+        default=64, description="Most texts sent in one /api/embed request"
+    )
+    max_concurrency: int = Field(
+        default=16,
+        description="Most /api/embed requests in flight at once; within it the "
+        "transport's adaptive limit follows the server's latency and overload",
+    )
+    embedding_cache: Union[bool, str] = Field(
+        default=True,
+        description="On-disk vector cache directory, True for the default one, or False",
+    )
+
+    _transport: OllamaTransport = PrivateAttr(default=None)
+    _cache: EmbeddingCache = PrivateAttr(default=None)
+    _semaphore: Optional[asyncio.Semaphore] = PrivateAttr(default=None)
+    _semaphore_loop: Any = PrivateAttr(default=None)
 
     def __init__(self, **kwargs):
+        # LlamaIndex hands _get_text_embeddings this many texts at a time
+        kwargs.setdefault("embed_batch_size", 64)
         super().__init__(**kwargs)
-        self.token = self._generate_token()
-
-    def _generate_token(self) -> str:
+        self._transport = transport_for(
+            {"base_url": self.base_url, "token_password": self.token_password}
+        )
+        self._cache = EmbeddingCache(
+            store_for(self.embedding_cache),
+            self._transport.url("api/embed"),
+            self.embed_model,
+            self.embedding_format,
+        )
         logger.info("Generating API token...")
-        url = f"{self.base_url}/mw/generate-token"
-        payload = {"password": self.token_password}
-        response = requests.post(url, json=payload)
-        if response.status_code == 200:
-            logger.info("Token generation successful.")
-            return response.json().get("token")
-        else:
-            logger.error(f"Error generating token: {response.text}")
-            raise Exception(f"Error generating token: {response.text}")
+        self._transport.authenticate()
 
     def _get_headers(self) -> dict:
-        return {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
-        }
+        return {"Accept": accept_header(self.embedding_format)}
+
+    def _parse_response(self, response, count: int) -> List[List[float]]:
+        response.raise_for_status()
+        embeddings = embeddings_from_response(
+            response.headers.get("content-type"), response.content
+        )
+        if len(embeddings) != count:
+            raise Exception(f"Expected {count} embeddings, got {len(embeddings)}")
+        return embeddings
+
+    def _batches(self, texts: List[str]) -> List[List[str]]:
+        size = self.request_batch_size
+        return [texts[i : i + size] for i in range(0, len(texts), size)]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        payload = {"model": self.embed_model, "input": texts}
+        response = self._transport.post(
+            "api/embed", json=payload, headers=self._get_headers(), bulk=len(texts)
+        )
+        return self._parse_response(response, len(texts))
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        payload = {"model": self.embed_model, "input": texts}
+        response = await self._transport.apost(
+            "api/embed", json=payload, headers=self._get_headers(), bulk=len(texts)
+        )
+        return self._parse_response(response, len(texts))
 
     def _get_embedding(self, text: str) -> List[float]:
         logger.info(f"Fetching embedding for text: {text[:50]}...")
-        url = f"{self.base_url}/mw/protected/api/embed"
-        payload = {"model": self.embed_model, "input": text}
-        response = requests.post(url, json=payload, headers=self._get_headers())
-        response.raise_for_status()
-        embeddings = response.json().get("embeddings", [[]])
-        logger.info("Embedding fetched successfully.")
-        return embeddings[0] if embeddings else []
+        return self._get_text_embeddings([text])[0]
 
     def _get_query_embedding(self, query: str) -> List[float]:
         return self._get_embedding(query)
@@ -153,10 +418,103 @@ class OllamaEmbeddings(BaseEmbedding, BaseModel):
         return self._get_embedding(text)
 
     def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
-        return [self._get_embedding(text) for text in texts]
+        # Only texts missing from the on-disk cache are sent
+        found, missing = self._cache.lookup(texts)
+        batches = self._batches(missing)
+        if len(batches) <= 1:
+            results = [self._embed_batch(missing)] if missing else []
+        else:
+            # The pooled sync client is thread-safe, so batches share its connections
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                results = list(executor.map(self._embed_batch, batches))
+            logger.info(f"Fetched {len(missing)} embeddings in {len(batches)} requests.")
+        fetched = {}
+        for batch, vectors in zip(batches, results):
+            self._cache.save(batch, vectors)
+            fetched.update(zip(batch, vectors))
+        return self._cache.fill(texts, found, fetched)
 
     async def _aget_query_embedding(self, query: str) -> List[float]:
-        return self._get_query_embedding(query)
+        return (await self._aget_text_embeddings([query]))[0]
 
     async def _aget_text_embedding(self, text: str) -> List[float]:
-        return self._get_text_embedding(text)
+        return (await self._aget_text_embeddings([text]))[0]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # One cap across concurrent calls (e.g. ingestion with num_workers) per loop
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+
+        found, missing = self._cache.lookup(texts)
+        fetched = {}
+
+        async def bounded(batch: List[str]):
+            async with self._semaphore:
+                vectors = await self._aembed_batch(batch)
+            self._cache.save(batch, vectors)
+            fetched.update(zip(batch, vectors))
+
+        await asyncio.gather(*(bounded(b) for b in self._batches(missing)))
+        return self._cache.fill(texts, found, fetched)
+
+
+# Rerank retrieved nodes server-side in one request
+class OllamaRerank(BaseNodePostprocessor):
+    base_url: str = Field(..., description="The base URL for the Ollama API")
+    token_password: str = Field(..., description="Password to generate API token")
+    embed_model: str = Field(..., description="Embedding model used for scoring")
+    top_n: Optional[int] = Field(default=None, description="Nodes to keep (all if None)")
+
+    _transport: OllamaTransport = PrivateAttr(default=None)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._transport = transport_for(
+            {"base_url": self.base_url, "token_password": self.token_password}
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "OllamaRerank"
+
+    def _payload(self, nodes: List[NodeWithScore], query_bundle: QueryBundle) -> dict:
+        return {
+            "model": self.embed_model,
+            "query": query_bundle.query_str,
+            "documents": [n.node.get_content(metadata_mode=MetadataMode.EMBED) for n in nodes],
+            "top_n": self.top_n or len(nodes),
+        }
+
+    @staticmethod
+    def _ranked(nodes: List[NodeWithScore], response) -> List[NodeWithScore]:
+        response.raise_for_status()
+        return [
+            NodeWithScore(node=nodes[r["index"]].node, score=r["score"])
+            for r in response.json()["results"]
+        ]
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None or not nodes:
+            return nodes
+        response = self._transport.post(
+            "rerank", json=self._payload(nodes, query_bundle), idempotent=True
+        )
+        return self._ranked(nodes, response)
+
+    async def _apostprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None or not nodes:
+            return nodes
+        response = await self._transport.apost(
+            "rerank", json=self._payload(nodes, query_bundle), idempotent=True
+        )
+        return self._ranked(nodes, response)
@@ -0,0 +1,93 @@
+"""
+Client-side persistent embedding cache.
+
+Wraps ``embedding_store.EmbeddingStore``, the memory-mapped float32 store the
+middleware keeps, so the embedding adapters look every text up locally and
+send only the misses over the network. Re-ingesting unchanged documents then
+costs a hash and an mmap read per chunk.
+
+Vectors are keyed by (server, model, text): the same model name on two
+servers may be a different build or quantisation. Packed float16 responses
+are lossy, so they are kept in a namespace of their own. Each embedded request batch is
+written with one append, so an interrupted ingestion keeps what it fetched.
+"""
+
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from embedding_store import EmbeddingStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBED_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "ollama_server", "embeddings"
+)
+
+
+_stores: Dict[str, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+
+
+def store_for(setting) -> Optional[EmbeddingStore]:
+    """Shared store for a client config value: a directory, True for the default, or falsy."""
+    if not setting:
+        return None
+    directory = DEFAULT_EMBED_CACHE_DIR if setting is True else setting
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = EmbeddingStore(directory)
+    return _stores[directory]
+
+
+class EmbeddingCache:
+    """Splits texts into cached vectors and misses, and stores fetched misses."""
+
+    def __init__(
+        self,
+        store: Optional[EmbeddingStore],
+        server: str,
+        model: str,
+        embedding_format: str,
+    ):
+        """server is the embed endpoint URL the vectors come from."""
+        self.store = store
+        self.namespace = f"{server.rstrip('/')}|{model}"
+        if embedding_format == "float16":
+            self.namespace += "|float16"
+
+    def lookup(self, texts: Sequence[str]) -> Tuple[List[Optional[list]], List[str]]:
+        """Cached vector per text (None for a miss) and the distinct texts to fetch."""
+        found: List[Optional[list]] = [None] * len(texts)
+        if self.store is not None:
+            try:
+                views = self.store.get_many(self.namespace, texts)
+                found = [view.tolist() if view is not None else None for view in views]
+            except (OSError, ValueError) as e:
+                logger.error(f"Embedding cache read failed: {e}")
+        missing = list(dict.fromkeys(t for t, v in zip(texts, found) if v is None))
+        if self.store is not None and texts:
+            logger.debug(
+                f"Embedding cache: {len(texts) - len(missing)}/{len(texts)} texts cached"
+            )
+        return found, missing
+
+    def save(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """Store one fetched batch."""
+        if self.store is None:
+            return
+        try:
+            self.store.put_many(self.namespace, texts, vectors)
+        except (OSError, ValueError) as e:
+            logger.error(f"Embedding cache write failed: {e}")
+
+    @staticmethod
+    def fill(
+        texts: Sequence[str], found: List[Optional[list]], fetched: Dict[str, list]
+    ) -> List[list]:
+        """Vectors in input order, taking misses from fetched."""
+        return [fetched[t] if v is None else v for t, v in zip(texts, found)]
+
+    def stats(self) -> Optional[dict]:
+        return self.store.stats() if self.store is not None else None
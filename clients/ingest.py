@@ -0,0 +1,372 @@
+"""
+Streaming document ingestion: chunk -> dedupe -> batch-embed -> sink.
+
+``IngestPipeline.run`` pulls documents from any iterable (a generator over
+files works), so memory stays bounded by the batches in flight however
+large the corpus is:
+
+1. documents are split into overlapping chunks at paragraph, line, sentence
+   or word boundaries
+2. chunks whose text was already ingested (or is in flight) are skipped,
+   matched by SHA-256 of the text
+3. new chunks are grouped into batches and embedded with at most
+   ``max_inflight`` batches outstanding
+4. vectors are written to a sink: ``ChromaSink`` for a Chroma collection or
+   ``MmapSink`` for a flat float32 file, or any object with ``write``
+
+Ingested chunk hashes are recorded in a SQLite state file after the sink
+accepts them, so an interrupted run resumes where it stopped when started
+again with the same ``state_path``. Delivery is at-least-once: a batch
+written just before a crash is written again (Chroma upserts by id, so that
+is harmless there).
+
+``embed`` is any callable from a list of texts to a list of vectors, such as
+``OllamaEmbedClient`` or ``OllamaEmbeddings.get_text_embedding_batch``.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Boundaries a chunk may end at, best first
+BOUNDARIES = ("\n\n", "\n", ". ", " ")
+
+
+class Chunk(NamedTuple):
+    id: str
+    doc_id: str
+    index: int
+    text: str
+    hash: str
+    metadata: dict
+
+
+def split_text(text: str, size: int = 1500, overlap: int = 200) -> Iterator[str]:
+    """Chunks of at most size characters, overlapping by about overlap characters."""
+    text = text.strip()
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            # Prefer the strongest boundary in the second half of the window
+            for boundary in BOUNDARIES:
+                cut = text.rfind(boundary, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(boundary)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            yield chunk
+        if end >= len(text):
+            break
+        # Start the next chunk on a word boundary inside the overlap
+        next_start = max(start + 1, end - overlap)
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 and overlap else next_start
+
+
+class StageStats:
+    """Items processed and seconds spent in one pipeline stage."""
+
+    def __init__(self):
+        self.items = 0
+        self.seconds = 0.0
+
+    def add(self, items: int, seconds: float):
+        self.items += items
+        self.seconds += seconds
+
+    def summary(self) -> dict:
+        return {
+            "items": self.items,
+            "seconds": round(self.seconds, 3),
+            "items_per_s": round(self.items / self.seconds, 1) if self.seconds else None,
+        }
+
+
+class IngestState:
+    """SQLite record of ingested chunk hashes, for dedupe and resume."""
+
+    def __init__(self, path: Optional[str] = None):
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(
+            path or ":memory:", isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, id TEXT NOT NULL)"
+        )
+
+    def seen(self, chunk_hash: str) -> bool:
+        row = self.connection.execute(
+            "SELECT 1 FROM chunks WHERE hash = ?", (chunk_hash,)
+        ).fetchone()
+        return row is not None
+
+    def mark(self, chunks: List[Chunk]):
+        self.connection.execute("BEGIN")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO chunks VALUES (?, ?)", [(c.hash, c.id) for c in chunks]
+        )
+        self.connection.execute("COMMIT")
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class ChromaSink:
+    """Upserts chunks into a Chroma collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def write(self, chunks: List[Chunk], vectors: List[List[float]]):
+        self.collection.upsert(
+            ids=[c.id for c in chunks],
+            embeddings=[list(v) for v in vectors],
+            documents=[c.text for c in chunks],
+            metadatas=[{"doc_id": c.doc_id, "chunk": c.index, **c.metadata} for c in chunks],
+        )
+
+
+class MmapSink:
+    """Appends vectors to ``<path>.f32`` (float32 rows) and chunks to ``<path>.jsonl``.
+
+    Row i of the vector file belongs to line i of the JSON lines file, so the
+    vectors can be memory-mapped with numpy.memmap or mmap + memoryview.cast.
+    Rows or lines left over from an interrupted write are cut off on reopen.
+    """
+
+    def __init__(self, path: str):
+        self.vectors_path = f"{path}.f32"
+        self.chunks_path = f"{path}.jsonl"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.dim = 0
+        self.rows = self._committed_rows()
+        self._vectors = open(self.vectors_path, "ab")
+        self._chunks = open(self.chunks_path, "a", encoding="utf-8")
+
+    def _committed_rows(self) -> int:
+        """Count complete chunk lines, dropping a torn last line."""
+        if not os.path.exists(self.chunks_path):
+            return 0
+        rows = 0
+        complete = 0
+        with open(self.chunks_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                rows += 1
+                complete += len(line)
+        if complete != os.path.getsize(self.chunks_path):
+            os.truncate(self.chunks_path, complete)
+        return rows
+
+    def write(self, chunks: List[Chunk], vectors: List[List[float]]):
+        packed = array("f")
+        for vector in vectors:
+            if self.dim and len(vector) != self.dim:
+                raise ValueError(f"Embedding dimension {len(vector)} does not match {self.dim}")
+            if not self.dim:
+                self.dim = len(vector)
+                # Vector rows beyond the committed lines belong to an interrupted write
+                committed = self.rows * self.dim * 4
+                if os.path.getsize(self.vectors_path) > committed:
+                    self._vectors.truncate(committed)
+            packed.extend(vector)
+        # Vectors first: a chunk line is only written once its row is on disk
+        self._vectors.write(packed.tobytes())
+        self._vectors.flush()
+        self._chunks.writelines(
+            json.dumps(
+                {
+                    "id": c.id,
+                    "doc_id": c.doc_id,
+                    "chunk": c.index,
+                    "hash": c.hash,
+                    "metadata": c.metadata,
+                }
+            )
+            + "\n"
+            for c in chunks
+        )
+        self._chunks.flush()
+        self.rows += len(chunks)
+
+    def close(self):
+        self._vectors.close()
+        self._chunks.close()
+
+
+Document = Union[str, dict]
+
+
+class IngestPipeline:
+    """Streams documents through chunking, dedupe, batched embedding and a sink."""
+
+    def __init__(
+        self,
+        embed: Callable[[List[str]], List[List[float]]],
+        sink,
+        state_path: Optional[str] = None,
+        chunk_chars: int = 1500,
+        chunk_overlap: int = 200,
+        batch_size: int = 64,
+        max_inflight: int = 4,
+        log_every: int = 20,
+    ):
+        self.embed = embed
+        self.sink = sink
+        self.state = IngestState(state_path)
+        self.chunk_chars = chunk_chars
+        self.chunk_overlap = chunk_overlap
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+        self.log_every = log_every
+        self.stats: Dict[str, StageStats] = {
+            stage: StageStats() for stage in ("read", "chunk", "dedupe", "embed", "sink")
+        }
+        self.skipped = 0
+        self._pending = set()
+
+    # -- stages ------------------------------------------------------------
+
+    def _documents(self, documents: Iterable[Document]) -> Iterator[dict]:
+        iterator = iter(documents)
+        while True:
+            started = time.perf_counter()
+            try:
+                document = next(iterator)
+            except StopIteration:
+                return
+            if isinstance(document, str):
+                document = {"text": document}
+            if "id" not in document:
+                document = {
+                    **document,
+                    "id": hashlib.sha256(document["text"].encode("utf-8")).hexdigest()[:16],
+                }
+            self.stats["read"].add(1, time.perf_counter() - started)
+            yield document
+
+    def _chunks(self, documents: Iterable[dict]) -> Iterator[Chunk]:
+        for document in documents:
+            started = time.perf_counter()
+            chunks = []
+            for index, text in enumerate(
+                split_text(document["text"], self.chunk_chars, self.chunk_overlap)
+            ):
+                chunks.append(
+                    Chunk(
+                        id=f"{document['id']}:{index}",
+                        doc_id=str(document["id"]),
+                        index=index,
+                        text=text,
+                        hash=hashlib.sha256(text.encode("utf-8")).hexdigest(),
+                        metadata=document.get("metadata") or {},
+                    )
+                )
+            self.stats["chunk"].add(len(chunks), time.perf_counter() - started)
+            yield from chunks
+
+    def _new_chunks(self, chunks: Iterable[Chunk]) -> Iterator[Chunk]:
+        for chunk in chunks:
+            started = time.perf_counter()
+            duplicate = chunk.hash in self._pending or self.state.seen(chunk.hash)
+            self.stats["dedupe"].add(1, time.perf_counter() - started)
+            if duplicate:
+                self.skipped += 1
+                continue
+            self._pending.add(chunk.hash)
+            yield chunk
+
+    def _batches(self, chunks: Iterable[Chunk]) -> Iterator[List[Chunk]]:
+        batch = []
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _embedded(self, batches: Iterable[List[Chunk]]):
+        """(batch, vectors) in input order, with at most max_inflight batches embedding."""
+        with ThreadPoolExecutor(max_workers=self.max_inflight) as executor:
+            inflight = deque()
+            for batch in batches:
+                inflight.append((batch, executor.submit(self._embed_batch, batch)))
+                if len(inflight) >= self.max_inflight:
+                    yield self._collect(*inflight.popleft())
+            while inflight:
+                yield self._collect(*inflight.popleft())
+
+    def _embed_batch(self, batch: List[Chunk]):
+        started = time.perf_counter()
+        vectors = self.embed([c.text for c in batch])
+        if len(vectors) != len(batch):
+            raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+        return vectors, time.perf_counter() - started
+
+    def _collect(self, batch: List[Chunk], future):
+        vectors, seconds = future.result()
+        self.stats["embed"].add(len(batch), seconds)
+        return batch, vectors
+
+    # -- run ---------------------------------------------------------------
+
+    def run(self, documents: Iterable[Document]) -> dict:
+        """Ingest documents and return per-stage statistics."""
+        started = time.perf_counter()
+        written = 0
+        stream = self._embedded(
+            self._batches(self._new_chunks(self._chunks(self._documents(documents))))
+        )
+        try:
+            for count, (batch, vectors) in enumerate(stream, 1):
+                sink_started = time.perf_counter()
+                self.sink.write(batch, vectors)
+                self.state.mark(batch)
+                self.stats["sink"].add(len(batch), time.perf_counter() - sink_started)
+                self._pending.difference_update(c.hash for c in batch)
+                written += len(batch)
+                if count % self.log_every == 0:
+                    elapsed = time.perf_counter() - started
+                    logger.info(
+                        f"Ingested {written} chunks from {self.stats['read'].items} documents "
+                        f"({written / elapsed:.1f} chunks/s, {self.skipped} skipped)"
+                    )
+        finally:
+            # Chunks of a batch that failed to embed or write (and of batches still
+            # in flight) were never marked, so a later run must not skip them
+            stream.close()
+            self._pending.clear()
+
+        elapsed = time.perf_counter() - started
+        summary = {
+            "documents": self.stats["read"].items,
+            "chunks": self.stats["chunk"].items,
+            "written": written,
+            "skipped": self.skipped,
+            "seconds": round(elapsed, 3),
+            "stages": {name: stage.summary() for name, stage in self.stats.items()},
+        }
+        logger.info(f"Ingestion finished: {summary}")
+        return summary
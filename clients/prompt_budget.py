@@ -0,0 +1,240 @@
+"""
+Keeps prompts inside a model's context window.
+
+``TokenEstimator`` counts tokens from character length using a per-model
+characters-per-token ratio. The ratio starts at a generic 4.0 and is
+calibrated from the ``prompt_tokens`` the server reports. Calibrations are
+cached in a small JSON file, so later processes start out calibrated.
+
+``PromptTrimmer`` fits a chat history into a token budget before it is sent.
+System messages and the latest message are always kept. Other messages are
+dropped according to the policy:
+
+- ``drop_oldest``: drop the oldest turns first
+- ``drop_middle``: keep the first turn (usually the task) and drop the turns
+  after it, oldest first
+
+Dropped turns are replaced by a one-line note. If what is left is still too
+long, the middle of the longest messages is cut out; system messages and the
+last user message are never cut.
+"""
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHARS_PER_TOKEN = 4.0
+
+# Tokens of chat-template framing per message and for the reply header
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+DEFAULT_CALIBRATION_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "ollama_server", "token_calibration.json"
+)
+
+POLICIES = ("drop_oldest", "drop_middle")
+
+TRUNCATION_MARKER = "\n[...]\n"
+
+
+class TokenEstimator:
+    """Character-based token counts with per-model calibration."""
+
+    def __init__(self, path: Optional[str] = DEFAULT_CALIBRATION_PATH, smoothing: float = 0.2):
+        self.path = path
+        self.smoothing = smoothing
+        self.chars_per_token: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.chars_per_token = {k: float(v) for k, v in json.load(f).items()}
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring token calibration cache {path}: {e}")
+
+    def ratio(self, model: str) -> float:
+        return self.chars_per_token.get(model, DEFAULT_CHARS_PER_TOKEN)
+
+    def count(self, model: str, text: str) -> int:
+        return math.ceil(len(text) / self.ratio(model))
+
+    def count_messages(self, model: str, messages: List[dict]) -> int:
+        ratio = self.ratio(model)
+        return REPLY_OVERHEAD + sum(
+            MESSAGE_OVERHEAD + math.ceil(len(m.get("content") or "") / ratio)
+            for m in messages
+        )
+
+    def observe(self, model: str, messages: List[dict], prompt_tokens: int):
+        """Refine the model's ratio from the prompt token count the server reported."""
+        chars = sum(len(m.get("content") or "") for m in messages)
+        content_tokens = prompt_tokens - REPLY_OVERHEAD - MESSAGE_OVERHEAD * len(messages)
+        if chars < 200 or content_tokens <= 0:
+            return  # Too little text to say anything about the tokenizer
+        observed = min(8.0, max(1.0, chars / content_tokens))
+        with self._lock:
+            current = self.chars_per_token.get(model)
+            self.chars_per_token[model] = (
+                observed
+                if current is None
+                else current + self.smoothing * (observed - current)
+            )
+            if self.path and time.monotonic() - self._saved_at > 30:
+                self._saved_at = time.monotonic()
+                self._save()
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.chars_per_token, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save token calibration: {e}")
+
+
+class PromptTrimmer:
+    """Fits chat messages into a token budget and counts the tokens saved."""
+
+    def __init__(self, estimator: TokenEstimator, policy: str = "drop_oldest"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown trim policy {policy!r}; expected one of {POLICIES}")
+        self.estimator = estimator
+        self.policy = policy
+        self.requests = 0
+        self.trimmed_requests = 0
+        self.messages_dropped = 0
+        self.tokens_saved = 0
+        self.last_tokens_saved = 0
+
+    def fit(self, model: str, messages: List[dict], budget: int) -> List[dict]:
+        """Messages that fit in budget tokens (the input list if it already fits)."""
+        self.requests += 1
+        self.last_tokens_saved = 0
+        before = self.estimator.count_messages(model, messages)
+        if before <= budget:
+            return messages
+
+        kept, dropped = self._drop(model, messages, budget)
+        kept = self._truncate(model, kept, budget)
+
+        after = self.estimator.count_messages(model, kept)
+        self.trimmed_requests += 1
+        self.messages_dropped += dropped
+        self.last_tokens_saved = before - after
+        self.tokens_saved += before - after
+        logger.info(
+            f"Trimmed prompt from ~{before} to ~{after} tokens "
+            f"(budget {budget}, {dropped} messages dropped)"
+        )
+        return kept
+
+    def _drop(self, model: str, messages: List[dict], budget: int) -> Tuple[List[dict], int]:
+        # Indexes that may be dropped, in the order the policy gives them up
+        candidates = [
+            i
+            for i, m in enumerate(messages[:-1])
+            if m.get("role") != "system"
+        ]
+        if self.policy == "drop_middle" and candidates:
+            candidates = candidates[1:]
+
+        ratio = self.estimator.ratio(model)
+        note_tokens = self.estimator.count_messages(model, [self._note(len(candidates))])
+        total = self.estimator.count_messages(model, messages)
+        removed = set()
+        for i in candidates:
+            if total + (note_tokens if removed else 0) <= budget:
+                break
+            content = messages[i].get("content") or ""
+            total -= MESSAGE_OVERHEAD + math.ceil(len(content) / ratio)
+            removed.add(i)
+        if not removed:
+            return list(messages), 0
+
+        first = min(removed)
+        kept = []
+        for i, message in enumerate(messages):
+            if i in removed:
+                if i == first:
+                    kept.append(self._note(len(removed)))
+                continue
+            kept.append(message)
+        return kept, len(removed)
+
+    @staticmethod
+    def _note(count: int) -> dict:
+        return {
+            "role": "system",
+            "content": f"[{count} earlier messages omitted to fit the context window]",
+        }
+
+    def _truncate(self, model: str, messages: List[dict], budget: int) -> List[dict]:
+        """Cut the middle out of the longest messages until the prompt fits.
+
+        System messages and the last user message are never cut.
+        """
+        last_user = max(
+            (i for i, m in enumerate(messages) if m.get("role") == "user"), default=None
+        )
+        cuttable = [
+            i for i, m in enumerate(messages) if m.get("role") != "system" and i != last_user
+        ]
+        messages = list(messages)
+        originals = {i: messages[i].get("content") or "" for i in cuttable}
+        removed: Dict[int, int] = {}
+        ratio = self.estimator.ratio(model)
+        while True:
+            excess = self.estimator.count_messages(model, messages) - budget
+            if excess <= 0:
+                return messages
+            # Messages that would still get shorter, the longest first
+            shrinkable = [
+                i
+                for i in cuttable
+                if len(messages[i].get("content") or "") > len(TRUNCATION_MARKER)
+            ]
+            if not shrinkable:
+                logger.warning(
+                    f"Prompt still ~{excess} tokens over budget; only protected messages are left"
+                )
+                return messages
+            longest = max(shrinkable, key=lambda i: len(messages[i].get("content") or ""))
+            content = originals[longest]
+            cut = math.ceil(excess * ratio)
+            if longest not in removed:
+                cut += len(TRUNCATION_MARKER)
+            removed[longest] = min(len(content), removed.get(longest, 0) + cut)
+            # Re-cut from the original so a message only ever carries one marker
+            keep = len(content) - removed[longest]
+            head = keep // 2
+            trimmed = content[:head] + TRUNCATION_MARKER + content[len(content) - (keep - head) :]
+            messages[longest] = {**messages[longest], "content": trimmed}
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "trimmed_requests": self.trimmed_requests,
+            "messages_dropped": self.messages_dropped,
+            "tokens_saved": self.tokens_saved,
+            "last_tokens_saved": self.last_tokens_saved,
+        }
+
+
+_estimators: Dict[Optional[str], TokenEstimator] = {}
+
+
+def estimator_for(path: Optional[str] = DEFAULT_CALIBRATION_PATH) -> TokenEstimator:
+    """Shared estimator per calibration file, so calibrations are learned once."""
+    if path not in _estimators:
+        _estimators[path] = TokenEstimator(path)
+    return _estimators[path]
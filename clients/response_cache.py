@@ -0,0 +1,182 @@
+"""
+Disk-backed, content-addressed cache of LLM responses.
+
+Entries are keyed by a hash of the model, messages and sampling parameters
+(plus an optional namespace such as autogen's ``cache_seed``), so re-running
+an agent workflow or an eval replays earlier answers instead of recomputing
+them. A cached entry keeps the chunks it was streamed in, so a hit can be
+replayed as a stream.
+
+Storage is one SQLite file in WAL mode: any number of processes can read
+while one writes. When the stored bodies grow past ``max_bytes``, the least
+recently used entries are evicted down to 90% of the limit.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "ollama_server", "responses.sqlite3"
+)
+
+# Access times are refreshed at most this often, so hits rarely write
+TOUCH_INTERVAL = 60.0
+
+# Check the size limit after this many inserts
+EVICT_EVERY = 32
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+
+def cache_key(model: str, messages: list, params: dict, namespace=None) -> str:
+    """Content address for a request: model, messages and sampling parameters."""
+    canonical = json.dumps(
+        {"model": model, "messages": messages, "params": params, "namespace": namespace},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed LRU of completed responses."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections are not shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[dict]:
+        """The cached entry for key: content, chunks, finish_reason and usage."""
+        try:
+            row = self._connection().execute(
+                "SELECT body, accessed FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache read failed: {e}")
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        body, accessed = row
+        now = time.time()
+        if now - accessed > TOUCH_INTERVAL:
+            try:
+                self._connection().execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                )
+            except sqlite3.Error:
+                pass  # Only affects eviction order
+        return json.loads(body)
+
+    def put(
+        self,
+        key: str,
+        model: str,
+        content: str,
+        chunks: Optional[List[str]] = None,
+        finish_reason: Optional[str] = None,
+        usage: Optional[dict] = None,
+    ):
+        body = json.dumps(
+            {
+                "content": content,
+                "chunks": chunks or [content],
+                "finish_reason": finish_reason,
+                "usage": usage or {},
+            }
+        ).encode("utf-8")
+        now = time.time()
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, body, len(body), now, now),
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache write failed: {e}")
+            return
+        with self._lock:
+            self._inserts += 1
+            check = self._inserts % EVICT_EVERY == 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """Drop least recently used entries once the cache is over max_bytes."""
+        connection = self._connection()
+        try:
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            target = total - int(self.max_bytes * 0.9)
+            rows = connection.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"
+            ).fetchall()
+            doomed = []
+            for key, size in rows:
+                doomed.append((key,))
+                target -= size
+                if target <= 0:
+                    break
+            connection.executemany("DELETE FROM responses WHERE key = ?", doomed)
+            logger.info(f"Evicted {len(doomed)} cached responses")
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache eviction failed: {e}")
+
+    def stats(self) -> dict:
+        entries, size = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+_caches: Dict[str, ResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def cache_for(setting, max_bytes: int = 512 * 1024 * 1024) -> Optional[ResponseCache]:
+    """Shared cache for a client config value: a path, True for the default path, or falsy."""
+    if not setting:
+        return None
+    path = DEFAULT_CACHE_PATH if setting is True else setting
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(path, max_bytes)
+    return _caches[path]
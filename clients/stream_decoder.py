@@ -0,0 +1,149 @@
+"""
+Incremental decoder for streamed completions.
+
+Understands both wire formats the middleware passes through:
+
+- OpenAI-compatible server-sent events (``/v1/chat/completions``,
+  ``/v1/completions``): ``data: {...}`` frames ending with ``data: [DONE]``,
+  with token usage in the final frame when ``stream_options.include_usage``
+  is set.
+- Native Ollama NDJSON (``/api/chat``, ``/api/generate``): one JSON object
+  per line, the last one carrying ``done: true`` and the eval counters.
+
+Each line yields the text delta it carries. The accumulated text is kept in
+a list and joined only when asked for, so long outputs are not re-copied on
+every token.
+"""
+
+import json
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional
+
+# Native counters reported alongside the token counts
+NATIVE_STATS = (
+    "total_duration",
+    "load_duration",
+    "prompt_eval_duration",
+    "eval_duration",
+)
+
+
+def native_usage(frame: dict) -> dict:
+    """OpenAI-style token usage plus the native counters from a final Ollama frame."""
+    prompt_tokens = frame.get("prompt_eval_count", 0)
+    completion_tokens = frame.get("eval_count", 0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        **{k: frame[k] for k in NATIVE_STATS if k in frame},
+    }
+
+
+class StreamError(Exception):
+    """The server reported an error in the middle of a stream."""
+
+
+class TextBuffer:
+    """Append-only text kept as a list of parts."""
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._joined = ""
+        self._joined_parts = 0
+
+    def append(self, text: str):
+        if text:
+            self._parts.append(text)
+
+    @property
+    def text(self) -> str:
+        if self._joined_parts != len(self._parts):
+            self._joined += "".join(self._parts[self._joined_parts :])
+            self._joined_parts = len(self._parts)
+        return self._joined
+
+    @property
+    def parts(self) -> List[str]:
+        return list(self._parts)
+
+    def __len__(self) -> int:
+        return len(self._parts)
+
+
+class StreamDecoder:
+    """Turns stream lines into text deltas and collects the final usage."""
+
+    def __init__(self):
+        self.buffer = TextBuffer()
+        self.usage: Optional[dict] = None
+        self.finish_reason: Optional[str] = None
+        self.done = False
+
+    @property
+    def text(self) -> str:
+        return self.buffer.text
+
+    def feed(self, line: str) -> str:
+        """Decode one line, returning its text delta ("" for control frames)."""
+        line = line.strip()
+        if not line or line.startswith(":"):
+            return ""
+        if line.startswith("data:"):
+            data = line[5:].strip()
+            if data == "[DONE]":
+                self.done = True
+                return ""
+        elif line.startswith(("event:", "id:", "retry:")):
+            return ""
+        else:
+            data = line
+
+        frame = json.loads(data)
+        if "error" in frame:
+            error = frame["error"]
+            raise StreamError(error.get("message", error) if isinstance(error, dict) else error)
+        delta = self._openai(frame) if "choices" in frame else self._native(frame)
+        self.buffer.append(delta)
+        return delta
+
+    def _openai(self, frame: dict) -> str:
+        if frame.get("usage"):
+            self.usage = frame["usage"]
+        if not frame["choices"]:
+            return ""
+        choice = frame["choices"][0]
+        self.finish_reason = choice.get("finish_reason") or self.finish_reason
+        if "delta" in choice:
+            return choice["delta"].get("content") or ""
+        return choice.get("text") or ""
+
+    def _native(self, frame: dict) -> str:
+        delta = (frame.get("message") or {}).get("content") or frame.get("response") or ""
+        if frame.get("done"):
+            self.done = True
+            self.finish_reason = frame.get("done_reason")
+            self.usage = native_usage(frame)
+        return delta
+
+    def replay(self, chunks: Iterable[str], finish_reason=None, usage=None) -> Iterator[str]:
+        """Feed already decoded chunks (e.g. from a cache), yielding them as deltas."""
+        for chunk in chunks:
+            self.buffer.append(chunk)
+            yield chunk
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.done = True
+
+    def deltas(self, lines: Iterable[str]) -> Iterator[str]:
+        """Non-empty text deltas from a line iterator."""
+        for line in lines:
+            delta = self.feed(line)
+            if delta:
+                yield delta
+
+    async def adeltas(self, lines: AsyncIterable[str]) -> AsyncIterator[str]:
+        """Async variant of deltas()."""
+        async for line in lines:
+            delta = self.feed(line)
+            if delta:
+                yield delta
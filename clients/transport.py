@@ -0,0 +1,423 @@
+"""
+Shared HTTP transport for the framework clients in this directory.
+
+One ``OllamaTransport`` per middleware (``base_url``) and password, shared by
+every adapter through ``transport_for``. It provides:
+
+- keep-alive connection pools, sync (``httpx.Client``) and async
+  (``httpx.AsyncClient``), created on first use
+- a bearer token fetched from ``/mw/generate-token``, refreshed shortly before
+  its ``exp`` claim and once more if the middleware answers 403
+- retries with full-jitter exponential backoff on connection failures, and
+  on 429/502/503/504 responses for idempotent and bulk requests (a chat POST
+  that reached the server is never sent twice)
+- timeouts from the client config (``timeout``, ``connect_timeout``)
+- an adaptive in-flight limit for bulk requests (``bulk=<items>``), see
+  clients/adaptive_limit.py; ``Retry-After`` is honored on every retry
+
+Paths are relative to ``/mw/protected/`` unless a full URL is passed.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional, Tuple
+
+import httpx
+import jwt
+
+from clients.adaptive_limit import AdaptiveLimit, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: overload and gateway errors
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+# Failures before the request reached Ollama, so a retry cannot duplicate work
+RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Methods safe to resend after a retryable status (bulk requests are too)
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Statuses that tell the bulk limit the server is overloaded
+OVERLOAD_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Refresh the token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 60.0
+
+# Lifetime assumed for tokens without a readable exp claim
+FALLBACK_TOKEN_LIFETIME = 4 * 3600.0
+
+
+class AuthenticationError(Exception):
+    """The middleware refused to issue a token."""
+
+
+def token_expiry(token: str) -> float:
+    """Unix time at which a token should be replaced."""
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False})
+        expiry = float(claims["exp"])
+    except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+        expiry = time.time() + FALLBACK_TOKEN_LIFETIME
+    return expiry - TOKEN_REFRESH_MARGIN
+
+
+class OllamaTransport:
+    """Pooled, authenticated, retrying HTTP access to the middleware."""
+
+    def __init__(
+        self,
+        base_url: str,
+        token_password: str = "default_token_password",
+        timeout: float = 600.0,
+        connect_timeout: float = 10.0,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        max_connections: int = 32,
+        initial_inflight: int = 4,
+        max_inflight: int = 16,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.token_url = f"{self.base_url}/mw/generate-token"
+        self.token_password = token_password
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Shared by every bulk caller of this middleware, sync or async
+        self.bulk_limit = AdaptiveLimit(initial_inflight, max_limit=max_inflight)
+
+        self.token: Optional[str] = None
+        self.token_refresh_at = 0.0
+        self._token_lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        # Pooled connections belong to one event loop, so each loop gets its own client
+        # (and token lock); a client is dropped with its loop, never shared between loops
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_clients_lock = threading.Lock()
+
+    # -- helpers ---------------------------------------------------------
+
+    def url(self, path: str) -> str:
+        if path.startswith(("http://", "https://")):
+            return path
+        return f"{self.base_url}/mw/protected/{path.lstrip('/')}"
+
+    def _headers(self, headers: Optional[dict]) -> Dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            **(headers or {}),
+            "Authorization": f"Bearer {self.token}",
+        }
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """Full-jitter exponential backoff, or longer if the server sent Retry-After."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if response is not None:
+            delay = max(delay, parse_retry_after(response.headers.get("retry-after")) or 0.0)
+        return delay
+
+    def _release_bulk(self, started: float, response: Optional[httpx.Response], items: int):
+        # No response means a timeout or connection failure: treat it as overload
+        if response is None or response.status_code in OVERLOAD_STATUS_CODES:
+            retry_after = None
+            if response is not None:
+                retry_after = parse_retry_after(response.headers.get("retry-after"))
+            self.bulk_limit.release(None, overloaded=True, retry_after=retry_after)
+        else:
+            self.bulk_limit.release(time.monotonic() - started, items)
+
+    def _store_token(self, response: httpx.Response) -> str:
+        if response.status_code != 200:
+            raise AuthenticationError(f"Authentication failed: {response.text}")
+        self.token = response.json()["token"]
+        self.token_refresh_at = token_expiry(self.token)
+        logger.info("Authentication successful.")
+        return self.token
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            self._client = httpx.Client(timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    def _async_state(self) -> Tuple[httpx.AsyncClient, asyncio.Lock]:
+        loop = asyncio.get_running_loop()
+        with self._async_clients_lock:
+            state = self._async_clients.get(loop)
+            if state is None:
+                # A closed loop's client can no longer be closed; let its sockets be collected
+                for old in [old for old in self._async_clients if old.is_closed()]:
+                    del self._async_clients[old]
+                state = (
+                    httpx.AsyncClient(timeout=self.timeout, limits=self.limits),
+                    asyncio.Lock(),
+                )
+                self._async_clients[loop] = state
+        return state
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """The connection pool of the running event loop."""
+        return self._async_state()[0]
+
+    # -- sync --------------------------------------------------------------
+
+    def authenticate(self, stale_token: Optional[str] = None) -> str:
+        """Fetch a token; concurrent callers share one refresh."""
+        with self._token_lock:
+            if self.token is not None and self.token != stale_token:
+                if time.time() < self.token_refresh_at:
+                    return self.token
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = self.client.post(
+                        self.token_url, json={"password": self.token_password}
+                    )
+                    break
+                except RETRY_EXCEPTIONS:
+                    if attempt >= self.max_retries:
+                        raise
+                    time.sleep(self._retry_delay(attempt))
+            return self._store_token(response)
+
+    def get_token(self) -> str:
+        if self.token is None or time.time() >= self.token_refresh_at:
+            return self.authenticate(stale_token=self.token)
+        return self.token
+
+    def _send_once(self, request, stream: bool, bulk: Optional[int]) -> httpx.Response:
+        if not bulk:
+            return self.client.send(request, stream=stream)
+        self.bulk_limit.acquire()
+        started = time.monotonic()
+        response = None
+        try:
+            response = self.client.send(request, stream=stream)
+            return response
+        finally:
+            self._release_bulk(started, response, bulk)
+
+    def _send(
+        self, method, path, headers, stream, bulk=None, idempotent=None, **kwargs
+    ) -> httpx.Response:
+        retry_status = retries_status(method, bulk, idempotent)
+        attempt = 0
+        refreshed = False
+        response = None
+        while True:
+            token = self.get_token()
+            request = self.client.build_request(
+                method, self.url(path), headers=self._headers(headers), **kwargs
+            )
+            try:
+                response = self._send_once(request, stream, bulk)
+            except RETRY_EXCEPTIONS as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Request to {path} failed ({e!r}); retrying")
+            else:
+                if response.status_code == 403 and not refreshed:
+                    # Token revoked or expired server-side: refresh once and retry
+                    response.close()
+                    refreshed = True
+                    self.authenticate(stale_token=token)
+                    continue
+                if (
+                    not retry_status
+                    or response.status_code not in RETRY_STATUS_CODES
+                    or attempt >= self.max_retries
+                ):
+                    return response
+                response.close()
+                logger.warning(f"Request to {path} returned {response.status_code}; retrying")
+            time.sleep(self._retry_delay(attempt, response))
+            response = None
+            attempt += 1
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        headers: Optional[dict] = None,
+        bulk: Optional[int] = None,
+        idempotent: Optional[bool] = None,
+        **kwargs,
+    ):
+        """Send a request and return the fully read response.
+
+        bulk is the number of items (e.g. texts) in a bulk request; such
+        requests wait for a slot under the adaptive in-flight limit.
+        idempotent marks a POST as safe to resend after a 429/5xx answer
+        (the default for bulk requests and idempotent methods).
+        """
+        return self._send(
+            method, path, headers, stream=False, bulk=bulk, idempotent=idempotent, **kwargs
+        )
+
+    def post(self, path: str, **kwargs) -> httpx.Response:
+        return self.request("POST", path, **kwargs)
+
+    @contextmanager
+    def stream(self, method: str, path: str, headers: Optional[dict] = None, **kwargs):
+        """Send a request and yield the response with its body still unread."""
+        response = self._send(method, path, headers, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            response.close()
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    # -- async -------------------------------------------------------------
+
+    async def aauthenticate(self, stale_token: Optional[str] = None) -> str:
+        """Async variant of authenticate()."""
+        client, token_lock = self._async_state()
+        async with token_lock:
+            if self.token is not None and self.token != stale_token:
+                if time.time() < self.token_refresh_at:
+                    return self.token
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.post(
+                        self.token_url, json={"password": self.token_password}
+                    )
+                    break
+                except RETRY_EXCEPTIONS:
+                    if attempt >= self.max_retries:
+                        raise
+                    await asyncio.sleep(self._retry_delay(attempt))
+            return self._store_token(response)
+
+    async def aget_token(self) -> str:
+        if self.token is None or time.time() >= self.token_refresh_at:
+            return await self.aauthenticate(stale_token=self.token)
+        return self.token
+
+    async def _asend_once(self, request, stream: bool, bulk: Optional[int]) -> httpx.Response:
+        if not bulk:
+            return await self.async_client.send(request, stream=stream)
+        await self.bulk_limit.aacquire()
+        started = time.monotonic()
+        response = None
+        try:
+            response = await self.async_client.send(request, stream=stream)
+            return response
+        finally:
+            self._release_bulk(started, response, bulk)
+
+    async def _asend(
+        self, method, path, headers, stream, bulk=None, idempotent=None, **kwargs
+    ) -> httpx.Response:
+        retry_status = retries_status(method, bulk, idempotent)
+        attempt = 0
+        refreshed = False
+        response = None
+        while True:
+            token = await self.aget_token()
+            request = self.async_client.build_request(
+                method, self.url(path), headers=self._headers(headers), **kwargs
+            )
+            try:
+                response = await self._asend_once(request, stream, bulk)
+            except RETRY_EXCEPTIONS as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Request to {path} failed ({e!r}); retrying")
+            else:
+                if response.status_code == 403 and not refreshed:
+                    await response.aclose()
+                    refreshed = True
+                    await self.aauthenticate(stale_token=token)
+                    continue
+                if (
+                    not retry_status
+                    or response.status_code not in RETRY_STATUS_CODES
+                    or attempt >= self.max_retries
+                ):
+                    return response
+                await response.aclose()
+                logger.warning(f"Request to {path} returned {response.status_code}; retrying")
+            await asyncio.sleep(self._retry_delay(attempt, response))
+            response = None
+            attempt += 1
+
+    async def arequest(
+        self,
+        method: str,
+        path: str,
+        headers: Optional[dict] = None,
+        bulk: Optional[int] = None,
+        idempotent: Optional[bool] = None,
+        **kwargs,
+    ) -> httpx.Response:
+        """Async variant of request()."""
+        return await self._asend(
+            method, path, headers, stream=False, bulk=bulk, idempotent=idempotent, **kwargs
+        )
+
+    async def apost(self, path: str, **kwargs) -> httpx.Response:
+        return await self.arequest("POST", path, **kwargs)
+
+    @asynccontextmanager
+    async def astream(self, method: str, path: str, headers: Optional[dict] = None, **kwargs):
+        """Async variant of stream()."""
+        response = await self._asend(method, path, headers, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def aclose(self):
+        """Close the running event loop's connection pool."""
+        with self._async_clients_lock:
+            state = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].aclose()
+
+
+def retries_status(method: str, bulk: Optional[int], idempotent: Optional[bool]) -> bool:
+    """Whether a 429/5xx answer may be retried: the request may have run already."""
+    if idempotent is not None:
+        return idempotent
+    return bool(bulk) or method.upper() in IDEMPOTENT_METHODS
+
+
+# One transport (and so one connection pool and token) per middleware, password
+# and settings
+_transports: Dict[tuple, OllamaTransport] = {}
+_transports_lock = threading.Lock()
+
+
+def transport_for(config: dict) -> OllamaTransport:
+    """Shared transport for a client config (base_url, token_password, timeouts)."""
+    base_url = config["base_url"].rstrip("/")
+    password = config.get("token_password", "default_token_password")
+    settings = {
+        "timeout": config.get("timeout", 600.0),
+        "connect_timeout": config.get("connect_timeout", 10.0),
+        "max_retries": config.get("max_retries", 3),
+        "initial_inflight": config.get("initial_inflight", 4),
+        "max_inflight": config.get("max_inflight", 16),
+    }
+    key = (base_url, password, *settings.values())
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = OllamaTransport(base_url, password, **settings)
+            _transports[key] = transport
+    return transport
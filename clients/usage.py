@@ -0,0 +1,103 @@
+"""
+Per-call usage and latency records, aggregated per model client.
+
+autogen creates one model client per agent, so a client's ``UsageTracker``
+is that agent's usage. ``usage_by_agent`` collects them from a list of
+agents, which makes it easy to spot the conversation that burns the most
+server time.
+
+Each call records token counts, Ollama's server-side durations (load,
+prompt eval, eval, total), client wall-clock time and, for streamed calls,
+time to first token.
+"""
+
+import threading
+from typing import Dict, Iterable, Optional
+
+# Native duration counters (nanoseconds) and the seconds fields they become
+DURATIONS = {
+    "load_duration": "load_s",
+    "prompt_eval_duration": "prompt_eval_s",
+    "eval_duration": "eval_s",
+    "total_duration": "server_s",
+}
+
+SUMMED_FIELDS = (
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "cost",
+    *DURATIONS.values(),
+    "wall_s",
+)
+
+
+def call_record(usage: dict, wall_s: float, ttft_s: Optional[float], cost: float) -> dict:
+    """One call's usage in seconds, from the decoded usage and client timings."""
+    record = {
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "total_tokens": usage.get("total_tokens", 0),
+        "cost": cost,
+        "wall_s": wall_s,
+        "ttft_s": ttft_s,
+    }
+    for native, seconds in DURATIONS.items():
+        record[seconds] = usage.get(native, 0) / 1e9
+    return record
+
+
+class UsageTracker:
+    """Running totals of call records."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.totals: Dict[str, float] = {field: 0 for field in SUMMED_FIELDS}
+        self.ttft_sum = 0.0
+        self.ttft_calls = 0
+
+    def record(self, record: dict):
+        with self._lock:
+            self.calls += 1
+            for field in SUMMED_FIELDS:
+                self.totals[field] += record.get(field) or 0
+            if record.get("ttft_s") is not None:
+                self.ttft_sum += record["ttft_s"]
+                self.ttft_calls += 1
+
+    def merge(self, other: "UsageTracker"):
+        with self._lock:
+            self.calls += other.calls
+            for field in SUMMED_FIELDS:
+                self.totals[field] += other.totals[field]
+            self.ttft_sum += other.ttft_sum
+            self.ttft_calls += other.ttft_calls
+
+    def summary(self) -> dict:
+        with self._lock:
+            totals = dict(self.totals)
+            calls = self.calls
+            ttft_calls, ttft_sum = self.ttft_calls, self.ttft_sum
+        return {
+            "calls": calls,
+            **totals,
+            "mean_wall_s": totals["wall_s"] / calls if calls else 0.0,
+            "mean_ttft_s": ttft_sum / ttft_calls if ttft_calls else None,
+            "eval_tokens_per_s": (
+                totals["completion_tokens"] / totals["eval_s"] if totals["eval_s"] else None
+            ),
+        }
+
+
+def usage_by_agent(agents: Iterable) -> Dict[str, dict]:
+    """Usage summary per autogen agent, from the model clients it registered."""
+    summaries = {}
+    for agent in agents:
+        combined = UsageTracker()
+        for client in getattr(getattr(agent, "client", None), "_clients", []):
+            tracker = getattr(client, "usage", None)
+            if isinstance(tracker, UsageTracker):
+                combined.merge(tracker)
+        summaries[agent.name] = combined.summary()
+    return summaries
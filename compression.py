@@ -0,0 +1,338 @@
+"""
+ASGI middleware for compressed responses and compressed request bodies.
+
+Responses are compressed with the best encoding the client accepts: zstd and
+brotli when their optional packages are installed, gzip otherwise.
+
+- Buffered responses (``application/json`` and friends) are only compressed
+  once they reach ``minimum_size``; smaller bodies go out untouched.
+- Streaming responses (NDJSON and server-sent events) are compressed from the
+  first frame and flushed after every frame, so each token reaches the client
+  as soon as it would without compression.
+
+Responses that could have been compressed carry ``Vary: Accept-Encoding``
+whether or not they were, so shared caches keep the variants apart.
+
+Request bodies sent with ``Content-Encoding`` are decompressed before the app
+sees them; both the compressed and the decompressed body are limited to
+``max_request_size`` bytes.
+"""
+
+import zlib
+from typing import Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import PlainTextResponse
+
+try:
+    import zstandard
+except ImportError:  # Optional: pip install zstandard
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # Optional: pip install brotli
+    brotli = None
+
+# Highest level each encoding accepts (gzip: 9, brotli: 11, zstd: 22)
+MAX_LEVELS = {"gzip": 9, "br": 11, "zstd": 22}
+
+# Input fed to a brotli decoder per call when it cannot cap its output itself
+BROTLI_SLICE = 1024
+
+STREAMING_TYPES = {"application/x-ndjson", "text/event-stream"}
+COMPRESSIBLE_TYPES = {"application/json", "application/x-ndjson", "text/event-stream"}
+
+
+def available_encodings() -> list:
+    """Supported content codings, most preferred first."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick a response encoding from an Accept-Encoding header, or None."""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    for encoding in available_encodings():
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class _Encoder:
+    """Incremental compressor with a per-frame flush."""
+
+    def __init__(self, encoding: str, level: int):
+        level = max(1, min(level, MAX_LEVELS.get(encoding, 9)))
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self.compress = self._compressor.compress
+            self.flush = lambda: self._compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+            self.finish = self._compressor.flush
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+            self.compress = self._compressor.process
+            self.flush = self._compressor.flush
+            self.finish = self._compressor.finish
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress = self._compressor.compress
+            self.flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = self._compressor.flush
+
+
+def decompress_body(encoding: str, body: bytes, limit: int) -> bytes:
+    """Decode a request body.
+
+    Raises LookupError for an unsupported encoding, OverflowError past limit
+    decompressed bytes and ValueError for corrupt or truncated input.
+    """
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        wbits = 16 + zlib.MAX_WBITS if encoding != "deflate" else zlib.MAX_WBITS
+        decoder = zlib.decompressobj(wbits)
+        try:
+            data = decoder.decompress(body, limit + 1)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        finished = decoder.eof
+    elif encoding == "zstd" and zstandard is not None:
+        try:
+            reader = zstandard.ZstdDecompressor().stream_reader(body)
+            data = reader.read(limit + 1)
+            finished = len(data) > limit or _zstd_finished(body)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+    elif encoding == "br" and brotli is not None:
+        try:
+            data, finished = _brotli_decompress(body, limit + 1)
+        except brotli.error as e:
+            raise ValueError(str(e))
+    else:
+        raise LookupError(encoding)
+    if len(data) > limit:
+        raise OverflowError(limit)
+    if not finished:
+        # A cut-off body would otherwise pass as a valid, shorter payload
+        raise ValueError(f"truncated {encoding} body")
+    return data
+
+
+def _zstd_finished(body: bytes) -> bool:
+    """Whether body holds a complete zstd frame; only called once its output fits the limit."""
+    decoder = zstandard.ZstdDecompressor().decompressobj()
+    decoder.decompress(body)
+    return decoder.eof
+
+
+def _brotli_decompress(body: bytes, limit: int) -> Tuple[bytes, bool]:
+    """Decode brotli, stopping once the output reaches limit bytes.
+
+    Returns the output and whether the stream ended.
+    """
+    decoder = brotli.Decompressor()
+    try:
+        data = decoder.process(body, output_buffer_limit=limit)
+        return data, decoder.is_finished()
+    except TypeError:
+        pass  # brotli < 1.2 has no output limit: feed small slices and check as we go
+    parts = []
+    size = 0
+    for start in range(0, len(body), BROTLI_SLICE):
+        part = decoder.process(body[start : start + BROTLI_SLICE])
+        parts.append(part)
+        size += len(part)
+        if size >= limit:
+            break
+    return b"".join(parts), decoder.is_finished()
+
+
+def _with_vary(start: dict) -> dict:
+    """A response start message with Vary: Accept-Encoding added."""
+    headers = MutableHeaders(raw=list(start["headers"]))
+    headers.add_vary_header("Accept-Encoding")
+    return {**start, "headers": headers.raw}
+
+
+class _CompressingSender:
+    """Wraps the ASGI send callable to compress the response body.
+
+    With encoding None (the client accepts none we offer) bodies pass through
+    untouched and only the Vary header is added.
+    """
+
+    def __init__(self, send, encoding: Optional[str], minimum_size: int, level: int):
+        self.send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.level = level
+        self.start = None
+        self.encoder = None
+        self.passthrough = False
+        self.streaming = False
+        self.buffer = b""
+
+    def _compressed_start(self, content_length: Optional[int] = None) -> dict:
+        headers = MutableHeaders(raw=list(self.start["headers"]))
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        if content_length is None:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(content_length)
+        return {**self.start, "headers": headers.raw}
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            headers = Headers(raw=message["headers"])
+            media_type = headers.get("content-type", "").split(";")[0].strip().lower()
+            self.passthrough = (
+                "content-encoding" in headers or media_type not in COMPRESSIBLE_TYPES
+            )
+            self.streaming = media_type in STREAMING_TYPES
+            if self.passthrough:
+                await self.send(message)
+            elif self.encoding is None:
+                self.passthrough = True
+                await self.send(_with_vary(message))
+            elif self.streaming:
+                self.encoder = _Encoder(self.encoding, self.level)
+                await self.send(self._compressed_start())
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.streaming:
+            # Flush every frame so compression never holds back a token
+            data = self.encoder.compress(body)
+            data += self.encoder.flush() if more_body else self.encoder.finish()
+            await self.send({**message, "body": data})
+            return
+
+        if self.encoder is None:
+            self.buffer += body
+            if len(self.buffer) < self.minimum_size:
+                if more_body:
+                    return
+                # Too small to be worth compressing
+                await self.send(_with_vary(self.start))
+                await self.send({**message, "body": self.buffer})
+                return
+            self.encoder = _Encoder(self.encoding, self.level)
+            body, self.buffer = self.buffer, b""
+            if not more_body:
+                data = self.encoder.compress(body) + self.encoder.finish()
+                await self.send(self._compressed_start(len(data)))
+                await self.send({**message, "body": data})
+                return
+            await self.send(self._compressed_start())
+
+        data = self.encoder.compress(body)
+        if not more_body:
+            data += self.encoder.finish()
+        await self.send({**message, "body": data})
+
+
+class CompressionMiddleware:
+    """Negotiates response compression and decodes compressed request bodies."""
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = 1024,
+        level: int = 6,
+        max_request_size: int = 64 * 1024 * 1024,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.max_request_size = max_request_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        request_encoding = headers.get("content-encoding", "").strip().lower()
+        if request_encoding and request_encoding != "identity":
+            parts = []
+            received = 0
+            more_body = True
+            while more_body:
+                message = await receive()
+                parts.append(message.get("body", b""))
+                received += len(parts[-1])
+                more_body = message.get("more_body", False)
+                if received > self.max_request_size:
+                    response = PlainTextResponse("Request body too large", status_code=413)
+                    await response(scope, receive, send)
+                    return
+            try:
+                body = decompress_body(
+                    request_encoding, b"".join(parts), self.max_request_size
+                )
+            except LookupError:
+                response = PlainTextResponse(
+                    f"Unsupported Content-Encoding: {request_encoding}", status_code=415
+                )
+                await response(scope, receive, send)
+                return
+            except OverflowError:
+                response = PlainTextResponse("Request body too large", status_code=413)
+                await response(scope, receive, send)
+                return
+            except ValueError as e:
+                response = PlainTextResponse(
+                    f"Invalid compressed body: {e}", status_code=400
+                )
+                await response(scope, receive, send)
+                return
+
+            request_headers = MutableHeaders(scope=scope)
+            del request_headers["Content-Encoding"]
+            request_headers["Content-Length"] = str(len(body))
+            receive = _replay(body, receive)
+
+        encoding = choose_encoding(headers.get("accept-encoding"))
+        await self.app(
+            scope,
+            receive,
+            _CompressingSender(send, encoding, self.minimum_size, self.level),
+        )
+
+
+def _replay(body: bytes, receive):
+    """ASGI receive callable that yields an already-read body, then defers to receive."""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
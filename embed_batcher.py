@@ -0,0 +1,190 @@
+"""
+Dynamic micro-batching of concurrent embed requests.
+
+Callers that need embeddings for the same namespace (model plus options) are
+gathered for a short window and forwarded as one multi-input ``/api/embed``
+call; the vectors are then split back to each caller in order.
+
+The window adapts to load. An EWMA of the gap between arrivals estimates how
+long the batch would take to fill: under heavy load the window stretches
+towards ``max_window`` to build bigger batches, and when arrivals are further
+apart than ``max_window`` nothing would join anyway, so the batch is sent
+immediately and adds no latency. A batch is also closed as soon as it holds
+``max_batch`` inputs.
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Sequence
+
+# Sends one batch upstream: (payload without input, texts) -> vectors
+BatchSender = Callable[[dict, List[str]], Awaitable[List[List[float]]]]
+
+
+class _Batch:
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self.texts: Dict[str, int] = {}  # text -> position in the upstream input
+        self.waiters: List[tuple] = []  # (future, texts, enqueue time)
+        self.timer = None
+        self.expired = False
+
+
+class _Lane:
+    """Per-namespace arrival statistics and batches waiting to be sent."""
+
+    def __init__(self):
+        self.batch = None  # Batch still accepting inputs
+        self.ready = deque()  # Full batches waiting for an upstream slot
+        self.inflight = 0
+        self.last_arrival = 0.0
+        self.gap_ewma = float("inf")
+
+
+class EmbedBatcher:
+    """Gathers embed inputs per namespace and sends them as shared batches.
+
+    At most ``max_inflight`` batches per namespace are sent at once. While the
+    lane is saturated an expired batch keeps accepting inputs, so batches grow
+    with load instead of queueing up behind each other at the backend.
+    """
+
+    def __init__(
+        self,
+        send: BatchSender,
+        max_batch: int = 64,
+        min_window: float = 0.002,
+        max_window: float = 0.010,
+        max_inflight: int = 2,
+    ):
+        self.send = send
+        self.max_batch = max_batch
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_inflight = max_inflight
+        self._lanes: Dict[str, _Lane] = {}
+        self._running = set()  # Strong references to batch tasks
+        self.batches = 0
+        self.items = 0
+        self.requests = 0
+        self.wait_total = 0.0
+        self.last_window = 0.0
+
+    def _window(self, lane: _Lane, pending: int) -> float:
+        """How long to hold the current batch open, given recent arrivals."""
+        if lane.gap_ewma >= self.max_window:
+            return 0.0
+        fill_time = lane.gap_ewma * (self.max_batch - pending)
+        return min(self.max_window, max(self.min_window, fill_time))
+
+    async def embed(
+        self, namespace: str, payload: dict, texts: Sequence[str]
+    ) -> List[List[float]]:
+        """Embed texts, sharing one upstream call with concurrent callers."""
+        texts = list(texts)
+        if not texts:
+            return []
+        if len(texts) >= self.max_batch or self.max_window <= 0:
+            self.batches += 1
+            self.items += len(texts)
+            self.requests += 1
+            return await self.send(payload, texts)
+
+        lane = self._lanes.setdefault(namespace, _Lane())
+        now = time.monotonic()
+        if lane.last_arrival:
+            gap = now - lane.last_arrival
+            lane.gap_ewma = (
+                gap if lane.gap_ewma == float("inf") else 0.8 * lane.gap_ewma + 0.2 * gap
+            )
+        lane.last_arrival = now
+
+        batch = lane.batch
+        if batch is not None:
+            new_texts = [t for t in dict.fromkeys(texts) if t not in batch.texts]
+            if len(batch.texts) + len(new_texts) > self.max_batch:
+                self._close(lane)
+                batch = None
+        if batch is None:
+            batch = lane.batch = _Batch(payload)
+
+        for text in texts:
+            batch.texts.setdefault(text, len(batch.texts))
+        future = asyncio.get_running_loop().create_future()
+        batch.waiters.append((future, texts, now))
+
+        if len(batch.texts) >= self.max_batch:
+            self._close(lane)
+        elif batch.timer is None and not batch.expired:
+            self.last_window = self._window(lane, len(batch.texts))
+            if self.last_window <= 0:
+                self._expire(lane, batch)
+            else:
+                batch.timer = asyncio.get_running_loop().call_later(
+                    self.last_window, self._expire, lane, batch
+                )
+        self._pump(lane)
+        return await future
+
+    def _close(self, lane: _Lane):
+        """Stop the filling batch from accepting inputs and queue it for sending."""
+        batch, lane.batch = lane.batch, None
+        if batch.timer is not None:
+            batch.timer.cancel()
+        lane.ready.append(batch)
+
+    def _expire(self, lane: _Lane, batch: _Batch):
+        batch.expired = True
+        batch.timer = None
+        self._pump(lane)
+
+    def _pump(self, lane: _Lane):
+        """Send queued batches, then the expired filling batch, while slots are free."""
+        while lane.inflight < self.max_inflight:
+            if not lane.ready and lane.batch is not None and lane.batch.expired:
+                self._close(lane)
+            if not lane.ready:
+                return
+            lane.inflight += 1
+            task = asyncio.ensure_future(self._send(lane, lane.ready.popleft()))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _send(self, lane: _Lane, batch: _Batch):
+        texts = list(batch.texts)
+        started = time.monotonic()
+        self.batches += 1
+        self.items += len(texts)
+        self.requests += len(batch.waiters)
+        for _, _, enqueued in batch.waiters:
+            self.wait_total += started - enqueued
+        try:
+            vectors = await self.send(batch.payload, texts)
+            if len(vectors) != len(texts):
+                raise ValueError(
+                    f"Expected {len(texts)} embeddings from Ollama, got {len(vectors)}"
+                )
+        except Exception as e:
+            for future, _, _ in batch.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            lane.inflight -= 1
+            self._pump(lane)
+        for future, wanted, _ in batch.waiters:
+            if not future.done():
+                future.set_result([vectors[batch.texts[t]] for t in wanted])
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "requests": self.requests,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "mean_added_wait_ms": (
+                1000 * self.wait_total / self.requests if self.requests else 0.0
+            ),
+            "last_window_ms": 1000 * self.last_window,
+        }
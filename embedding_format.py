@@ -0,0 +1,128 @@
+"""
+Packed binary wire format for embedding responses.
+
+Clients opt in by sending one of the media types below in ``Accept``; anything
+else keeps the regular Ollama JSON response. A packed body is a 16-byte
+little-endian header followed by ``count * dim`` values in row-major order:
+
+    magic  4s  b"EMB1"
+    dtype  B   1 = float32, 2 = float16
+    pad    3x
+    count  I   number of vectors
+    dim    I   values per vector
+"""
+
+import json
+import struct
+import sys
+from array import array
+from typing import List, Optional, Sequence
+
+FLOAT32_MEDIA_TYPE = "application/x-embeddings-f32"
+FLOAT16_MEDIA_TYPE = "application/x-embeddings-f16"
+
+MAGIC = b"EMB1"
+HEADER = struct.Struct("<4sB3xII")
+DTYPE_CODES = {"float32": 1, "float16": 2}
+DTYPE_NAMES = {code: name for name, code in DTYPE_CODES.items()}
+MEDIA_TYPES = {"float32": FLOAT32_MEDIA_TYPE, "float16": FLOAT16_MEDIA_TYPE}
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def _quality(params: str) -> float:
+    for param in params.split(";"):
+        name, _, value = param.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return min(1.0, max(0.0, float(value)))
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+def negotiate(accept: Optional[str]) -> Optional[str]:
+    """Pick a packed dtype from an Accept header, or None for JSON.
+
+    Packed types must be listed explicitly (wildcards mean JSON). The packed
+    type with the highest q-value wins unless JSON is ranked higher; q=0
+    marks a type as not acceptable.
+    """
+    if not accept:
+        return None
+    ranks = {}
+    for part in accept.split(","):
+        media_type, _, params = part.partition(";")
+        media_type = media_type.strip().lower()
+        if media_type:
+            ranks[media_type] = max(ranks.get(media_type, 0.0), _quality(params))
+    json_rank = next(
+        (ranks[t] for t in ("application/json", "application/*", "*/*") if t in ranks), 0.0
+    )
+    # Ties go to float32, the lossless one
+    dtype = max(MEDIA_TYPES, key=lambda d: ranks.get(MEDIA_TYPES[d], 0.0))
+    rank = ranks.get(MEDIA_TYPES[dtype], 0.0)
+    if rank > 0 and rank >= json_rank:
+        return dtype
+    return None
+
+
+def accept_header(embedding_format: str = "float32") -> str:
+    """Accept header for a client preferring embedding_format ("json" disables packing)."""
+    if embedding_format == "json":
+        return "application/json"
+    return f"{MEDIA_TYPES[embedding_format]}, application/json;q=0.5"
+
+
+def encode_embeddings(vectors: Sequence[Sequence[float]], dtype: str = "float32") -> bytes:
+    """Pack vectors (lists, arrays or float32 memoryviews) into the wire format."""
+    count = len(vectors)
+    dim = len(vectors[0]) if count else 0
+    header = HEADER.pack(MAGIC, DTYPE_CODES[dtype], count, dim)
+    if dtype == "float16":
+        values = [value for vector in vectors for value in vector]
+        return header + struct.pack(f"<{len(values)}e", *values)
+
+    if LITTLE_ENDIAN:
+        # float32 memoryviews (e.g. from the embedding store) are copied as-is
+        return header + b"".join(
+            vector.tobytes() if isinstance(vector, memoryview) else array("f", vector).tobytes()
+            for vector in vectors
+        )
+    packed = array("f", [value for vector in vectors for value in vector])
+    packed.byteswap()
+    return header + packed.tobytes()
+
+
+def decode_embeddings(body: bytes) -> List[List[float]]:
+    """Unpack a packed embedding body into a list of float lists."""
+    if len(body) < HEADER.size:
+        raise ValueError("Packed embedding response is shorter than its header")
+    magic, code, count, dim = HEADER.unpack_from(body)
+    if magic != MAGIC or code not in DTYPE_NAMES:
+        raise ValueError("Not a packed embedding response")
+    payload = memoryview(body)[HEADER.size :]
+    itemsize = 2 if DTYPE_NAMES[code] == "float16" else 4
+    if len(payload) != count * dim * itemsize:
+        raise ValueError(
+            f"Packed embedding response has {len(payload)} bytes of values, "
+            f"expected {count} x {dim} x {itemsize}"
+        )
+    if DTYPE_NAMES[code] == "float16":
+        values = struct.unpack(f"<{count * dim}e", payload)
+        return [list(values[i * dim : (i + 1) * dim]) for i in range(count)]
+
+    if LITTLE_ENDIAN:
+        values = payload.cast("f")
+    else:
+        values = array("f")
+        values.frombytes(payload)
+        values.byteswap()
+    return [values[i * dim : (i + 1) * dim].tolist() for i in range(count)]
+
+
+def embeddings_from_response(content_type: Optional[str], body: bytes) -> List[List[float]]:
+    """Vectors from an embed response body, whichever format the server chose."""
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in MEDIA_TYPES.values():
+        return decode_embeddings(body)
+    return json.loads(body).get("embeddings", [])
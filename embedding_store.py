@@ -0,0 +1,231 @@
+"""
+Disk-backed, memory-mapped embedding store shared by every middleware worker.
+
+Each namespace (an embedding model plus any options that change its output)
+gets two append-only files in the store directory:
+
+- ``<stem>.f32``: fixed-width rows of little-endian float32 vectors.
+- ``<stem>.idx``: a 16-byte header carrying the vector dimension, followed by
+  one 16-byte key digest per row. Entry ``i`` describes row ``i``.
+
+Writers append under an exclusive ``flock`` on the key file and write a key
+only after its row is on disk, so the key file is the commit log: a reader
+never sees a key whose vector is incomplete, and a row orphaned by a crash is
+simply overwritten by the next append. Every process keeps its own dict index
+over the key file and catches up with rows appended by other workers whenever
+the key file grows. Reads return ``memoryview`` slices of the mapping, so a
+cache hit never copies the vector.
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+from typing import Dict, List, Optional, Sequence
+
+MAGIC = b"OEMB"
+VERSION = 1
+HEADER = struct.Struct("<4sII4x")  # magic, version, dimension, padding
+KEY_SIZE = 16
+FLOAT_SIZE = 4
+
+
+def embedding_key(namespace: str, text: str) -> bytes:
+    """Hash a namespace and input text into a fixed-width row key."""
+    digest = hashlib.blake2b(digest_size=KEY_SIZE)
+    digest.update(namespace.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.digest()
+
+
+def namespace_stem(namespace: str) -> str:
+    """File name stem for a namespace: readable prefix plus a short hash."""
+    readable = re.sub(r"[^A-Za-z0-9._-]+", "_", namespace)[:48]
+    suffix = hashlib.blake2b(namespace.encode("utf-8"), digest_size=6).hexdigest()
+    return f"{readable}-{suffix}"
+
+
+class _Shard:
+    """The pair of files backing a single namespace."""
+
+    def __init__(self, idx_path: str, vec_path: str):
+        self.idx_path = idx_path
+        self.vec_path = vec_path
+        self.idx_fd = os.open(idx_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.vec_fd = os.open(vec_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.dim = 0
+        self.rows = 0
+        self.index: Dict[bytes, int] = {}
+        self.mapping: Optional[mmap.mmap] = None
+        self.mapped_rows = 0
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * FLOAT_SIZE
+
+    def _read_header(self) -> bool:
+        header = os.pread(self.idx_fd, HEADER.size, 0)
+        if len(header) < HEADER.size:
+            return False
+        magic, version, dim = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unrecognised embedding index file: {self.idx_path}")
+        self.dim = dim
+        return True
+
+    def refresh(self):
+        """Pick up rows appended by this or any other process."""
+        if not self.dim and not self._read_header():
+            return
+        size = os.fstat(self.idx_fd).st_size
+        rows = (size - HEADER.size) // KEY_SIZE
+        if rows <= self.rows:
+            return
+        start = HEADER.size + self.rows * KEY_SIZE
+        keys = os.pread(self.idx_fd, (rows - self.rows) * KEY_SIZE, start)
+        for offset in range(0, len(keys), KEY_SIZE):
+            # Later rows win, matching what a fresh scan of the file would see
+            self.index[keys[offset : offset + KEY_SIZE]] = self.rows
+            self.rows += 1
+        self._remap()
+
+    def _remap(self):
+        if self.rows == self.mapped_rows:
+            return
+        # Outstanding memoryviews keep the previous mapping alive until released
+        self.mapping = mmap.mmap(
+            self.vec_fd, self.rows * self.row_bytes, access=mmap.ACCESS_READ
+        )
+        self.mapped_rows = self.rows
+
+    def get(self, key: bytes) -> Optional[memoryview]:
+        row = self.index.get(key)
+        if row is None:
+            return None
+        start = row * self.row_bytes
+        return memoryview(self.mapping)[start : start + self.row_bytes].cast("f")
+
+    def append(self, keys: List[bytes], vectors: Sequence[Sequence[float]]):
+        dim = len(vectors[0])
+        fcntl.flock(self.idx_fd, fcntl.LOCK_EX)
+        try:
+            if not self._read_header():
+                os.pwrite(self.idx_fd, HEADER.pack(MAGIC, VERSION, dim), 0)
+                self.dim = dim
+            if dim != self.dim:
+                raise ValueError(
+                    f"Embedding dimension {dim} does not match store dimension {self.dim}"
+                )
+
+            # Count committed rows under the lock; a torn trailing key is dropped
+            size = os.fstat(self.idx_fd).st_size
+            committed = (size - HEADER.size) // KEY_SIZE
+            key_offset = HEADER.size + committed * KEY_SIZE
+            if size != key_offset:
+                os.ftruncate(self.idx_fd, key_offset)
+
+            packed = array("f")
+            for vector in vectors:
+                if len(vector) != dim:
+                    raise ValueError("All embeddings in a batch must share a dimension")
+                packed.extend(vector)
+            os.pwrite(self.vec_fd, packed.tobytes(), committed * self.row_bytes)
+            os.pwrite(self.idx_fd, b"".join(keys), key_offset)
+        finally:
+            fcntl.flock(self.idx_fd, fcntl.LOCK_UN)
+        self.refresh()
+
+    def close(self):
+        self.mapping = None
+        os.close(self.idx_fd)
+        os.close(self.vec_fd)
+
+
+class EmbeddingStore:
+    """Persistent float32 embedding cache keyed by (namespace, text)."""
+
+    def __init__(self, directory: str):
+        if sys.byteorder != "little":
+            raise RuntimeError("EmbeddingStore requires a little-endian host")
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._shards: Dict[str, _Shard] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _shard(self, namespace: str, create: bool) -> Optional[_Shard]:
+        shard = self._shards.get(namespace)
+        if shard is not None:
+            return shard
+        stem = os.path.join(self.directory, namespace_stem(namespace))
+        idx_path, vec_path = f"{stem}.idx", f"{stem}.f32"
+        if not create and not os.path.exists(idx_path):
+            return None
+        shard = _Shard(idx_path, vec_path)
+        self._shards[namespace] = shard
+        logging.info(f"Opened embedding store shard {stem} for {namespace!r}")
+        return shard
+
+    def get_many(
+        self, namespace: str, texts: Sequence[str]
+    ) -> List[Optional[memoryview]]:
+        """Return a zero-copy float32 view per text, or None when not cached."""
+        with self._lock:
+            shard = self._shard(namespace, create=False)
+            if shard is None:
+                self.misses += len(texts)
+                return [None] * len(texts)
+            shard.refresh()
+            found = [shard.get(embedding_key(namespace, text)) for text in texts]
+            hits = sum(1 for vector in found if vector is not None)
+            self.hits += hits
+            self.misses += len(texts) - hits
+        return found
+
+    def put_many(
+        self,
+        namespace: str,
+        texts: Sequence[str],
+        vectors: Sequence[Sequence[float]],
+    ):
+        """Append embeddings for texts that are not stored yet."""
+        if len(texts) != len(vectors):
+            raise ValueError("texts and vectors must have the same length")
+        if not texts:
+            return
+        with self._lock:
+            shard = self._shard(namespace, create=True)
+            shard.refresh()
+            keys, fresh, seen = [], [], set()
+            for text, vector in zip(texts, vectors):
+                key = embedding_key(namespace, text)
+                if key not in shard.index and key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+                    fresh.append(vector)
+            if keys:
+                shard.append(keys, fresh)
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = {namespace: shard.rows for namespace, shard in self._shards.items()}
+        return {
+            "directory": self.directory,
+            "hits": self.hits,
+            "misses": self.misses,
+            "rows": rows,
+        }
+
+    def close(self):
+        with self._lock:
+            for shard in self._shards.values():
+                shard.close()
+            self._shards.clear()
@@ -0,0 +1,92 @@
+"""
+ETag helpers and a small TTL cache for idempotent metadata responses.
+
+The middleware tags ``/api/tags``, ``/api/show`` and ``/api/ps`` responses
+with a weak ETag derived from the body and answers a matching
+``If-None-Match`` with a bodyless 304. The edge proxy keeps the responses in
+a ``ResponseCache``: within the TTL they are served locally, after it they
+are revalidated with ``If-None-Match`` so an unchanged response costs a 304
+instead of the full body. Weak tags are used because the compression
+middleware may re-encode the body in transit.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+def entity_tag(body: bytes) -> str:
+    """Weak ETag for a response body."""
+    return f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+class CachedResponse:
+    """A fully read upstream response."""
+
+    def __init__(self, status_code: int, headers: Dict[str, str], body: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.etag = headers.get("etag")
+        self.stored_at = time.monotonic()
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.stored_at
+
+    def refresh(self):
+        """Mark the entry as just revalidated."""
+        self.stored_at = time.monotonic()
+
+
+class ResponseCache:
+    """LRU of cached responses; entries past the TTL are kept for revalidation."""
+
+    def __init__(self, ttl: float = 5.0, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """The entry for key, fresh or stale, or None."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def fresh(self, entry: Optional[CachedResponse]) -> bool:
+        return entry is not None and entry.age < self.ttl
+
+    def put(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+        }
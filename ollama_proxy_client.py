@@ -1,103 +1,471 @@
+import asyncio
+import logging
 import os
-from datetime import datetime, timedelta
+import time
+from collections import deque
+from datetime import timedelta
 import httpx
+import jwt
 from fastapi import FastAPI, HTTPException, Request
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+from http_cache import CachedResponse, ResponseCache, etag_matches
+from single_flight import SingleFlight, request_key
 
 # Configuration
 BASE_URL = os.getenv("BASE_URL", "http://144.24.112.144/amp/mw")  # Middleware URL
 PASSWORD = os.getenv("TOKEN_PASSWORD", "default_token_password")  # Token password
 API_KEY = os.getenv("API_KEY", "ollama")  # Default API key
 
+# Middleware endpoints in order of preference (comma-separated, defaults to BASE_URL)
+BASE_URLS = [
+    url.strip().rstrip("/")
+    for url in os.getenv("BASE_URLS", BASE_URL).split(",")
+    if url.strip()
+]
+
 # Initialize FastAPI app
 app = FastAPI()
 
-# In-memory token storage
-auth_token = None
-token_expiry = None
+# Long-lived pooled client so requests reuse keep-alive connections to the middleware
+client = httpx.AsyncClient(
+    timeout=httpx.Timeout(600.0, connect=10.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+)
+
+# Headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Request headers the proxy sets itself
+REPLACED_REQUEST_HEADERS = {"host", "authorization", "x-api-key", "content-length"}
+
+# Refresh this many seconds before expiry (capped at a fifth of the token lifetime)
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+
+# Lifetime assumed for tokens without a readable exp claim
+FALLBACK_TOKEN_LIFETIME = timedelta(hours=4).total_seconds()
+
+# Upstream statuses that mean "try another endpoint" (idempotent requests only)
+FAILOVER_STATUS_CODES = {502, 503, 504}
+
+# Errors raised before the request reached the endpoint, safe to fail over for any request
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+# Seconds an endpoint is skipped after a failure (doubles per consecutive failure)
+UPSTREAM_COOLDOWN = float(os.getenv("UPSTREAM_COOLDOWN", "2"))
+UPSTREAM_MAX_COOLDOWN = float(os.getenv("UPSTREAM_MAX_COOLDOWN", "60"))
+
+# Hedging: duplicate slow idempotent requests to a second endpoint
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "0.5"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+
+# Paths that are safe to send twice (GET requests always are)
+IDEMPOTENT_POST_PATHS = {"api/show", "api/embed", "api/embeddings", "api/tags", "api/ps"}
 
+# Metadata responses served from the edge cache (a TTL of 0 disables it)
+CACHED_PATHS = {"api/tags", "api/show", "api/ps"}
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", "5"))
+METADATA_CACHE_MAX_ENTRIES = int(os.getenv("METADATA_CACHE_MAX_ENTRIES", "256"))
 
-async def get_new_token():
-    """Fetch a new token from the middleware."""
-    global auth_token, token_expiry
+
+def token_times(token: str):
+    """Expiry and proactive refresh time for a token, read from its JWT claims."""
+    now = time.time()
     try:
-        async with httpx.AsyncClient() as client:
+        claims = jwt.decode(token, options={"verify_signature": False})
+        expiry = float(claims["exp"])
+        issued = float(claims.get("iat", now))
+    except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+        logging.warning("Token has no readable exp claim; assuming default lifetime")
+        expiry, issued = now + FALLBACK_TOKEN_LIFETIME, now
+    margin = min(TOKEN_REFRESH_MARGIN, (expiry - issued) / 5)
+    return expiry, expiry - margin
+
+
+def log_refresh_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"Token refresh failed: {task.exception()}")
+
+
+class Upstream:
+    """A middleware endpoint with its own token and health state."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+        # In-memory token storage (expiry and refresh times are Unix timestamps)
+        self.auth_token = None
+        self.token_expiry = None
+        self.token_refresh_at = None
+        # The refresh in progress, shared by every caller that needs a new token
+        self.refresh_task = None
+        # Timer that refreshes the token ahead of expiry, even without traffic
+        self.scheduled_refresh = None
+
+        # Health tracking
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        # Time to response headers of recent idempotent requests
+        self.latencies = deque(maxlen=200)
+
+    async def get_new_token(self):
+        """Fetch a new token from the middleware."""
+        try:
             response = await client.post(
-                f"{BASE_URL}/generate-token", json={"password": PASSWORD}
+                f"{self.base_url}/generate-token", json={"password": PASSWORD}
             )
             response.raise_for_status()
             data = response.json()
-            auth_token = data["token"]
-            token_expiry = datetime.utcnow() + timedelta(hours=4)  # Match token expiry
-            return auth_token
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to get new token: {e}")
+            self.auth_token = data["token"]
+            self.token_expiry, self.token_refresh_at = token_times(self.auth_token)
+            self.schedule_refresh()
+            return self.auth_token
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=500, detail=f"Failed to get new token: {e}")
+
+    def start_refresh(self):
+        """Start a token refresh unless one is already running, and return it."""
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.ensure_future(self.get_new_token())
+            self.refresh_task.add_done_callback(log_refresh_failure)
+        return self.refresh_task
+
+    async def refresh_token(self, stale_token=None):
+        """
+        Fetch a new token, collapsing concurrent refreshes into one request.
+
+        When stale_token is given and has already been replaced, the current
+        token is returned without another refresh.
+        """
+        if stale_token is not None and self.auth_token not in (None, stale_token):
+            return self.auth_token
+        return await asyncio.shield(self.start_refresh())
+
+    def schedule_refresh(self):
+        """Arrange for the current token to be replaced shortly before it expires."""
+        if self.scheduled_refresh is not None:
+            self.scheduled_refresh.cancel()
+        delay = max(0.0, self.token_refresh_at - time.time())
+        self.scheduled_refresh = asyncio.get_running_loop().call_later(
+            delay, self.start_refresh
+        )
+
+    async def get_token(self):
+        """Ensure a valid token is available."""
+        now = time.time()
+        if self.auth_token is None or now >= self.token_expiry:
+            return await self.refresh_token()
+        if now >= self.token_refresh_at:
+            # Close to expiry: refresh in the background and keep using the current token
+            self.start_refresh()
+        return self.auth_token
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        cooldown = min(
+            UPSTREAM_MAX_COOLDOWN,
+            UPSTREAM_COOLDOWN * 2 ** (self.consecutive_failures - 1),
+        )
+        self.down_until = time.monotonic() + cooldown
+        logging.warning(f"Upstream {self.base_url} marked down for {cooldown:.1f}s")
+
+    def hedge_delay(self) -> float:
+        """p95 of recent response times, the point past which a hedge is sent."""
+        if len(self.latencies) < 20:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    async def send(self, method, path, headers, params, body, idempotent):
+        """Send one request with this endpoint's token, refreshing once on a 403."""
+        self.requests += 1
+        started = time.monotonic()
+        url = f"{self.base_url}/protected/{path}"
+
+        async def attempt(token):
+            upstream_request = client.build_request(
+                method,
+                url,
+                headers={**headers, "Authorization": f"Bearer {token}"},
+                params=params,
+                content=body,
+            )
+            return await client.send(upstream_request, stream=True)
+
+        try:
+            token = await self.get_token()
+            response = await attempt(token)
+            if response.status_code == 403:
+                # Token revoked or expired server-side: refresh once and retry
+                await response.aclose()
+                response = await attempt(await self.refresh_token(stale_token=token))
+        except (httpx.HTTPError, HTTPException):
+            self.record_failure()
+            raise
+        if response.status_code in FAILOVER_STATUS_CODES:
+            self.record_failure()
+        else:
+            self.record_success()
+            if idempotent:
+                self.latencies.append(time.monotonic() - started)
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "failures": self.failures,
+            "hedge_delay_ms": 1000 * self.hedge_delay(),
+        }
+
+
+upstreams = [Upstream(url) for url in BASE_URLS]
+
+# Hedging counters, used to keep duplicates within HEDGE_MAX_RATIO of requests
+hedge_stats = {"eligible": 0, "hedged": 0, "hedge_wins": 0}
+
+# Strong references to losing responses being closed, so they are not collected mid-close
+closing = set()
 
 
-async def get_token():
-    """Ensure a valid token is available."""
-    global auth_token, token_expiry
-    if auth_token is None or datetime.utcnow() >= token_expiry:
-        await get_new_token()
-    return auth_token
+def ordered_upstreams():
+    """Healthy endpoints in configured order, then the ones cooling down."""
+    return [u for u in upstreams if u.healthy] + [u for u in upstreams if not u.healthy]
+
+
+def discard(task):
+    """Cancel a losing attempt, closing its response if it already arrived."""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and task.exception() is None:
+        close = asyncio.ensure_future(task.result().aclose())
+        closing.add(close)
+        close.add_done_callback(closing.discard)
+
+
+async def hedged_send(primary, secondary, *args):
+    """Send to primary; past its p95 latency, race a duplicate on secondary."""
+    if not args[-1]:
+        # Never duplicate a request that is not safe to run twice
+        return await primary.send(*args)
+    first = asyncio.ensure_future(primary.send(*args))
+    done, _ = await asyncio.wait({first}, timeout=primary.hedge_delay())
+    if done or hedge_stats["hedged"] >= HEDGE_MAX_RATIO * hedge_stats["eligible"]:
+        return await first
+
+    hedge_stats["hedged"] += 1
+    second = asyncio.ensure_future(secondary.send(*args))
+    pending = {first, second}
+    failure = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                failure = task
+                continue
+            if task.result().status_code in FAILOVER_STATUS_CODES and pending:
+                discard(task)
+                continue
+            for other in pending:
+                discard(other)
+            if task is second:
+                hedge_stats["hedge_wins"] += 1
+            return task.result()
+    return failure.result()  # Both attempts raised; re-raise the last error
+
+
+def is_idempotent(method, path) -> bool:
+    return method in ("GET", "HEAD") or (method == "POST" and path in IDEMPOTENT_POST_PATHS)
+
+
+def can_fail_over(idempotent, error) -> bool:
+    """
+    Whether a failed attempt may be sent to another endpoint.
+
+    A request that may have reached the endpoint (read timeout, dropped
+    connection) could already be running there, so only idempotent requests
+    are retried after those; anything else only after a connect failure or a
+    token error, where nothing was sent.
+    """
+    return idempotent or isinstance(error, (HTTPException, *CONNECT_ERRORS))
+
+
+async def forward(method, path, headers, params, body):
+    """Send a request to the first endpoint that answers, failing over on errors."""
+    idempotent = is_idempotent(method, path)
+    hedge = HEDGE_REQUESTS and idempotent and len(upstreams) > 1
+    if hedge:
+        hedge_stats["eligible"] += 1
+
+    candidates = ordered_upstreams()
+    last_error = None
+    for position, upstream in enumerate(candidates):
+        args = (method, path, headers, params, body, idempotent)
+        has_next = position + 1 < len(candidates)
+        try:
+            if hedge and has_next:
+                response = await hedged_send(upstream, candidates[position + 1], *args)
+            else:
+                response = await upstream.send(*args)
+        except (httpx.HTTPError, HTTPException) as e:
+            last_error = e
+            if can_fail_over(idempotent, e):
+                continue
+            break
+        if response.status_code in FAILOVER_STATUS_CODES and has_next and idempotent:
+            await response.aclose()
+            last_error = f"{upstream.base_url} returned {response.status_code}"
+            continue
+        return response
+    if isinstance(last_error, HTTPException):
+        last_error = last_error.detail
+    raise HTTPException(status_code=500, detail=f"Failed to proxy request: {last_error}")
+
+
+# Read-through cache for metadata endpoints, revalidated with If-None-Match
+metadata_cache = ResponseCache(ttl=METADATA_CACHE_TTL, max_entries=METADATA_CACHE_MAX_ENTRIES)
+
+# Collapses concurrent misses and revalidations of the same entry into one request
+metadata_flights = SingleFlight()
+
+
+async def fetch_metadata(key, method, path, headers, params, body):
+    """Fetch or revalidate a cached metadata response."""
+    cached = metadata_cache.get(key)
+    headers = {name: value for name, value in headers.items() if name != "if-none-match"}
+    if cached is not None and cached.etag:
+        headers["If-None-Match"] = cached.etag
+
+    response = await forward(method, path, headers, params, body)
+    try:
+        if response.status_code == 304 and cached is not None:
+            cached.refresh()
+            metadata_cache.revalidated += 1
+            return cached
+        content = b"".join([chunk async for chunk in response.aiter_raw()])
+    finally:
+        await response.aclose()
+
+    metadata_cache.misses += 1
+    entry = CachedResponse(
+        response.status_code,
+        {
+            name: value
+            for name, value in response.headers.items()
+            if name not in HOP_BY_HOP_HEADERS
+        },
+        content,
+    )
+    if response.status_code == 200:
+        metadata_cache.put(key, entry)
+    return entry
+
+
+async def cached_metadata(request: Request, path: str, headers: dict, body: bytes):
+    """Serve a metadata request from the cache, fetching it once when stale."""
+    # Raw bodies are cached, so the encoding the client accepts is part of the key
+    key = "|".join(
+        (
+            request_key(request.method, path, str(request.query_params), body),
+            request.headers.get("accept-encoding", ""),
+        )
+    )
+    entry = metadata_cache.get(key)
+    if metadata_cache.fresh(entry):
+        metadata_cache.hits += 1
+    else:
+        entry = await metadata_flights.do(
+            key,
+            lambda: fetch_metadata(
+                key, request.method, path, headers, request.query_params, body
+            ),
+        )
+
+    if entry.status_code == 200 and etag_matches(
+        request.headers.get("if-none-match"), entry.etag
+    ):
+        return Response(status_code=304, headers={"ETag": entry.etag})
+    return Response(
+        content=entry.body, status_code=entry.status_code, headers=entry.headers
+    )
 
 
 @app.middleware("http")
-async def validate_api_key_and_token_middleware(request: Request, call_next):
+async def validate_api_key_middleware(request: Request, call_next):
     """
-    Middleware to validate API key and ensure token validity for each request.
+    Middleware to validate the API key for each request.
     """
     api_key = request.headers.get("x-api-key")
     if api_key != API_KEY and api_key != "":
-        raise HTTPException(status_code=401, detail="Invalid or missing API key")
-
-    # Ensure token is valid
-    await get_token()
+        return JSONResponse(
+            status_code=401, content={"detail": "Invalid or missing API key"}
+        )
 
     # Proceed to the next middleware or endpoint
     response = await call_next(request)
     return response
 
 
+@app.on_event("shutdown")
+async def close_client():
+    for upstream in upstreams:
+        if upstream.scheduled_refresh is not None:
+            upstream.scheduled_refresh.cancel()
+    await client.aclose()
+
+
 @app.api_route("/pxy/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def proxy_request(path: str, request: Request):
     """
-    Pass requests through the protected route.
+    Pass requests through the protected route, streaming the response back
+    byte for byte with the upstream status and headers.
     """
-    token = await get_token()
+    # Forward the original method, headers, and body
+    headers = {
+        name: value
+        for name, value in request.headers.items()
+        if name not in HOP_BY_HOP_HEADERS and name not in REPLACED_REQUEST_HEADERS
+    }
+    body = await request.body()
 
-    # Construct the full URL for the protected route
-    protected_url = f"{BASE_URL}/protected/{path}"
+    if path in CACHED_PATHS and METADATA_CACHE_TTL > 0:
+        return await cached_metadata(request, path, headers, body)
 
-    # Forward the original method, headers, and body
-    async with httpx.AsyncClient() as client:
-        try:
-            method = request.method.upper()
-            headers = {
-                "Authorization": f"Bearer {token}",
-                "Content-Type": request.headers.get("Content-Type", "application/json"),
-            }
-
-            if method == "GET":
-                response = await client.get(
-                    protected_url, headers=headers, params=request.query_params
-                )
-            elif method in {"POST", "PUT", "PATCH"}:
-                body = await request.body()
-                response = await client.request(
-                    method, protected_url, headers=headers, content=body
-                )
-            elif method == "DELETE":
-                response = await client.delete(protected_url, headers=headers)
-            else:
-                raise HTTPException(status_code=405, detail="Method not allowed")
+    response = await forward(request.method, path, headers, request.query_params, body)
 
-            return {
-                "status_code": response.status_code,
-                "content": response.json(),
-                "headers": dict(response.headers),
-            }
-        except httpx.HTTPError as e:
-            raise HTTPException(status_code=500, detail=f"Failed to proxy request: {e}")
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers={
+            name: value
+            for name, value in response.headers.items()
+            if name not in HOP_BY_HOP_HEADERS
+        },
+        background=BackgroundTask(response.aclose),
+    )
 
 
 @app.get("/mw/")
@@ -106,10 +474,22 @@ async def root():
     return {"message": "Proxy is running and ready to handle requests"}
 
 
+@app.get("/mw/upstreams")
+async def upstream_status():
+    """Health of each middleware endpoint and hedging counters."""
+    return {"upstreams": [u.stats() for u in upstreams], "hedging": hedge_stats}
+
+
+@app.get("/mw/cache")
+async def cache_status():
+    """Edge metadata cache counters."""
+    return metadata_cache.stats()
+
+
 # Run the application on port 11434
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run("proxy_script:app", host="0.0.0.0", port=11434, reload=True)
+    uvicorn.run("ollama_proxy_client:app", host="0.0.0.0", port=11434, reload=True)
 
 # uvicorn ollama_proxy_client:app --host 0.0.0.0 --port 11434 --reload
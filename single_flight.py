@@ -0,0 +1,272 @@
+"""
+Single-flight coalescing of identical in-flight upstream requests.
+
+Requests are identified by a canonical hash of their method, path, query and
+body (JSON bodies are re-serialised with sorted keys, so key order and
+whitespace do not matter). While a request is in flight, identical requests
+join it instead of calling Ollama again:
+
+- ``SingleFlight.do`` shares the result of a plain awaitable.
+- ``SingleFlight.stream`` shares a streamed response. The leader's frames are
+  kept in a fan-out buffer; every waiter replays the buffer from the first
+  frame and then follows new frames as they arrive. Frames all subscribers
+  have read are dropped, after which the flight takes no new subscribers.
+
+The upstream work runs in its own task, so a waiter that disconnects does not
+cancel the call for everyone else; it is cancelled once no subscriber is left.
+"""
+
+import asyncio
+import hashlib
+import json
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+
+def request_key(method: str, path: str, query: str, body: bytes) -> str:
+    """Canonical hash for a request, insensitive to JSON key order and spacing."""
+    try:
+        canonical = json.dumps(
+            json.loads(body), sort_keys=True, separators=(",", ":")
+        ).encode("utf-8")
+    except ValueError:
+        canonical = body
+    digest = hashlib.sha256()
+    for part in (method.upper().encode(), path.encode(), query.encode()):
+        digest.update(part)
+        digest.update(b"\0")
+    digest.update(canonical)
+    return digest.hexdigest()
+
+
+# Opens an upstream stream: returns (status_code, media_type, chunk iterator)
+StreamOpener = Callable[[], Awaitable[Tuple[int, str, AsyncIterator[bytes]]]]
+
+
+class Flight:
+    """Fan-out buffer for one streamed upstream response.
+
+    Every ``SingleFlight.stream`` call reserves one subscriber, which the
+    ``Subscription`` returned by ``subscribe`` then takes up or gives back.
+    Frames every subscriber has read are dropped; once that has happened the
+    flight can no longer be joined, since a new subscriber could not replay
+    it from the start. When the
+    last subscriber leaves before the response ends, the upstream call is
+    cancelled.
+    """
+
+    def __init__(self):
+        self.status_code = 0
+        self.media_type = "application/json"
+        self.frames: Deque[bytes] = deque()
+        self.base = 0  # Index of frames[0] in the whole response
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.started = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.reserved = 0
+        self._positions: Dict[int, int] = {}
+        self._next_subscriber = 0
+        self._changed = asyncio.Condition()
+
+    @property
+    def joinable(self) -> bool:
+        return self.base == 0 and not (self.task is not None and self.task.cancelled())
+
+    async def _publish(self, frame: Optional[bytes] = None, done: bool = False):
+        async with self._changed:
+            if frame is not None:
+                self.frames.append(frame)
+            self.done = self.done or done
+            self._changed.notify_all()
+
+    async def run(self, opener: StreamOpener):
+        try:
+            self.status_code, self.media_type, chunks = await opener()
+            self.started.set()
+            async for chunk in chunks:
+                await self._publish(chunk)
+        except BaseException as e:
+            self.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self.started.set()
+            await self._publish(done=True)
+
+    def release(self):
+        """Give up a reservation without subscribing."""
+        self.reserved -= 1
+        self._cancel_if_abandoned()
+
+    def _cancel_if_abandoned(self):
+        if (
+            not self._positions
+            and self.reserved <= 0
+            and not self.done
+            and self.task is not None
+        ):
+            self.task.cancel()
+
+    def _trim(self):
+        # Frames below every subscriber's position are no longer needed
+        if self.reserved > 0 or not self._positions:
+            return
+        lowest = min(self._positions.values())
+        while self.base < lowest and self.frames:
+            self.frames.popleft()
+            self.base += 1
+
+    def subscribe(self) -> "Subscription":
+        """A reader that yields every frame of the response, from the first one onwards."""
+        return Subscription(self)
+
+    def _join(self) -> int:
+        """Turn a reservation into a subscriber reading from the first frame."""
+        subscriber = self._next_subscriber
+        self._next_subscriber += 1
+        self._positions[subscriber] = self.base
+        self.reserved -= 1
+        return subscriber
+
+    async def _next(self, subscriber: int) -> Optional[bytes]:
+        """The subscriber's next frame, or None once the response has ended."""
+        async with self._changed:
+            position = self._positions[subscriber]
+            await self._changed.wait_for(
+                lambda: self.done or self.base + len(self.frames) > position
+            )
+            if position == self.base + len(self.frames):
+                return None
+            frame = self.frames[position - self.base]
+        self._positions[subscriber] += 1
+        self._trim()
+        return frame
+
+    def _leave(self, subscriber: int):
+        del self._positions[subscriber]
+        self._trim()
+        self._cancel_if_abandoned()
+
+
+class Subscription:
+    """One subscriber's read of a flight.
+
+    The first ``__anext__`` takes up the reservation made by
+    ``SingleFlight.stream``. ``close`` leaves the flight; if iteration never
+    started (the client went away before the body was sent) it gives the
+    reservation back, so the flight still trims its buffer and is cancelled
+    once nobody is left.
+    """
+
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        self.subscriber: Optional[int] = None
+        self.closed = False
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.closed:
+            raise StopAsyncIteration
+        if self.subscriber is None:
+            self.subscriber = self.flight._join()
+        try:
+            frame = await self.flight._next(self.subscriber)
+        except BaseException:
+            self.close()
+            raise
+        if frame is None:
+            self.close()
+            if self.flight.error is not None:
+                raise self.flight.error
+            raise StopAsyncIteration
+        return frame
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.subscriber is None:
+            self.flight.release()
+        else:
+            self.flight._leave(self.subscriber)
+
+    async def aclose(self):
+        self.close()
+
+
+class SingleFlight:
+    """Registry of in-flight upstream calls keyed by canonical request hash."""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._flights: Dict[str, Flight] = {}
+        self._running = set()  # Strong references to flight tasks
+        self.upstream_calls = 0
+        self.saved_calls = 0
+
+    async def do(self, key: Optional[str], fn: Callable[[], Awaitable]):
+        """Await fn() once per key, sharing its result with concurrent callers.
+
+        A key of None runs fn() without sharing.
+        """
+        if key is None:
+            self.upstream_calls += 1
+            return await fn()
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self.upstream_calls += 1
+            task.add_done_callback(lambda t: self._forget(self._calls, key, t))
+        else:
+            self.saved_calls += 1
+        return await asyncio.shield(task)
+
+    async def stream(self, key: Optional[str], opener: StreamOpener) -> Flight:
+        """Join or start the flight for key and wait until its status is known.
+
+        A key of None starts a private flight that no other request can join.
+        The caller must iterate or close ``subscribe()`` (or ``release`` the flight).
+        """
+        flight = self._flights.get(key) if key is not None else None
+        if flight is None or not flight.joinable:
+            flight = Flight()
+            if key is not None:
+                self._flights[key] = flight
+            self.upstream_calls += 1
+            flight.task = asyncio.ensure_future(flight.run(opener))
+            self._running.add(flight.task)
+            flight.task.add_done_callback(self._running.discard)
+            flight.task.add_done_callback(
+                lambda t: self._forget(self._flights, key, flight)
+            )
+        else:
+            self.saved_calls += 1
+        flight.reserved += 1
+        try:
+            await flight.started.wait()
+        except asyncio.CancelledError:
+            # The caller went away before the response started
+            flight.release()
+            raise
+        if flight.error is not None and flight.status_code == 0:
+            flight.release()
+            raise flight.error
+        return flight
+
+    @staticmethod
+    def _forget(registry: dict, key: str, entry):
+        if registry.get(key) is entry:
+            del registry[key]
+        if isinstance(entry, asyncio.Future) and not entry.cancelled():
+            entry.exception()  # Mark as retrieved; waiters already saw it
+
+    def stats(self) -> dict:
+        return {
+            "upstream_calls": self.upstream_calls,
+            "saved_calls": self.saved_calls,
+            "in_flight": len(self._calls) + len(self._flights),
+        }
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+
+from clients.adaptive_limit import MAX_RETRY_AFTER, AdaptiveLimit, parse_retry_after
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (None, None),
+        ("", None),
+        ("soon", None),
+        ("3", 3.0),
+        ("1.5", 1.5),
+        ("-4", 0.0),
+        ("100000", MAX_RETRY_AFTER),
+    ],
+)
+def test_parse_retry_after_seconds(value, expected):
+    assert parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+    assert 25 <= parse_retry_after(formatdate(time.time() + 30, usegmt=True)) <= 30
+    assert parse_retry_after(formatdate(time.time() - 30, usegmt=True)) == 0.0
+
+
+def fill(limit):
+    for _ in range(int(limit.limit)):
+        limit.acquire()
+
+
+def test_initial_limit_is_clamped():
+    assert AdaptiveLimit(initial=50, max_limit=8).limit == 8
+    assert AdaptiveLimit(initial=0, min_limit=2).limit == 2
+
+
+def test_full_window_grows_by_about_one_per_round_trip():
+    limit = AdaptiveLimit(initial=4)
+    fill(limit)
+    # Steady state: every completion is replaced by a new request
+    for _ in range(4):
+        limit.release(0.1)
+        limit.acquire()
+    assert 4.9 < limit.limit < 5.1
+    # Completions while the window is not full do not grow it
+    for _ in range(limit.inflight):
+        limit.release(0.1)
+    grown = limit.limit
+    limit.acquire()
+    limit.release(0.1)
+    assert limit.limit == grown
+
+
+def test_overload_halves_once_per_round_trip():
+    limit = AdaptiveLimit(initial=8)
+    fill(limit)
+    limit.release(1.0)
+    grown = limit.limit
+    # The second refusal lands within the same 1 s round trip
+    limit.release(None, overloaded=True)
+    limit.release(None, overloaded=True)
+    assert limit.limit == pytest.approx(grown * 0.5)
+    assert limit.stats()["overloads"] == 2
+
+
+def test_overload_never_goes_below_min_limit():
+    limit = AdaptiveLimit(initial=2, min_limit=2)
+    limit.acquire()
+    limit.release(None, overloaded=True)
+    assert limit.limit == 2
+
+
+def test_latency_back_off_uses_per_item_latency():
+    limit = AdaptiveLimit(initial=8, latency_tolerance=2.0)
+    limit.acquire()
+    limit.release(0.1, items=10)
+    # Ten times the items in ten times the time is the same latency per item
+    limit.acquire()
+    limit.release(1.0, items=100)
+    assert limit.limit == 8
+    for _ in range(20):
+        limit.acquire()
+        limit.release(5.0, items=10)
+    assert limit.limit < 8
+
+
+def test_retry_after_blocks_new_requests():
+    limit = AdaptiveLimit(initial=4)
+    limit.acquire()
+    limit.release(None, overloaded=True, retry_after=0.2)
+    started = time.monotonic()
+    limit.acquire()
+    assert time.monotonic() - started >= 0.15
+    assert limit.stats()["blocked_for_s"] == 0.0
+
+
+def test_full_window_waits_for_a_release_from_another_thread():
+    limit = AdaptiveLimit(initial=1, max_limit=1)
+    limit.acquire()
+    timer = threading.Timer(0.1, limit.release, args=(0.1,))
+    timer.start()
+    started = time.monotonic()
+    limit.acquire()
+    assert time.monotonic() - started >= 0.05
+    assert limit.inflight == 1
+
+
+def test_async_waiters_are_woken_by_a_thread_release():
+    limit = AdaptiveLimit(initial=1, max_limit=1)
+
+    async def main():
+        await limit.aacquire()
+        waiter = asyncio.ensure_future(limit.aacquire())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        threading.Thread(target=limit.release, args=(0.1,)).start()
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(main())
+    assert limit.inflight == 1
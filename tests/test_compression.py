@@ -0,0 +1,145 @@
+import gzip
+import zlib
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import compression
+from compression import CompressionMiddleware, choose_encoding, decompress_body
+
+PAYLOAD = b'{"input": "' + b"a" * 10000 + b'"}'
+
+
+def encoders():
+    """(encoding, compress) for every encoding installed here."""
+    found = [
+        ("gzip", gzip.compress),
+        ("deflate", zlib.compress),
+    ]
+    if compression.zstandard is not None:
+        found.append(("zstd", compression.zstandard.ZstdCompressor().compress))
+    if compression.brotli is not None:
+        found.append(("br", compression.brotli.compress))
+    return found
+
+
+@pytest.mark.parametrize("encoding,compress", encoders())
+def test_decompress_body_round_trips_within_limit(encoding, compress):
+    assert decompress_body(encoding, compress(PAYLOAD), len(PAYLOAD)) == PAYLOAD
+
+
+@pytest.mark.parametrize("encoding,compress", encoders())
+def test_decompress_body_stops_at_limit(encoding, compress):
+    with pytest.raises(OverflowError):
+        decompress_body(encoding, compress(PAYLOAD), len(PAYLOAD) - 1)
+
+
+@pytest.mark.parametrize("encoding,compress", encoders())
+def test_decompress_body_rejects_truncated_input(encoding, compress):
+    body = compress(PAYLOAD)
+    for cut in (len(body) // 2, len(body) - 1):
+        with pytest.raises(ValueError, match="truncated"):
+            decompress_body(encoding, body[:cut], len(PAYLOAD))
+
+
+def test_decompress_body_rejects_corrupt_and_unknown_input():
+    with pytest.raises(ValueError):
+        decompress_body("gzip", b"not gzip", 1000)
+    with pytest.raises(LookupError):
+        decompress_body("lzma", b"", 1000)
+
+
+def test_brotli_without_output_limit_still_stops_early(monkeypatch):
+    brotli = pytest.importorskip("brotli")
+    Decompressor = brotli.Decompressor
+
+    class OldDecompressor:
+        """A decoder without output_buffer_limit, as in brotli < 1.2."""
+
+        def __init__(self):
+            self.decoder = Decompressor()
+
+        def process(self, data):
+            return self.decoder.process(data)
+
+        def is_finished(self):
+            return self.decoder.is_finished()
+
+    monkeypatch.setattr(brotli, "Decompressor", OldDecompressor)
+    with pytest.raises(OverflowError):
+        decompress_body("br", brotli.compress(PAYLOAD), 100)
+    assert decompress_body("br", brotli.compress(PAYLOAD), len(PAYLOAD)) == PAYLOAD
+    with pytest.raises(ValueError, match="truncated"):
+        decompress_body("br", brotli.compress(PAYLOAD)[:-1], len(PAYLOAD))
+
+
+def test_choose_encoding_honors_q_values():
+    assert choose_encoding("gzip;q=0") is None
+    assert choose_encoding("identity") is None
+    assert choose_encoding("gzip, deflate") == "gzip"
+
+
+def app(**kwargs):
+    async def small(request):
+        return JSONResponse({"ok": True})
+
+    async def large(request):
+        return JSONResponse({"text": "a" * 5000})
+
+    async def echo(request):
+        return PlainTextResponse(str(len(await request.body())))
+
+    routes = [
+        Route("/small", small),
+        Route("/large", large),
+        Route("/echo", echo, methods=["POST"]),
+    ]
+    return TestClient(CompressionMiddleware(Starlette(routes=routes), **kwargs))
+
+
+def test_uncompressed_compressible_responses_vary_on_accept_encoding():
+    client = app()
+    small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    assert small.headers["vary"] == "Accept-Encoding"
+
+    plain = client.get("/large", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["vary"] == "Accept-Encoding"
+
+    compressed = client.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert compressed.headers["vary"] == "Accept-Encoding"
+
+
+def test_compressed_request_size_is_limited_while_reading():
+    client = app(max_request_size=len(PAYLOAD))
+    accepted = client.post(
+        "/echo", content=gzip.compress(PAYLOAD), headers={"Content-Encoding": "gzip"}
+    )
+    assert accepted.text == str(len(PAYLOAD))
+
+    # Incompressible input larger than the limit is refused before decoding
+    noise = gzip.compress(bytes(range(256)) * 100, compresslevel=0)
+    refused = app(max_request_size=1000).post(
+        "/echo", content=noise, headers={"Content-Encoding": "gzip"}
+    )
+    assert refused.status_code == 413
+
+
+def test_configured_level_is_used_for_zstd(monkeypatch):
+    zstandard = pytest.importorskip("zstandard")
+    levels = []
+    real = zstandard.ZstdCompressor
+
+    def recording(level):
+        levels.append(level)
+        return real(level=level)
+
+    monkeypatch.setattr(zstandard, "ZstdCompressor", recording)
+    compression._Encoder("zstd", 9)
+    compression._Encoder("zstd", 40)
+    assert levels == [9, 22]
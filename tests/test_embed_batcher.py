@@ -0,0 +1,121 @@
+import asyncio
+
+from embed_batcher import EmbedBatcher
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class Upstream:
+    """Records each batch and answers with one-element vectors of the text length."""
+
+    def __init__(self, delay=0.0):
+        self.batches = []
+        self.delay = delay
+        self.error = None
+        self.inflight = 0
+        self.peak = 0
+
+    async def __call__(self, payload, texts):
+        self.batches.append(list(texts))
+        self.inflight += 1
+        self.peak = max(self.peak, self.inflight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            return vectors(texts)
+        finally:
+            self.inflight -= 1
+
+
+def vectors(texts):
+    return [[float(len(t))] for t in texts]
+
+
+async def warm_up(batcher):
+    # The first arrival in a lane has no gap estimate and is sent at once
+    await batcher.embed("m", {}, ["warm"])
+
+
+def test_concurrent_callers_share_a_batch():
+    async def main():
+        upstream = Upstream()
+        batcher = EmbedBatcher(upstream, min_window=0.02, max_window=0.05)
+        await warm_up(batcher)
+        calls = [["a"], ["bb", "a"], ["ccc"]]
+        results = await asyncio.gather(*(batcher.embed("m", {}, t) for t in calls))
+        assert results == [vectors(t) for t in calls]
+        # Duplicates are sent once and split back to every caller
+        assert upstream.batches[1:] == [["a", "bb", "ccc"]]
+        assert batcher.stats()["requests"] == 4 and batcher.stats()["batches"] == 2
+
+    run(main())
+
+
+def test_namespaces_are_batched_separately():
+    async def main():
+        upstream = Upstream()
+        batcher = EmbedBatcher(upstream, min_window=0.02, max_window=0.05)
+        results = await asyncio.gather(
+            batcher.embed("m", {"model": "m"}, ["x"]),
+            batcher.embed("n", {"model": "n"}, ["yy"]),
+        )
+        assert results == [vectors(["x"]), vectors(["yy"])]
+        assert sorted(upstream.batches) == [["x"], ["yy"]]
+
+    run(main())
+
+
+def test_batches_close_at_max_batch():
+    async def main():
+        upstream = Upstream()
+        batcher = EmbedBatcher(upstream, max_batch=4, min_window=0.02, max_window=0.05)
+        await warm_up(batcher)
+        calls = [["a1", "a2"], ["b1", "b2"], ["c1", "c2"]]
+        results = await asyncio.gather(*(batcher.embed("m", {}, t) for t in calls))
+        assert results == [vectors(t) for t in calls]
+        assert upstream.batches[1:] == [["a1", "a2", "b1", "b2"], ["c1", "c2"]]
+        # A single call of max_batch inputs or more skips the window
+        big = [str(i) for i in range(6)]
+        assert await batcher.embed("m", {}, big) == vectors(big)
+        assert upstream.batches[-1] == big
+
+    run(main())
+
+
+def test_inflight_batches_are_bounded():
+    async def main():
+        upstream = Upstream(delay=0.02)
+        batcher = EmbedBatcher(
+            upstream, max_batch=2, min_window=0.001, max_window=0.05, max_inflight=2
+        )
+        await warm_up(batcher)
+        calls = [[str(i)] for i in range(16)]
+        results = await asyncio.gather(*(batcher.embed("m", {}, t) for t in calls))
+        assert results == [vectors(t) for t in calls]
+        # Full batches queue for a slot instead of piling up at the backend
+        assert upstream.peak == 2
+        assert upstream.batches[1:] == [[str(i), str(i + 1)] for i in range(0, 16, 2)]
+
+    run(main())
+
+
+def test_upstream_error_reaches_every_waiter():
+    async def main():
+        upstream = Upstream()
+        batcher = EmbedBatcher(upstream, min_window=0.02, max_window=0.05)
+        await warm_up(batcher)
+        upstream.error = RuntimeError("connection refused")
+        results = await asyncio.gather(
+            *(batcher.embed("m", {}, [t]) for t in "abc"), return_exceptions=True
+        )
+        assert len(upstream.batches) == 2
+        assert all(r is upstream.error for r in results)
+
+        # The lane's slot is given back, so later calls still go through
+        upstream.error = None
+        assert await batcher.embed("m", {}, ["d"]) == vectors(["d"])
+
+    run(main())
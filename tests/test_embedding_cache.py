@@ -0,0 +1,46 @@
+import logging
+
+from clients.embedding_cache import EmbeddingCache
+from embedding_store import EmbeddingStore
+
+
+def test_vectors_are_namespaced_by_server_model_and_format(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    first = EmbeddingCache(store, "http://a/mw/protected/api/embed", "m", "float32")
+    first.save(["hello"], [[1.0, 2.0]])
+
+    found, missing = first.lookup(["hello", "world", "world"])
+    assert found == [[1.0, 2.0], None, None]
+    assert missing == ["world"]
+
+    for other in (
+        EmbeddingCache(store, "http://b/mw/protected/api/embed", "m", "float32"),
+        EmbeddingCache(store, "http://a/mw/protected/api/embed", "m2", "float32"),
+        EmbeddingCache(store, "http://a/mw/protected/api/embed", "m", "float16"),
+    ):
+        assert other.lookup(["hello"]) == ([None], ["hello"])
+    trailing = EmbeddingCache(store, "http://a/mw/protected/api/embed/", "m", "float32")
+    assert trailing.namespace == first.namespace
+
+
+def test_fill_restores_input_order():
+    found = [[1.0], None, [3.0], None]
+    fetched = {"b": [2.0], "d": [4.0]}
+    assert EmbeddingCache.fill(["a", "b", "c", "d"], found, fetched) == [[1.0], [2.0], [3.0], [4.0]]
+
+
+def test_lookup_logs_at_debug(tmp_path, caplog):
+    cache = EmbeddingCache(EmbeddingStore(str(tmp_path)), "http://a", "m", "float32")
+    with caplog.at_level(logging.INFO, logger="clients.embedding_cache"):
+        cache.lookup(["x"])
+    assert not caplog.records
+    with caplog.at_level(logging.DEBUG, logger="clients.embedding_cache"):
+        cache.lookup(["x"])
+    assert "0/1 texts cached" in caplog.text
+
+
+def test_without_a_store_everything_is_missing():
+    cache = EmbeddingCache(None, "http://a", "m", "float32")
+    assert cache.lookup(["x", "x"]) == ([None, None], ["x"])
+    cache.save(["x"], [[1.0]])
+    assert cache.stats() is None
@@ -0,0 +1,73 @@
+import pytest
+
+from embedding_format import (
+    FLOAT16_MEDIA_TYPE,
+    FLOAT32_MEDIA_TYPE,
+    accept_header,
+    decode_embeddings,
+    embeddings_from_response,
+    encode_embeddings,
+    negotiate,
+)
+
+VECTORS = [[0.5, -1.0, 2.0], [0.0, 0.25, -0.125]]
+
+
+@pytest.mark.parametrize(
+    "accept,expected",
+    [
+        (None, None),
+        ("application/json", None),
+        ("*/*", None),
+        (FLOAT32_MEDIA_TYPE, "float32"),
+        (accept_header("float16"), "float16"),
+        (accept_header("json"), None),
+        (f"{FLOAT16_MEDIA_TYPE}", "float16"),
+        # Highest q-value wins, whatever the order
+        (f"{FLOAT32_MEDIA_TYPE};q=0.2, {FLOAT16_MEDIA_TYPE};q=0.9", "float16"),
+        (f"{FLOAT32_MEDIA_TYPE};q=0.5, application/json", None),
+        (f"application/json;q=0.4, {FLOAT32_MEDIA_TYPE};q=0.5", "float32"),
+        # q=0 means not acceptable
+        (f"{FLOAT32_MEDIA_TYPE};q=0", None),
+        (f"{FLOAT32_MEDIA_TYPE};q=0, {FLOAT16_MEDIA_TYPE}", "float16"),
+        # Ties go to the lossless float32
+        (f"{FLOAT16_MEDIA_TYPE}, {FLOAT32_MEDIA_TYPE}", "float32"),
+        (f"{FLOAT32_MEDIA_TYPE};q=junk", None),
+    ],
+)
+def test_negotiate(accept, expected):
+    assert negotiate(accept) == expected
+
+
+def test_float32_round_trip_is_exact():
+    body = encode_embeddings(VECTORS, "float32")
+    assert len(body) == 16 + 2 * 3 * 4
+    assert decode_embeddings(body) == VECTORS
+    assert embeddings_from_response(f"{FLOAT32_MEDIA_TYPE}; charset=binary", body) == VECTORS
+
+
+def test_float16_round_trip_and_memoryview_input():
+    assert decode_embeddings(encode_embeddings(VECTORS, "float16")) == VECTORS
+    views = [memoryview(bytearray(encode_embeddings([v])[16:])).cast("f") for v in VECTORS]
+    assert decode_embeddings(encode_embeddings(views)) == VECTORS
+
+
+def test_empty_batch():
+    assert decode_embeddings(encode_embeddings([])) == []
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_decode_rejects_truncated_or_padded_bodies(dtype):
+    body = encode_embeddings(VECTORS, dtype)
+    with pytest.raises(ValueError):
+        decode_embeddings(body[:-1])
+    with pytest.raises(ValueError):
+        decode_embeddings(body + b"\0\0\0\0")
+    with pytest.raises(ValueError):
+        decode_embeddings(body[:10])
+    with pytest.raises(ValueError):
+        decode_embeddings(b"JUNK" + body[4:])
+
+
+def test_json_responses_pass_through():
+    assert embeddings_from_response("application/json", b'{"embeddings": [[1.0]]}') == [[1.0]]
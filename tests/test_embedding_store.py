@@ -0,0 +1,93 @@
+import os
+import threading
+
+import pytest
+
+from embedding_store import HEADER, KEY_SIZE, EmbeddingStore, namespace_stem
+
+NS = "nomic-embed-text"
+
+
+def vector(i, dim=4):
+    return [float(i), float(i) + 0.5, -float(i), 0.25][:dim]
+
+
+def lists(found):
+    return [None if v is None else v.tolist() for v in found]
+
+
+def test_round_trip_persists_across_reopen(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    assert store.get_many(NS, ["a"]) == [None]
+    store.put_many(NS, ["a", "b", "a"], [vector(1), vector(2), vector(9)])
+    assert lists(store.get_many(NS, ["b", "a", "c"])) == [vector(2), vector(1), None]
+    assert store.stats()["rows"] == {NS: 2}
+    store.close()
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert lists(reopened.get_many(NS, ["a", "b"])) == [vector(1), vector(2)]
+    # Namespaces do not share rows
+    assert reopened.get_many("other", ["a"]) == [None]
+    assert reopened.stats()["hits"] == 2 and reopened.stats()["misses"] == 1
+
+
+def test_refresh_picks_up_rows_from_another_instance(tmp_path):
+    writer = EmbeddingStore(str(tmp_path))
+    reader = EmbeddingStore(str(tmp_path))
+    writer.put_many(NS, ["a"], [vector(1)])
+    assert lists(reader.get_many(NS, ["a", "b"])) == [vector(1), None]
+    writer.put_many(NS, ["b"], [vector(2)])
+    assert lists(reader.get_many(NS, ["a", "b"])) == [vector(1), vector(2)]
+    # A row another instance already stored is not appended twice
+    reader.put_many(NS, ["b"], [vector(2)])
+    assert reader.stats()["rows"] == {NS: 2}
+
+
+def test_concurrent_appends_from_separate_instances(tmp_path):
+    stores = [EmbeddingStore(str(tmp_path)) for _ in range(4)]
+
+    def write(worker, store):
+        for batch in range(10):
+            texts = [f"{worker}-{batch}-{i}" for i in range(5)]
+            store.put_many(NS, texts, [vector(worker * 100 + batch * 5 + i) for i in range(5)])
+
+    threads = [threading.Thread(target=write, args=(w, s)) for w, s in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    check = EmbeddingStore(str(tmp_path))
+    texts = [f"{w}-{b}-{i}" for w in range(4) for b in range(10) for i in range(5)]
+    expected = [vector(w * 100 + b * 5 + i) for w in range(4) for b in range(10) for i in range(5)]
+    assert lists(check.get_many(NS, texts)) == expected
+    assert check.stats()["rows"] == {NS: 200}
+
+
+def test_torn_key_is_ignored_and_overwritten(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.put_many(NS, ["a", "b"], [vector(1), vector(2)])
+    store.close()
+    idx = os.path.join(str(tmp_path), f"{namespace_stem(NS)}.idx")
+    # A crash part-way through writing the next key
+    with open(idx, "ab") as f:
+        f.write(b"\x01" * (KEY_SIZE // 2))
+
+    store = EmbeddingStore(str(tmp_path))
+    assert lists(store.get_many(NS, ["a", "b"])) == [vector(1), vector(2)]
+    store.put_many(NS, ["c"], [vector(3)])
+    assert os.path.getsize(idx) == HEADER.size + 3 * KEY_SIZE
+    assert lists(EmbeddingStore(str(tmp_path)).get_many(NS, ["a", "b", "c"])) == [
+        vector(1),
+        vector(2),
+        vector(3),
+    ]
+
+
+def test_dimension_mismatch_is_rejected(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.put_many(NS, ["a"], [vector(1)])
+    with pytest.raises(ValueError):
+        store.put_many(NS, ["b"], [vector(2, dim=3)])
+    with pytest.raises(ValueError):
+        store.put_many(NS, ["b"], [])
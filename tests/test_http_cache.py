@@ -0,0 +1,47 @@
+import pytest
+
+from http_cache import CachedResponse, ResponseCache, entity_tag, etag_matches
+
+TAG = entity_tag(b'{"models": []}')
+
+
+def test_entity_tag_is_weak_and_stable():
+    assert TAG.startswith('W/"') and TAG.endswith('"')
+    assert TAG == entity_tag(b'{"models": []}')
+    assert TAG != entity_tag(b'{"models": [1]}')
+
+
+@pytest.mark.parametrize(
+    "if_none_match,etag,expected",
+    [
+        (None, TAG, False),
+        ("", TAG, False),
+        (TAG, None, False),
+        ("*", TAG, True),
+        (" * ", TAG, True),
+        (TAG, TAG, True),
+        # Weak comparison ignores the W/ prefix on either side
+        (TAG[2:], TAG, True),
+        (TAG, TAG[2:], True),
+        (f'"other", {TAG}', TAG, True),
+        (f'W/"other",{TAG[2:]}', TAG, True),
+        ('W/"other"', TAG, False),
+        # The quotes are part of the opaque tag
+        (TAG[3:-1], TAG, False),
+    ],
+)
+def test_etag_matches(if_none_match, etag, expected):
+    assert etag_matches(if_none_match, etag) is expected
+
+
+def test_response_cache_keeps_stale_entries_and_evicts_lru():
+    cache = ResponseCache(ttl=0.0, max_entries=2)
+    for key in ("a", "b"):
+        cache.put(key, CachedResponse(200, {"etag": TAG}, key.encode()))
+    cache.get("a")
+    cache.put("c", CachedResponse(200, {}, b"c"))
+    assert cache.get("b") is None
+    entry = cache.get("a")
+    assert entry.etag == TAG and not cache.fresh(entry)
+    assert not cache.fresh(None)
+    assert cache.stats()["entries"] == 2
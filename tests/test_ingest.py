@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from clients.ingest import IngestPipeline, MmapSink, split_text
+
+WORDS = " ".join(f"word{i}" for i in range(400))
+
+
+def fake_embed(texts):
+    return [[float(len(text)), 1.0] for text in texts]
+
+
+class ListSink:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunks, vectors):
+        self.chunks.extend(chunks)
+
+
+def test_split_text_respects_size_and_overlaps():
+    chunks = list(split_text(WORDS, size=200, overlap=50))
+    assert len(chunks) > 1
+    assert all(len(c) <= 200 for c in chunks)
+    for previous, current in zip(chunks, chunks[1:]):
+        # Each chunk starts on a whole word taken from the end of the previous one
+        assert current.split()[0] in previous.split()
+    assert chunks[0].startswith("word0 ") and chunks[-1].endswith("word399")
+
+
+def test_split_text_prefers_paragraph_boundaries():
+    text = "a" * 80 + "\n\n" + "b" * 80 + ". " + "c" * 30
+    chunks = list(split_text(text, size=150, overlap=0))
+    assert chunks[0] == "a" * 80
+    assert chunks[1].startswith("b")
+
+
+def test_split_text_edge_cases():
+    assert list(split_text("   ")) == []
+    assert list(split_text(" short ")) == ["short"]
+    # No boundary at all: hard cuts that still make progress
+    chunks = list(split_text("x" * 250, size=100, overlap=20))
+    assert all(len(c) <= 100 for c in chunks)
+    assert "".join(chunks).count("x") >= 250
+
+
+def test_duplicates_are_skipped_within_and_across_runs(tmp_path):
+    sink = ListSink()
+    state = str(tmp_path / "state.db")
+    pipeline = IngestPipeline(fake_embed, sink, state_path=state, batch_size=2)
+    summary = pipeline.run(["alpha", "beta", "alpha", {"id": "d", "text": "gamma"}])
+    assert summary["written"] == 3 and summary["skipped"] == 1
+    assert [c.text for c in sink.chunks] == ["alpha", "beta", "gamma"]
+
+    again = IngestPipeline(fake_embed, ListSink(), state_path=state)
+    assert again.run(["beta", "delta"])["written"] == 1
+
+
+@pytest.mark.parametrize("failing_stage", ["embed", "sink"])
+def test_failed_batch_is_retried_by_the_next_run(failing_stage):
+    sink = ListSink()
+    calls = []
+
+    def embed(texts):
+        calls.append(texts)
+        if failing_stage == "embed" and len(calls) == 1:
+            raise RuntimeError("server down")
+        return fake_embed(texts)
+
+    write = sink.write
+
+    def flaky_write(chunks, vectors):
+        if failing_stage == "sink" and not sink.chunks and len(calls) == 1:
+            raise OSError("disk full")
+        write(chunks, vectors)
+
+    sink.write = flaky_write
+    pipeline = IngestPipeline(embed, sink, batch_size=2)
+    with pytest.raises((RuntimeError, OSError)):
+        pipeline.run(["one", "two"])
+    assert pipeline._pending == set()
+
+    assert pipeline.run(["one", "two"])["written"] == 2
+    assert [c.text for c in sink.chunks] == ["one", "two"]
+
+
+def test_mmap_sink_drops_a_torn_write_on_reopen(tmp_path):
+    path = str(tmp_path / "vectors")
+    sink = MmapSink(path)
+    IngestPipeline(fake_embed, sink, batch_size=1).run(["one", "three"])
+    sink.close()
+    # A crash after the vector row but before its chunk line
+    with open(f"{path}.f32", "ab") as f:
+        f.write(b"\0" * 8)
+    with open(f"{path}.jsonl", "a") as f:
+        f.write('{"id": "torn"')
+
+    sink = MmapSink(path)
+    assert sink.rows == 2
+    IngestPipeline(fake_embed, sink).run(["seven"])
+    sink.close()
+    with open(f"{path}.jsonl") as f:
+        assert len([json.loads(line) for line in f]) == 3
+    with open(f"{path}.f32", "rb") as f:
+        assert len(f.read()) == 3 * 2 * 4
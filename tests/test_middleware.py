@@ -0,0 +1,290 @@
+import asyncio
+import json
+import math
+import os
+import time
+
+import httpx
+import numpy as np
+import pytest
+
+# Keep the module-level stores out of the working tree; the fixture swaps them anyway
+os.environ.setdefault("EMBED_STORE_DIR", "")
+os.environ.setdefault("VECTOR_STORE_DIR", "")
+
+import auth_middleware  # noqa: E402
+from benchmarks.stub_ollama import StubConfig, create_app  # noqa: E402
+from embed_batcher import EmbedBatcher  # noqa: E402
+from embedding_store import EmbeddingStore  # noqa: E402
+from single_flight import SingleFlight  # noqa: E402
+from vector_index import VectorStore  # noqa: E402
+
+FAST = dict(embedding_dim=8, tokens_per_second=2000.0, default_tokens=5)
+
+# Fields Ollama sends on the final frame of /api/generate and /api/chat
+FINAL_FIELDS = {
+    "model",
+    "created_at",
+    "done",
+    "done_reason",
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+}
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    """Run test(client, stub) against the middleware, with the stub Ollama as upstream.
+
+    ``client`` is an authenticated httpx client for the middleware app and
+    ``stub`` the stub's ``StubOllama`` state (request counter, config).
+    """
+    monkeypatch.setattr(auth_middleware, "OLLAMA_API_URL", "http://ollama/")
+    monkeypatch.setattr(auth_middleware, "embedding_store", None)
+    monkeypatch.setattr(auth_middleware, "vector_store", VectorStore(None))
+    monkeypatch.setattr(auth_middleware, "single_flight", SingleFlight())
+    monkeypatch.setattr(
+        auth_middleware, "embed_batcher", EmbedBatcher(auth_middleware.send_embed_batch)
+    )
+
+    def run(test, **config):
+        async def main():
+            stub_app = create_app(StubConfig(**{**FAST, **config}))
+            upstream = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub_app))
+            monkeypatch.setattr(auth_middleware, "upstream_client", upstream)
+            headers = {"Authorization": f"Bearer {auth_middleware.generate_token()}"}
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=auth_middleware.app),
+                base_url="http://proxy",
+                headers=headers,
+            ) as client:
+                try:
+                    return await test(client, stub_app.state.stub)
+                finally:
+                    await upstream.aclose()
+
+        return asyncio.run(main())
+
+    return run
+
+
+def ndjson(body: bytes) -> list:
+    return [json.loads(line) for line in body.splitlines() if line]
+
+
+def test_generate_streams_ollama_frames_through(proxy):
+    async def test(client, stub):
+        request = {"model": "llama3.2", "prompt": "hello", "options": {"num_predict": 4}}
+        response = await client.post("/protected/api/generate", json=request)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        frames = ndjson(response.content)
+        assert [f["done"] for f in frames] == [False] * 4 + [True]
+        assert set(frames[-1]) == FINAL_FIELDS | {"response"}
+        assert frames[-1]["eval_count"] == 4
+
+        # Non-streaming returns the same text in one frame
+        whole = await client.post("/protected/api/generate", json={**request, "stream": False})
+        assert whole.json()["response"] == "".join(f["response"] for f in frames)
+
+    proxy(test)
+
+
+def test_chat_and_openai_streams_keep_their_shapes(proxy):
+    async def test(client, stub):
+        messages = [{"role": "user", "content": "hi"}]
+        chat = await client.post(
+            "/protected/api/chat", json={"model": "llama3.2", "messages": messages}
+        )
+        frames = ndjson(chat.content)
+        assert all(f["message"]["role"] == "assistant" for f in frames)
+        assert set(frames[-1]) == FINAL_FIELDS | {"message"}
+
+        openai = await client.post(
+            "/protected/v1/chat/completions",
+            json={
+                "model": "llama3.2",
+                "messages": messages,
+                "stream": True,
+                "stream_options": {"include_usage": True},
+            },
+        )
+        assert openai.headers["content-type"].startswith("text/event-stream")
+        events = [e[len("data: ") :] for e in openai.text.split("\n\n") if e]
+        assert events[-1] == "[DONE]"
+        usage = json.loads(events[-2])
+        assert usage["choices"] == [] and usage["usage"]["completion_tokens"] == 5
+        assert json.loads(events[-3])["choices"][0]["finish_reason"] == "stop"
+
+    proxy(test)
+
+
+def test_injected_failure_becomes_an_ollama_api_error(proxy):
+    async def test(client, stub):
+        for path, request in (
+            ("api/generate", {"model": "llama3.2", "prompt": "x"}),
+            ("api/embed", {"model": "nomic-embed-text", "input": "x"}),
+        ):
+            response = await client.post(f"/protected/{path}", json=request)
+            assert response.status_code == 500
+            assert "Ollama API Error" in response.json()["detail"]
+            assert "injected failure" in response.json()["detail"]
+
+    proxy(test, failure_rate=1.0)
+
+
+def test_stalled_stream_still_completes(proxy):
+    async def test(client, stub):
+        started = time.monotonic()
+        response = await client.post(
+            "/protected/api/generate", json={"model": "llama3.2", "prompt": "x"}
+        )
+        assert time.monotonic() - started >= 0.2
+        assert ndjson(response.content)[-1]["done"] is True
+
+    proxy(test, stall_rate=1.0, stall_seconds=0.2)
+
+
+def test_unknown_model_is_passed_through_as_404(proxy):
+    async def test(client, stub):
+        response = await client.post(
+            "/protected/api/show", json={"model": "missing"}
+        )
+        assert response.status_code == 404
+        assert "not found" in response.json()["detail"]
+
+    proxy(test)
+
+
+def test_concurrent_embeds_share_upstream_calls(proxy):
+    async def test(client, stub):
+        async def embed(text):
+            response = await client.post(
+                "/protected/api/embed", json={"model": "nomic-embed-text", "input": [text]}
+            )
+            return response.json()["embeddings"][0]
+
+        texts = [f"text {i % 4}" for i in range(12)]
+        vectors = await asyncio.gather(*(embed(t) for t in texts))
+        assert all(len(v) == 8 and math.isclose(math.hypot(*v), 1.0) for v in vectors)
+        assert vectors[0] == vectors[4] != vectors[1]
+        assert stub.requests < len(texts)
+
+    proxy(test)
+
+
+def test_tags_are_revalidated_with_an_etag(proxy):
+    async def test(client, stub):
+        first = await client.get("/protected/api/tags")
+        assert [m["name"] for m in first.json()["models"]] == stub.config.models
+        etag = first.headers["etag"]
+        again = await client.get("/protected/api/tags", headers={"If-None-Match": etag})
+        assert again.status_code == 304 and again.content == b""
+
+    proxy(test)
+
+
+def test_vector_routes_reject_malformed_fields(proxy):
+    async def test(client, stub):
+        base = "/protected/vectors/docs"
+        for items in ({"id": 1}, ["idx"], [{"text": "no id"}], [], None):
+            response = await client.post(f"{base}/upsert", json={"items": items})
+            assert response.status_code == 400, items
+        upsert = await client.post(
+            f"{base}/upsert",
+            json={
+                "model": "nomic-embed-text",
+                "items": [{"id": "a", "text": "alpha", "metadata": {"n": 1}}],
+            },
+        )
+        assert upsert.json() == {"upserted": 1, "count": 1}
+
+        for include in ("metadata", ["metadata", "scores"], [["metadata"]], {"metadata": 1}):
+            response = await client.post(
+                f"{base}/query", json={"query": "alpha", "include": include}
+            )
+            assert response.status_code == 400, include
+        hits = await client.post(
+            f"{base}/query", json={"query": "alpha", "include": ["documents"]}
+        )
+        assert hits.json()["ids"] == [["a"]]
+        assert hits.json()["documents"] == [["alpha"]] and "metadata" not in hits.json()
+        assert (await client.post(f"{base}/query", json={"query": "alpha"})).json()[
+            "metadata"
+        ] == [[{"n": 1}]]
+
+    proxy(test)
+
+
+def test_unreachable_ollama_is_a_500_on_the_embed_path(proxy):
+    def refuse(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    async def test(client, stub):
+        auth_middleware.upstream_client = httpx.AsyncClient(
+            transport=httpx.MockTransport(refuse)
+        )
+        for request in (
+            {"model": "nomic-embed-text", "input": "x"},
+            {"model": "nomic-embed-text", "input": ["x", "y"]},
+        ):
+            response = await client.post("/protected/api/embed", json=request)
+            assert response.status_code == 500
+            assert response.json()["detail"].startswith("Failed to query Ollama")
+
+    proxy(test)
+
+
+def test_embeds_are_served_from_the_store(proxy, monkeypatch, tmp_path):
+    monkeypatch.setattr(auth_middleware, "embedding_store", EmbeddingStore(str(tmp_path)))
+
+    async def test(client, stub):
+        request = {"model": "nomic-embed-text", "input": ["a", "b"]}
+        first = await client.post("/protected/api/embed", json=request)
+        calls = stub.requests
+        again = await client.post("/protected/api/embed", json=request)
+        # Stored as float32
+        assert np.allclose(again.json()["embeddings"], first.json()["embeddings"], atol=1e-6)
+        assert stub.requests == calls
+
+    proxy(test)
+
+
+@pytest.mark.parametrize("cancel", [False, True])
+def test_flight_response_releases_an_unstarted_subscription(cancel):
+    async def main():
+        flights = SingleFlight()
+
+        async def opener():
+            async def chunks():
+                await asyncio.sleep(3600)
+                yield b"never"
+
+            return 200, "application/x-ndjson", chunks()
+
+        flight = await flights.stream("k", opener)
+        response = auth_middleware.FlightResponse(flight)
+
+        async def receive():
+            if cancel:
+                await asyncio.sleep(3600)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            # The client never reads the response start
+            await asyncio.sleep(3600)
+
+        call = asyncio.ensure_future(response({"type": "http"}, receive, send))
+        await asyncio.sleep(0.01)
+        if cancel:
+            # e.g. BaseHTTPMiddleware tearing down the inner app
+            call.cancel()
+        await asyncio.gather(call, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert flight.reserved == 0 and flight.task.cancelled()
+
+    asyncio.run(main())
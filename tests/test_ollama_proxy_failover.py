@@ -0,0 +1,140 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import ollama_proxy_client as proxy
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def install(monkeypatch, handlers):
+    """Point the proxy at fake endpoints; handlers map host to a request handler."""
+    calls = []
+
+    def handle(request):
+        if request.url.path.endswith("/generate-token"):
+            return httpx.Response(200, json={"token": "t"})
+        calls.append((request.url.host, request.method, request.url.path))
+        return handlers[request.url.host](request)
+
+    monkeypatch.setattr(
+        proxy, "client", httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    )
+    monkeypatch.setattr(
+        proxy, "upstreams", [proxy.Upstream(f"http://{host}") for host in handlers]
+    )
+    return calls
+
+
+def ok(request):
+    return httpx.Response(200, json={"ok": True})
+
+
+def unavailable(request):
+    return httpx.Response(503)
+
+
+def refuse(request):
+    raise httpx.ConnectError("refused", request=request)
+
+
+def drop(request):
+    raise httpx.RemoteProtocolError("closed", request=request)
+
+
+def read_timeout(request):
+    raise httpx.ReadTimeout("slow", request=request)
+
+
+async def forward(method, path):
+    try:
+        response = await proxy.forward(method, path, {}, {}, b"{}")
+        await response.aread()
+        return response.status_code
+    finally:
+        for upstream in proxy.upstreams:
+            if upstream.scheduled_refresh is not None:
+                upstream.scheduled_refresh.cancel()
+
+
+def test_post_fails_over_on_connect_error(monkeypatch):
+    calls = install(monkeypatch, {"a": refuse, "b": ok})
+    assert run(forward("POST", "api/chat")) == 200
+    assert [host for host, _, _ in calls] == ["a", "b"]
+
+
+@pytest.mark.parametrize("failure", [drop, read_timeout])
+def test_post_is_not_resent_after_it_may_have_arrived(monkeypatch, failure):
+    calls = install(monkeypatch, {"a": failure, "b": ok})
+    with pytest.raises(HTTPException):
+        run(forward("POST", "api/generate"))
+    assert [host for host, _, _ in calls] == ["a"]
+
+
+def test_post_returns_upstream_5xx_without_failover(monkeypatch):
+    calls = install(monkeypatch, {"a": unavailable, "b": ok})
+    assert run(forward("POST", "api/chat")) == 503
+    assert [host for host, _, _ in calls] == ["a"]
+
+
+@pytest.mark.parametrize("method,path", [("GET", "api/version"), ("POST", "api/embed")])
+def test_idempotent_requests_fail_over_on_status_and_timeouts(monkeypatch, method, path):
+    calls = install(monkeypatch, {"a": unavailable, "b": read_timeout, "c": ok})
+    assert run(forward(method, path)) == 200
+    assert [host for host, _, _ in calls] == ["a", "b", "c"]
+
+
+def test_hedged_send_does_not_duplicate_non_idempotent_requests(monkeypatch):
+    async def slow(request):
+        await asyncio.sleep(0.05)
+        return httpx.Response(200)
+
+    calls = install(monkeypatch, {"a": slow, "b": ok})
+    monkeypatch.setattr(proxy, "HEDGE_DEFAULT_DELAY", 0.0)
+    monkeypatch.setitem(proxy.hedge_stats, "eligible", 100)
+    monkeypatch.setitem(proxy.hedge_stats, "hedged", 0)
+    primary, secondary = proxy.upstreams
+
+    async def send(method, path):
+        args = (method, path, {}, {}, b"{}", proxy.is_idempotent(method, path))
+        response = await proxy.hedged_send(primary, secondary, *args)
+        await response.aclose()
+        for upstream in (primary, secondary):
+            if upstream.scheduled_refresh is not None:
+                upstream.scheduled_refresh.cancel()
+
+    run(send("POST", "api/chat"))
+    assert [host for host, _, _ in calls] == ["a"]
+
+    run(send("POST", "api/embed"))
+    assert [host for host, _, _ in calls[1:]] == ["a", "b"]
+
+
+def test_discarded_response_is_closed_with_a_strong_reference():
+    class Response:
+        closed = False
+
+        async def aclose(self):
+            await asyncio.sleep(0)
+            self.closed = True
+
+    async def main():
+        response = Response()
+
+        async def arrived():
+            return response
+
+        winner = asyncio.ensure_future(arrived())
+        await winner
+        proxy.discard(winner)
+        assert len(proxy.closing) == 1
+        await asyncio.gather(*proxy.closing)
+        await asyncio.sleep(0)
+        return response
+
+    assert run(main()).closed
+    assert not proxy.closing
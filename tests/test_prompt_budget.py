@@ -0,0 +1,86 @@
+import pytest
+
+from clients.prompt_budget import TRUNCATION_MARKER, PromptTrimmer, TokenEstimator
+
+MODEL = "m"
+
+
+def estimator():
+    return TokenEstimator(path=None)
+
+
+def msg(role, size, fill="x"):
+    return {"role": role, "content": fill * size}
+
+
+def test_messages_that_fit_are_returned_unchanged():
+    trimmer = PromptTrimmer(estimator())
+    messages = [msg("system", 40), msg("user", 40)]
+    assert trimmer.fit(MODEL, messages, 1000) is messages
+    assert trimmer.stats()["trimmed_requests"] == 0
+
+
+def test_drop_oldest_replaces_old_turns_with_a_note():
+    trimmer = PromptTrimmer(estimator(), "drop_oldest")
+    messages = [msg("system", 40, "s")] + [
+        msg("user" if i % 2 == 0 else "assistant", 400, str(i)) for i in range(6)
+    ]
+    kept = trimmer.fit(MODEL, messages, 350)
+    assert kept[0] == messages[0]
+    assert "omitted" in kept[1]["content"]
+    assert kept[-1] == messages[-1]
+    assert trimmer.estimator.count_messages(MODEL, kept) <= 350
+    assert trimmer.stats()["messages_dropped"] == len(messages) - len(kept) + 1
+
+
+def test_drop_middle_keeps_the_first_turn():
+    trimmer = PromptTrimmer(estimator(), "drop_middle")
+    messages = [msg("system", 40, "s")] + [
+        msg("user" if i % 2 == 0 else "assistant", 400, str(i)) for i in range(6)
+    ]
+    kept = trimmer.fit(MODEL, messages, 350)
+    assert kept[:2] == messages[:2]
+    assert "omitted" in kept[2]["content"]
+    assert kept[-1] == messages[-1]
+
+
+def test_truncate_cuts_several_messages_until_it_fits():
+    trimmer = PromptTrimmer(estimator())
+    messages = [
+        msg("system", 400, "s"),
+        msg("assistant", 800, "a"),
+        msg("tool", 800, "t"),
+        msg("user", 400, "u"),
+    ]
+    budget = 350
+    kept = trimmer._truncate(MODEL, messages, budget)
+    assert trimmer.estimator.count_messages(MODEL, kept) <= budget
+    # The system message and the last user message are untouched
+    assert kept[0] == messages[0] and kept[-1] == messages[-1]
+    for message in kept[1:3]:
+        assert message["content"].count(TRUNCATION_MARKER) == 1
+
+
+def test_truncate_never_cuts_protected_messages():
+    trimmer = PromptTrimmer(estimator())
+    messages = [msg("system", 4000, "s"), msg("assistant", 400, "a"), msg("user", 4000, "u")]
+    kept = trimmer._truncate(MODEL, messages, 100)
+    assert kept[0] == messages[0] and kept[2] == messages[2]
+    assert kept[1]["content"] == TRUNCATION_MARKER
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        PromptTrimmer(estimator(), "drop_newest")
+
+
+def test_estimator_calibrates_and_persists(tmp_path):
+    path = str(tmp_path / "calibration.json")
+    first = TokenEstimator(path=path)
+    messages = [msg("user", 3000)]
+    first.observe(MODEL, messages, prompt_tokens=1000 + 3 + 4)
+    assert first.ratio(MODEL) == pytest.approx(3.0)
+    assert TokenEstimator(path=path).ratio(MODEL) == pytest.approx(3.0)
+    # Short prompts say too little about the tokenizer
+    first.observe("other", [msg("user", 50)], prompt_tokens=60)
+    assert first.ratio("other") == 4.0
@@ -0,0 +1,175 @@
+import asyncio
+
+from single_flight import SingleFlight, request_key
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def opener_for(frames, calls, gate=None):
+    async def opener():
+        calls.append(1)
+
+        async def chunks():
+            for frame in frames:
+                if gate is not None:
+                    await gate.wait()
+                yield frame
+
+        return 200, "application/x-ndjson", chunks()
+
+    return opener
+
+
+def test_request_key_ignores_json_key_order():
+    a = request_key("POST", "api/embed", "", b'{"model": "m", "input": "x"}')
+    b = request_key("post", "api/embed", "", b'{"input":"x","model":"m"}')
+    assert a == b
+    assert a != request_key("POST", "api/show", "", b'{"model": "m", "input": "x"}')
+
+
+def test_concurrent_streams_share_one_upstream_call():
+    async def main():
+        flights = SingleFlight()
+        calls = []
+        opener = opener_for([b"a", b"b", b"c"], calls)
+
+        async def consume():
+            flight = await flights.stream("k", opener)
+            return b"".join([f async for f in flight.subscribe()])
+
+        results = await asyncio.gather(consume(), consume(), consume())
+        return results, calls, flights.stats()
+
+    results, calls, stats = run(main())
+    assert results == [b"abc"] * 3
+    assert len(calls) == 1
+    assert stats["saved_calls"] == 2
+
+
+def test_read_frames_are_dropped_and_flight_stops_accepting_joiners():
+    async def main():
+        flights = SingleFlight()
+        calls = []
+        gate = asyncio.Event()
+        gate.set()
+        opener = opener_for([b"a", b"b", b"c"], calls, gate)
+        flight = await flights.stream("k", opener)
+        stream = flight.subscribe()
+        assert await stream.__anext__() == b"a"
+        await asyncio.sleep(0)
+        assert await stream.__anext__() == b"b"
+        # Everything the only subscriber has read is gone
+        assert flight.base >= 1
+        assert not flight.joinable
+        second = await flights.stream("k", opener)
+        assert second is not flight
+        rest = [f async for f in stream]
+        assert b"".join([f async for f in second.subscribe()]) == b"abc"
+        return rest, calls
+
+    rest, calls = run(main())
+    assert rest == [b"c"]
+    assert len(calls) == 2
+
+
+def test_upstream_is_cancelled_when_last_subscriber_leaves():
+    async def main():
+        flights = SingleFlight()
+        closed = asyncio.Event()
+
+        async def opener():
+            async def chunks():
+                try:
+                    yield b"first"
+                    await asyncio.sleep(3600)
+                    yield b"never"
+                finally:
+                    closed.set()
+
+            return 200, "application/x-ndjson", chunks()
+
+        flight = await flights.stream("k", opener)
+        other = await flights.stream("k", opener)
+        assert other is flight
+        first, second = flight.subscribe(), other.subscribe()
+        assert await first.__anext__() == b"first"
+        assert await second.__anext__() == b"first"
+        await first.aclose()
+        await asyncio.sleep(0.01)
+        # One subscriber is still reading, so the upstream call continues
+        assert not flight.task.done()
+        await second.aclose()
+        await asyncio.wait_for(closed.wait(), 1)
+        await asyncio.sleep(0)
+        return flight, flights.stats()
+
+    flight, stats = run(main())
+    assert flight.task.cancelled()
+    assert stats["in_flight"] == 0
+
+
+def test_caller_cancelled_before_start_cancels_upstream():
+    async def main():
+        flights = SingleFlight()
+        started = asyncio.Event()
+
+        async def opener():
+            started.set()
+            await asyncio.sleep(3600)
+
+        waiter = asyncio.ensure_future(flights.stream("k", opener))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        return list(flights._running), flights.stats()
+
+    running, stats = run(main())
+    assert running == []
+    assert stats["in_flight"] == 0
+
+
+def test_do_shares_result():
+    async def main():
+        flights = SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 42
+
+        return await asyncio.gather(*(flights.do("k", fn) for _ in range(4))), calls
+
+    results, calls = run(main())
+    assert results == [42] * 4
+    assert len(calls) == 1
+
+
+def test_closing_an_unread_subscription_gives_back_the_reservation():
+    async def main():
+        flights = SingleFlight()
+        calls = []
+        gate = asyncio.Event()
+        opener = opener_for([b"a", b"b"], calls, gate)
+        flight = await flights.stream("k", opener)
+        joined = await flights.stream("k", opener)
+        unread, reader = flight.subscribe(), joined.subscribe()
+        # The client behind unread disconnected before its body started
+        unread.close()
+        unread.close()
+        assert flight.reserved == 1
+        gate.set()
+        assert [f async for f in reader] == [b"a", b"b"]
+        assert flight.base == 2 and not flight.frames
+        assert [f async for f in unread] == []
+
+        # With no one left, the upstream call is cancelled
+        gate.clear()
+        abandoned = await flights.stream("other", opener_for([b"x"], calls, gate))
+        await abandoned.subscribe().aclose()
+        await asyncio.sleep(0)
+        return abandoned
+
+    assert run(main()).task.cancelled()
@@ -0,0 +1,95 @@
+import asyncio
+
+import httpx
+import pytest
+
+from clients import transport as transport_module
+from clients.transport import OllamaTransport, transport_for
+
+
+def fake_transport(handler, **kwargs):
+    """A transport whose sync client answers with handler (tokens are always issued)."""
+    calls = []
+
+    def handle(request):
+        if request.url.path.endswith("/generate-token"):
+            return httpx.Response(200, json={"token": "t"})
+        calls.append(request.method)
+        return handler(request, len(calls))
+
+    transport = OllamaTransport("http://mw", backoff=0.0, **kwargs)
+    transport._client = httpx.Client(transport=httpx.MockTransport(handle))
+    return transport, calls
+
+
+def busy_once(request, count):
+    return httpx.Response(503 if count == 1 else 200)
+
+
+def test_remote_protocol_error_is_not_retried():
+    assert httpx.RemoteProtocolError not in transport_module.RETRY_EXCEPTIONS
+
+    def drop(request, count):
+        raise httpx.RemoteProtocolError("closed", request=request)
+
+    transport, calls = fake_transport(drop)
+    with pytest.raises(httpx.RemoteProtocolError):
+        transport.post("api/chat", json={})
+    assert calls == ["POST"]
+
+
+def test_chat_post_is_not_retried_on_status():
+    transport, calls = fake_transport(busy_once)
+    assert transport.post("api/chat", json={}).status_code == 503
+    assert calls == ["POST"]
+
+
+@pytest.mark.parametrize(
+    "method,kwargs",
+    [("GET", {}), ("POST", {"bulk": 2}), ("POST", {"idempotent": True})],
+)
+def test_idempotent_and_bulk_requests_are_retried_on_status(method, kwargs):
+    transport, calls = fake_transport(busy_once)
+    assert transport.request(method, "api/embed", **kwargs).status_code == 200
+    assert len(calls) == 2
+
+
+def test_connect_errors_are_retried_for_any_method():
+    def refuse_once(request, count):
+        if count == 1:
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200)
+
+    transport, calls = fake_transport(refuse_once)
+    assert transport.post("api/chat", json={}).status_code == 200
+    assert calls == ["POST", "POST"]
+
+
+def test_async_client_is_per_event_loop():
+    transport = OllamaTransport("http://mw")
+
+    async def client_pair():
+        return transport.async_client, transport.async_client, len(transport._async_clients)
+
+    first, again, _ = asyncio.run(client_pair())
+    assert first is again
+    second, _, loops = asyncio.run(client_pair())
+    assert second is not first
+    # The client of the closed first loop is not kept around
+    assert loops == 1
+
+    async def close():
+        await transport.aclose()
+
+    asyncio.run(close())
+
+
+def test_transport_for_separates_settings(monkeypatch):
+    monkeypatch.setattr(transport_module, "_transports", {})
+    config = {"base_url": "http://mw/", "token_password": "p"}
+    shared = transport_for(config)
+    assert transport_for({**config, "base_url": "http://mw"}) is shared
+    slow = transport_for({**config, "timeout": 30.0})
+    assert slow is not shared
+    assert slow.timeout.read == 30.0
+    assert transport_for({**config, "max_inflight": 4}).bulk_limit.max_limit == 4
@@ -0,0 +1,141 @@
+import os
+import threading
+
+import numpy as np
+
+import vector_index
+from vector_index import IVFIndex, VectorCollection, VectorStore, normalize, top_k
+
+
+def random_vectors(rows, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((rows, dim)).astype(np.float32)
+
+
+def upsert(collection, ids, vectors):
+    return collection.upsert(ids, vectors, "m", [None] * len(ids), [None] * len(ids))
+
+
+def test_top_k_orders_best_first():
+    scores = np.array([0.1, 0.9, 0.5, 0.7, 0.3])
+    assert top_k(scores, 2).tolist() == [1, 3]
+    assert top_k(scores, 10).tolist() == [1, 3, 2, 4, 0]
+
+
+def test_ivf_index_lists_cover_every_row_once():
+    vectors = normalize(random_vectors(400))
+    index = IVFIndex(vectors)
+    assert len(index.centroids) == 20
+    assert sorted(index.order.tolist()) == list(range(400))
+    everything = index.candidates(vectors[0], nprobe=len(index.centroids))
+    assert sorted(everything.tolist()) == list(range(400))
+    # A row is always in its own nearest list
+    assert 7 in index.candidates(vectors[7], nprobe=1).tolist()
+
+
+def test_exact_search_finds_the_query_row():
+    collection = VectorCollection("c", None, ivf_min_rows=10**6)
+    vectors = random_vectors(50)
+    upsert(collection, [f"id{i}" for i in range(50)], vectors)
+    hits = collection.search(vectors[[3, 9]], k=3, nprobe=1)
+    assert [h[0]["id"] for h in hits] == ["id3", "id9"]
+    assert abs(hits[0][0]["score"] - 1.0) < 1e-5
+
+
+def test_ivf_search_sees_rows_written_after_the_build():
+    collection = VectorCollection("c", None, ivf_min_rows=100)
+    vectors = random_vectors(400)
+    upsert(collection, [f"id{i}" for i in range(400)], vectors)
+    collection.search(vectors[:1], k=1, nprobe=1)
+    collection.wait_for_index()
+    assert collection.describe()["index"] == "ivf"
+
+    # Overwritten, swapped-in (by a delete) and appended rows are scanned exactly
+    moved = random_vectors(2, seed=1)
+    upsert(collection, ["id5", "new"], moved)
+    collection.delete(["id0"])
+    hits = collection.search(np.vstack([moved, vectors[399]]), k=1, nprobe=1)
+    assert [h[0]["id"] for h in hits] == ["id5", "new", "id399"]
+    assert all(h["id"] != "id0" for h in collection.search(vectors[:1], k=5, nprobe=20)[0])
+
+
+def test_search_maps_rows_through_a_consistent_view(monkeypatch):
+    """A delete landing while a search scores must not attach scores to the wrong ids."""
+    collection = VectorCollection("c", None, ivf_min_rows=10**6)
+    vectors = random_vectors(10)
+    upsert(collection, [f"id{i}" for i in range(10)], vectors)
+
+    score = VectorCollection._score
+    raced = threading.Event()
+
+    def racing_score(self, *args):
+        ranked = score(self, *args)
+        if not raced.is_set():
+            raced.set()
+            # Moves id9 into row 0 after the scores were computed
+            self.delete(["id0"])
+        return ranked
+
+    monkeypatch.setattr(VectorCollection, "_score", racing_score)
+    hits = collection.search(vectors[:1], k=3, nprobe=1)
+    assert raced.is_set()
+    # Every score belongs to the id it is reported with, and id0 is gone
+    unit = normalize(vectors)
+    for hit in hits[0]:
+        row = int(hit["id"][2:])
+        assert row != 0
+        assert abs(hit["score"] - float(unit[row] @ unit[0])) < 1e-5
+
+
+def test_writes_append_to_the_journal_and_other_workers_replay_it(tmp_path):
+    first = VectorStore(str(tmp_path), ivf_min_rows=10**6)
+    second = VectorStore(str(tmp_path), ivf_min_rows=10**6)
+    vectors = random_vectors(20)
+    upsert(first.collection("docs", create=True), [f"id{i}" for i in range(20)], vectors)
+    assert not os.path.exists(tmp_path / "docs.npz")
+    size = os.path.getsize(tmp_path / "docs.wal")
+
+    reader = second.collection("docs")
+    assert reader.count == 20
+    first.collection("docs").delete(["id1"])
+    assert os.path.getsize(tmp_path / "docs.wal") > size
+    assert reader.search(vectors[1:2], k=1, nprobe=1)[0][0]["id"] != "id1"
+    assert reader.count == 19
+    assert second.names() == ["docs"]
+
+
+def test_journal_is_compacted_into_a_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "MIN_COMPACT_BYTES", 1000)
+    store = VectorStore(str(tmp_path), ivf_min_rows=10**6)
+    collection = store.collection("docs", create=True)
+    vectors = random_vectors(40)
+    for i in range(40):
+        upsert(collection, [f"id{i}"], vectors[i : i + 1])
+    assert os.path.exists(tmp_path / "docs.npz")
+    assert os.path.getsize(tmp_path / "docs.wal") < os.path.getsize(tmp_path / "docs.npz")
+
+    reloaded = VectorStore(str(tmp_path)).collection("docs")
+    assert reloaded.count == 40
+    assert reloaded.search(vectors[39:], k=1, nprobe=1)[0][0]["id"] == "id39"
+
+
+def test_torn_journal_record_is_ignored_and_overwritten(tmp_path):
+    store = VectorStore(str(tmp_path), ivf_min_rows=10**6)
+    vectors = random_vectors(3)
+    upsert(store.collection("docs", create=True), ["a", "b"], vectors[:2])
+    with open(tmp_path / "docs.wal", "ab") as f:
+        f.write(b'{"op": "upsert", "ids": ["c"], "dim": 16')
+
+    other = VectorStore(str(tmp_path), ivf_min_rows=10**6)
+    assert other.collection("docs").count == 2
+    upsert(other.collection("docs"), ["c"], vectors[2:])
+    assert VectorStore(str(tmp_path)).collection("docs").count == 3
+
+
+def test_drop_removes_the_collection_for_every_worker(tmp_path):
+    first = VectorStore(str(tmp_path))
+    second = VectorStore(str(tmp_path))
+    upsert(first.collection("docs", create=True), ["a"], random_vectors(1))
+    assert second.collection("docs").count == 1
+    assert first.drop("docs")
+    assert second.collection("docs") is None
+    assert second.names() == []
@@ -0,0 +1,602 @@
+"""
+Named collections of embeddings with top-k cosine search.
+
+Each collection keeps its vectors L2-normalised in one contiguous float32
+NumPy array (grown by doubling), so a cosine score is a dot product and a
+search over the whole collection is one matrix multiply:
+
+- Below ``ivf_min_rows`` rows every query is scored against every row
+  (exact, and fast enough at that size).
+- From ``ivf_min_rows`` rows up, an IVF index is built in a background
+  thread (searches stay exact until it is ready): spherical k-means over a
+  sample gives ``sqrt(rows)`` centroids, every row is assigned to its
+  nearest centroid, and a query only scores the rows of its ``nprobe``
+  nearest lists. Rows added or overwritten after the build are scanned
+  exhaustively; a new index is built in the background once they pass 10%
+  of the collection.
+
+Searches score a consistent view without blocking writers: they note the
+collection's version under the lock, score outside it, and start again if a
+write landed in between (falling back to scoring under the lock).
+
+With a directory, each collection is a ``.npz`` snapshot (vectors plus a
+JSON header with ids, metadata and documents) and a ``.wal`` journal that
+every write appends one record to, under an exclusive ``flock``. Once the
+journal outgrows the snapshot it is folded into a new snapshot. Workers
+sharing the directory replay the journal records they have not seen yet,
+so they all serve the same data without reloading the whole collection.
+"""
+
+import fcntl
+import json
+import logging
+import math
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+COLLECTION_NAME = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+# Rows assigned to centroids per block, to bound the temporary score matrix
+ASSIGN_BLOCK_ROWS = 16384
+
+# Fraction of stale rows (added or changed since the build) that triggers a rebuild
+REBUILD_FRACTION = 0.1
+
+# Searches scored outside the lock before one is scored under it
+OPTIMISTIC_SEARCH_ATTEMPTS = 2
+
+# The journal is folded into the snapshot once it passes this size and the snapshot's
+MIN_COMPACT_BYTES = 1024 * 1024
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indexes of the k highest scores, best first."""
+    if k >= len(scores):
+        return np.argsort(-scores)
+    best = np.argpartition(-scores, k)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+class IVFIndex:
+    """Inverted-file index over normalised vectors: centroids plus one row list each."""
+
+    def __init__(self, vectors: np.ndarray, iterations: int = 10, seed: int = 0):
+        rows = len(vectors)
+        self.rows = rows
+        lists = max(1, int(math.sqrt(rows)))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(rows, size=min(rows, lists * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=lists) == 0
+            # Re-seed empty lists from random sample rows
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = normalize(sums)
+        self.centroids = centroids
+
+        assignment = np.empty(rows, dtype=np.int32)
+        for start in range(0, rows, ASSIGN_BLOCK_ROWS):
+            block = vectors[start : start + ASSIGN_BLOCK_ROWS]
+            assignment[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        self.order = np.argsort(assignment, kind="stable").astype(np.int64)
+        self.offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignment, minlength=lists)))
+        )
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Rows in the nprobe lists nearest to query."""
+        nprobe = min(nprobe, len(self.centroids))
+        nearest = top_k(self.centroids @ query, nprobe)
+        return np.concatenate(
+            [self.order[self.offsets[c] : self.offsets[c + 1]] for c in nearest]
+        )
+
+
+class VectorCollection:
+    """One named collection: vectors, ids, metadata and documents."""
+
+    def __init__(self, name: str, path: Optional[str], ivf_min_rows: int):
+        self.name = name
+        self.path = path
+        self.snapshot_path = f"{path}.npz" if path else None
+        self.journal_path = f"{path}.wal" if path else None
+        self.ivf_min_rows = ivf_min_rows
+        self._lock = threading.Lock()
+        self.version = 0
+        self._builder: Optional[threading.Thread] = None
+        self._reset()
+
+    def _reset(self):
+        self.model: Optional[str] = None
+        self.dim = 0
+        self.count = 0
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        self.documents: List[Optional[str]] = []
+        self.rows: Dict[str, int] = {}
+        self.version += 1
+        # Index state: rows below index.rows written since the build are "dirty"
+        self.index: Optional[IVFIndex] = None
+        self.dirty: Set[int] = set()
+        # The build in progress (a token), the rows it covers and rows written since
+        self._building: Optional[object] = None
+        self._building_rows = 0
+        self._building_dirty: Set[int] = set()
+        # What has been read from disk
+        self._snapshot_stat = None
+        self._journal_inode = None
+        self._journal_offset = 0
+
+    # -- persistence -------------------------------------------------------
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def exists(self) -> bool:
+        return bool(self.path) and (
+            os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path)
+        )
+
+    def _changed(self) -> bool:
+        """Whether another worker wrote since the files were last read."""
+        if self.path is None:
+            return False
+        journal = self._stat(self.journal_path)
+        seen = (self._journal_inode, self._journal_offset) if self._journal_inode else None
+        return self._stat(self.snapshot_path) != self._snapshot_stat or (
+            (journal[0], journal[2]) if journal else None
+        ) != seen
+
+    def refresh(self):
+        """Catch up with writes made by other workers."""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        # Caller holds self._lock; readers take a shared flock so no write is half-seen
+        if self._changed():
+            with self._file_lock(shared=True):
+                self._sync()
+
+    def _sync(self):
+        """Load what changed on disk; the caller holds self._lock and the file lock."""
+        if self.path is None:
+            return
+        snapshot = self._stat(self.snapshot_path)
+        journal = self._stat(self.journal_path)
+        if snapshot is None and journal is None:
+            if self._snapshot_stat is not None or self._journal_inode is not None:
+                # Dropped by another worker
+                self._reset()
+            return
+        journal_inode = journal[0] if journal else None
+        if (
+            snapshot != self._snapshot_stat
+            or journal_inode != self._journal_inode
+            or (journal is not None and journal[2] < self._journal_offset)
+        ):
+            # Compacted or recreated elsewhere: start again from the snapshot
+            self._reset()
+            if snapshot is not None:
+                self._load_snapshot()
+            self._snapshot_stat = snapshot
+            self._journal_inode = journal_inode
+        if journal is not None and journal[2] > self._journal_offset:
+            self._replay()
+
+    def _load_snapshot(self):
+        with np.load(self.snapshot_path) as snapshot:
+            header = json.loads(snapshot["header"].tobytes().decode("utf-8"))
+            vectors = snapshot["vectors"]
+        self.model = header["model"]
+        self.dim = header["dim"]
+        self.ids = header["ids"]
+        self.metadata = header["metadata"]
+        self.documents = header["documents"]
+        self.rows = {id_: row for row, id_ in enumerate(self.ids)}
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.count = len(self.ids)
+        logging.info(f"Loaded vector collection {self.name!r} ({self.count} rows)")
+
+    def _replay(self):
+        """Apply journal records past the last one read; a torn last record is left alone."""
+        with open(self.journal_path, "rb") as f:
+            f.seek(self._journal_offset)
+            applied = 0
+            while True:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                if record["op"] == "upsert":
+                    size = len(record["ids"]) * record["dim"] * 4
+                    payload = f.read(size)
+                    if len(payload) < size:
+                        break
+                    vectors = np.frombuffer(payload, dtype=np.float32).reshape(
+                        len(record["ids"]), record["dim"]
+                    )
+                    self._apply_upsert(
+                        record["ids"],
+                        vectors,
+                        record["model"],
+                        record["metadata"],
+                        record["documents"],
+                    )
+                else:
+                    self._apply_delete(record["ids"])
+                self._journal_offset = f.tell()
+                applied += 1
+        if applied:
+            logging.info(
+                f"Replayed {applied} journal records for {self.name!r} ({self.count} rows)"
+            )
+
+    def _append(self, record: dict, payload: bytes = b""):
+        """Log one write; the caller holds self._lock and the exclusive file lock."""
+        if self.path is None:
+            return
+        with open(self.journal_path, "ab") as f:
+            # Bytes past what was replayed can only be a write that died half-way
+            f.truncate(self._journal_offset)
+            f.write(json.dumps(record).encode("utf-8") + b"\n" + payload)
+            self._journal_offset = f.tell()
+        self._journal_inode = os.stat(self.journal_path).st_ino
+        snapshot_size = self._snapshot_stat[2] if self._snapshot_stat else 0
+        if self._journal_offset > max(MIN_COMPACT_BYTES, snapshot_size):
+            self._compact()
+
+    def _compact(self):
+        """Fold the journal into a new snapshot."""
+        header = json.dumps(
+            {
+                "model": self.model,
+                "dim": self.dim,
+                "ids": self.ids,
+                "metadata": self.metadata,
+                "documents": self.documents,
+            }
+        ).encode("utf-8")
+        tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp,
+            vectors=self.vectors[: self.count],
+            header=np.frombuffer(header, dtype=np.uint8),
+        )
+        os.replace(tmp, self.snapshot_path)
+        os.truncate(self.journal_path, 0)
+        self._snapshot_stat = self._stat(self.snapshot_path)
+        self._journal_offset = 0
+
+    def _file_lock(self, shared: bool = False):
+        return _FileLock(f"{self.path}.lock" if self.path else None, shared)
+
+    # -- writes ------------------------------------------------------------
+
+    def _reserve(self, rows: int):
+        if rows <= len(self.vectors):
+            return
+        capacity = max(rows, 2 * len(self.vectors), 64)
+        grown = np.zeros((capacity, self.dim), dtype=np.float32)
+        grown[: self.count] = self.vectors[: self.count]
+        self.vectors = grown
+
+    def _mark_dirty(self, row: int):
+        """Note that a row changed under the current (and the in-progress) index."""
+        if self.index is not None and row < self.index.rows:
+            self.dirty.add(row)
+        if self._building is not None and row < self._building_rows:
+            self._building_dirty.add(row)
+
+    def _apply_upsert(self, ids, vectors, model, metadata, documents):
+        if not self.count and self.vectors.shape[1] != vectors.shape[1]:
+            self.vectors = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+        self.dim = vectors.shape[1]
+        self.model = self.model or model
+        self._reserve(self.count + len(ids))
+        for id_, vector, meta, document in zip(ids, vectors, metadata, documents):
+            row = self.rows.get(id_)
+            if row is None:
+                row = self.count
+                self.count += 1
+                self.rows[id_] = row
+                self.ids.append(id_)
+                self.metadata.append(meta or {})
+                self.documents.append(document)
+            else:
+                self.metadata[row] = meta or {}
+                self.documents[row] = document
+            self.vectors[row] = vector
+            self._mark_dirty(row)
+        self.version += 1
+
+    def _apply_delete(self, ids) -> int:
+        removed = 0
+        for id_ in ids:
+            row = self.rows.pop(id_, None)
+            if row is None:
+                continue
+            last = self.count - 1
+            if row != last:
+                self.vectors[row] = self.vectors[last]
+                self.ids[row] = self.ids[last]
+                self.metadata[row] = self.metadata[last]
+                self.documents[row] = self.documents[last]
+                self.rows[self.ids[row]] = row
+                self._mark_dirty(row)
+            self.ids.pop()
+            self.metadata.pop()
+            self.documents.pop()
+            self.count -= 1
+            removed += 1
+        if removed:
+            self.version += 1
+        return removed
+
+    def upsert(
+        self,
+        ids: Sequence[str],
+        vectors: np.ndarray,
+        model: Optional[str],
+        metadata: Sequence[Optional[dict]],
+        documents: Sequence[Optional[str]],
+    ) -> int:
+        """Insert or replace rows; returns the collection size."""
+        with self._lock, self._file_lock():
+            self._sync()
+            if self.count and vectors.shape[1] != self.dim:
+                raise ValueError(
+                    f"Vector dimension {vectors.shape[1]} does not match collection "
+                    f"dimension {self.dim}"
+                )
+            if self.count and model and self.model and model != self.model:
+                raise ValueError(f"Collection {self.name!r} holds {self.model} embeddings")
+            vectors = normalize(vectors)
+            metadata = [meta or {} for meta in metadata]
+            documents = list(documents)
+            self._apply_upsert(ids, vectors, model, metadata, documents)
+            self._append(
+                {
+                    "op": "upsert",
+                    "ids": list(ids),
+                    "dim": self.dim,
+                    "model": model,
+                    "metadata": metadata,
+                    "documents": documents,
+                },
+                np.ascontiguousarray(vectors, dtype=np.float32).tobytes(),
+            )
+            return self.count
+
+    def delete(self, ids: Sequence[str]) -> int:
+        """Remove rows by id (moving the last row into each gap); returns the number removed."""
+        with self._lock, self._file_lock():
+            self._sync()
+            removed = self._apply_delete(ids)
+            if removed:
+                self._append({"op": "delete", "ids": list(ids)})
+            return removed
+
+    # -- index -------------------------------------------------------------
+
+    def _stale_rows(self) -> int:
+        if self.index is None:
+            return self.count
+        return len(self.dirty) + max(0, self.count - self.index.rows)
+
+    def _maybe_build_index(self):
+        """Start a background build when the index is missing or too stale (caller holds the lock)."""
+        if self.count < self.ivf_min_rows or self._building is not None:
+            return
+        if self.index is not None and self._stale_rows() <= REBUILD_FRACTION * self.count:
+            return
+        self._building = token = object()
+        self._building_rows = self.count
+        self._building_dirty = set()
+        vectors = self.vectors[: self.count].copy()
+        self._builder = threading.Thread(
+            target=self._build_index, args=(vectors, token), daemon=True
+        )
+        self._builder.start()
+
+    def _build_index(self, vectors: np.ndarray, token: object):
+        logging.info(f"Building IVF index for {self.name!r} ({len(vectors)} rows)")
+        try:
+            index = IVFIndex(vectors)
+        except Exception as e:
+            logging.error(f"IVF index build for {self.name!r} failed: {e}")
+            index = None
+        with self._lock:
+            if self._building is not token:
+                return  # The collection was reloaded from scratch meanwhile
+            self._building = None
+            if index is not None:
+                self.index = index
+                self.dirty = self._building_dirty
+                self.version += 1
+
+    def wait_for_index(self, timeout: Optional[float] = None):
+        """Block until a background index build (if any) has finished."""
+        builder = self._builder
+        if builder is not None:
+            builder.join(timeout)
+
+    # -- search ------------------------------------------------------------
+
+    def _score(self, queries, k, nprobe, vectors, count, index, extra):
+        """(row, score) hits per query against one view of the collection."""
+        if index is None:
+            # Exact: one matrix multiply for all queries
+            scores = queries @ vectors[:count].T
+            return [[(int(row), float(s[row])) for row in top_k(s, k)] for s in scores]
+        ranked = []
+        for query in queries:
+            # Listed rows past count were deleted; dirty and new rows are scanned exactly
+            listed = index.candidates(query, nprobe)
+            rows = np.union1d(listed[listed < count], extra)
+            row_scores = vectors[rows] @ query
+            best = top_k(row_scores, k)
+            ranked.append([(int(rows[i]), float(row_scores[i])) for i in best])
+        return ranked
+
+    def _view(self):
+        index = self.index
+        extra = None
+        if index is not None:
+            extra = np.union1d(
+                np.fromiter(self.dirty, dtype=np.int64, count=len(self.dirty)),
+                np.arange(index.rows, self.count),
+            )
+            extra = extra[extra < self.count]
+        return self.vectors, self.count, index, extra
+
+    def _hits(self, ranked) -> List[List[dict]]:
+        return [
+            [
+                {
+                    "id": self.ids[row],
+                    "score": score,
+                    "metadata": self.metadata[row],
+                    "document": self.documents[row],
+                }
+                for row, score in hits
+            ]
+            for hits in ranked
+        ]
+
+    def search(self, queries: np.ndarray, k: int, nprobe: int) -> List[List[dict]]:
+        """Hits (id, score, metadata, document) for each query, best first."""
+        queries = normalize(queries)
+        for attempt in range(OPTIMISTIC_SEARCH_ATTEMPTS + 1):
+            with self._lock:
+                self._refresh()
+                if self.count and queries.shape[1] != self.dim:
+                    raise ValueError(
+                        f"Query dimension {queries.shape[1]} does not match collection "
+                        f"dimension {self.dim}"
+                    )
+                if not self.count:
+                    return [[] for _ in queries]
+                self._maybe_build_index()
+                version = self.version
+                view = self._view()
+                if attempt == OPTIMISTIC_SEARCH_ATTEMPTS:
+                    # Writers kept landing mid-search: score this one under the lock
+                    return self._hits(self._score(queries, k, nprobe, *view))
+
+            # Scoring runs outside the lock, so searches proceed in parallel
+            ranked = self._score(queries, k, nprobe, *view)
+
+            with self._lock:
+                # Rows are only mapped to ids if no write moved them in the meantime
+                if self.version == version:
+                    return self._hits(ranked)
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "model": self.model,
+                "dim": self.dim,
+                "count": self.count,
+                "index": "ivf" if self.index is not None else "exact",
+                "lists": len(self.index.centroids) if self.index is not None else 0,
+                "stale_rows": self._stale_rows() if self.index is not None else 0,
+                "indexing": self._building is not None,
+            }
+
+
+class _FileLock:
+    """flock on a path (exclusive unless shared), or nothing without one."""
+
+    def __init__(self, path: Optional[str], shared: bool = False):
+        self.path = path
+        self.shared = shared
+        self.fd = None
+
+    def __enter__(self):
+        if self.path:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+class VectorStore:
+    """The collections of one middleware, optionally persisted to a directory."""
+
+    def __init__(self, directory: Optional[str], ivf_min_rows: int = 20000, nprobe: int = 8):
+        self.directory = directory
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._collections: Dict[str, VectorCollection] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> Optional[str]:
+        return os.path.join(self.directory, name) if self.directory else None
+
+    def collection(self, name: str, create: bool = False) -> Optional[VectorCollection]:
+        if not COLLECTION_NAME.match(name):
+            raise ValueError(f"Invalid collection name {name!r}")
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                if not create and not self.directory:
+                    return None
+                collection = VectorCollection(name, self._path(name), self.ivf_min_rows)
+            if not create and collection.path and not collection.exists():
+                # Never written, or dropped by another worker
+                self._collections.pop(name, None)
+                return None
+            self._collections[name] = collection
+        collection.refresh()
+        return collection
+
+    def names(self) -> List[str]:
+        names = set(self._collections)
+        if self.directory:
+            names.update(
+                f.rsplit(".", 1)[0]
+                for f in os.listdir(self.directory)
+                if f.endswith((".npz", ".wal")) and ".tmp" not in f
+            )
+        return sorted(names)
+
+    def drop(self, name: str) -> bool:
+        collection = self.collection(name)
+        if collection is None:
+            return False
+        with self._lock:
+            self._collections.pop(name, None)
+        if collection.path:
+            with collection._file_lock():
+                for path in (collection.snapshot_path, collection.journal_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return True